@@ -1,56 +1,24 @@
 #!/usr/bin/env python3
-import os
 import time
-from datetime import datetime
-from bioblend.galaxy import GalaxyInstance
+from galaxy_session import connect, HistoryIndex
+from galaxy_polling import wait_for_datasets, failed_datasets
+from stage_manifest import StageManifest
+from galaxy_tools import quast_request, signature, submit
+from pipeline_events import stage_logger, sample_timing
 
-API_KEY_FILE = "galaxy/key.txt"
-ACCESSION_FILE = "download/accession.txt"
-GALAXY_URL = "https://usegalaxy.eu"
-QUAST_TOOL_ID = "toolshed.g2.bx.psu.edu/repos/iuc/quast/quast/5.3.0+galaxy0"
 CHECK_INTERVAL = 30  # seconds
 LOG_FILE = "../outputs/galaxy/quast_metagenomic.log"
 
-def log(message):
-    timestamp = datetime.now().strftime("[%Y-%m-%d %H:%M:%S]")
-    with open(LOG_FILE, "a") as logfile:
-        logfile.write(f"{timestamp} {message}\n")
-    print(f"{timestamp} {message}")
+log = stage_logger("assembly_qc", LOG_FILE)
 
-def check_jobs_completion(gi, history_id, dataset_ids):
-    statuses = []
-    for dsid in dataset_ids:
-        state = gi.histories.show_dataset(history_id, dsid)["state"]
-        statuses.append((dsid, state, state == "ok"))
-    return statuses
-
-
-if not os.path.exists(API_KEY_FILE) or not os.path.exists(ACCESSION_FILE):
-    log("ERROR: Missing API key or accession file.")
-    exit(1)
-
-with open(API_KEY_FILE, "r") as key_file:
-    api_key = key_file.read().strip()
-
-with open(ACCESSION_FILE, "r") as accession_file:
-    history_name = accession_file.read().strip()
-
-gi = GalaxyInstance(GALAXY_URL, api_key)
-
-# Retrieve the specified history
-histories = gi.histories.get_histories(name=history_name)
-if not histories:
-    log(f"ERROR: History '{history_name}' not found.")
-    exit(1)
-history_id = histories[0]["id"]
-log(f"Using history '{history_name}' (ID: {history_id})")
+gi, history_id, history_name = connect(log)
+index = HistoryIndex(gi, history_id)
+index.sync()
 
 # MEGAHIT output datasets
-history_contents = gi.histories.show_history(history_id, contents=True)
 megahit_outputs = {
-    item["name"]: item["id"]
-    for item in history_contents
-    if item["history_content_type"] == "dataset" and "MEGAHIT" in item["name"]
+    item["name"]: (item["id"], item["state"])
+    for item in index.find(name_contains="MEGAHIT")
 }
 
 if not megahit_outputs:
@@ -60,55 +28,53 @@ if not megahit_outputs:
 log(f"Found MEGAHIT outputs: {list(megahit_outputs.keys())}")
 
 # QUAST
+manifest = StageManifest()
 submitted_jobs = []
+submitted = {}
+submit_times = {}
+up_to_date = 0
 
-for name, dataset_id in megahit_outputs.items():
+for name, (dataset_id, state) in megahit_outputs.items():
     log(f"Processing file: '{name}'")
 
-    dataset_info = gi.histories.show_dataset(history_id, dataset_id)
-    if dataset_info["state"] != "ok":
+    if state != "ok":
         log(f"Skipping '{name}': Dataset not in 'ok' state.")
         continue
 
-    log(f"Launching QUAST (metagenome mode) for '{name}'...")
-
-    quast_inputs = {
-    "mode|mode": "individual",
-    "mode|in|custom": "false",
-    "mode|in|inputs": { "src": "hda", "id": dataset_id },
-    "assembly|type": "metagenome"
-    }
+    request = quast_request(dataset_id)
+    sig = signature(manifest, request, {"assembly": dataset_id})
+    if manifest.is_current("assembly_qc", name, sig):
+        log(f"Skipping '{name}': QUAST already ran on this assembly.")
+        up_to_date += 1
+        continue
 
-    response = gi.tools.run_tool(
-        history_id=history_id,
-        tool_id=QUAST_TOOL_ID,
-        tool_inputs=quast_inputs
-    )
+    log(f"Launching QUAST (metagenome mode) for '{name}'...")
 
-    output_ids = [output["id"] for output in response["outputs"]]
+    output_ids = [output["id"] for output in submit(gi, history_id, request)]
     log(f"  '{name}' - outputs: {output_ids}")
 
     submitted_jobs.extend(output_ids)
+    submitted[name] = (sig, output_ids)
+    submit_times[name] = time.time()
 
 if not submitted_jobs:
+    if up_to_date:
+        log(f"Nothing to submit: QUAST is up to date for {up_to_date} assembly(ies).")
+        exit(0)
     log("ERROR: No QUAST jobs were submitted.")
     exit(1)
 
 # Check if it's completed
 log(f"Waiting for {len(submitted_jobs)} QUAST job(s) to finish...")
-while True:
-    time.sleep(CHECK_INTERVAL)
-    job_statuses = check_jobs_completion(gi, history_id, submitted_jobs)
-    pending_jobs = [(dsid, state) for dsid, state, is_ok in job_statuses if not is_ok]
-    for dsid, state, is_ok in job_statuses:
-        log(f"  Dataset {dsid}: {state}")
-    if not pending_jobs:
-        break
-    log(f"{len(pending_jobs)} job(s) still running...")
+timeline = {}
+states = wait_for_datasets(gi, history_id, submitted_jobs, log, CHECK_INTERVAL, index, timeline)
+for name, (sig, output_ids) in submitted.items():
+    sample_timing("assembly_qc", name, submit_times[name], output_ids, timeline, states)
+    if all(states[dsid] == "ok" for dsid in output_ids):
+        manifest.record("assembly_qc", name, sig, output_ids)
 
 # Check final status
-final_statuses = check_jobs_completion(gi, history_id, submitted_jobs)
-failed = [dsid for dsid, state, is_ok in final_statuses if not is_ok]
+failed = failed_datasets(states)
 
 if failed:
     log(f"ERROR: {len(failed)} QUAST job(s) failed: {failed}. Stop the script here if you want to change settings.")
@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+import re
+import json
+import time
+import random
+import argparse
+import threading
+from collections import Counter
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# Stand-in for the parts of the Galaxy API the pipeline scripts use:
+# histories, history contents and /api/datasets listings, show_dataset,
+# run_tool and upload_from_ftp (POST /api/tools), map-over of collections,
+# show_job and dataset download. Jobs finish after a random duration, some fail, and every
+# request is counted per route for the benchmark.
+
+DB_TAXA = 200  # distinct lineages in generated Kraken-translate output
+
+def timestamp(t):
+    # Galaxy-style update_time; always with microseconds so strings sort
+    return datetime.fromtimestamp(t, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")
+
+class MockGalaxy:
+
+    def __init__(self, job_seconds=(0.5, 2.0), failure_rate=0.0, history_size=0, output_lines=1000, seed=1):
+        self.job_seconds = job_seconds
+        self.failure_rate = failure_rate
+        self.history_size = history_size
+        self.output_lines = output_lines
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.next_id = 1
+        self.histories = {}
+        self.datasets = {}
+        self.jobs = {}
+        self.collections = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.calls = Counter()
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def stats(self):
+        return {"calls": dict(self.calls), "total_calls": sum(self.calls.values()),
+                "bytes_in": self.bytes_in, "bytes_out": self.bytes_out}
+
+    def new_id(self):
+        self.next_id += 1
+        return f"{self.next_id:016x}"
+
+    # Histories and jobs
+
+    def create_history(self, name):
+        history = {"id": self.new_id(), "name": name, "hid_counter": 1}
+        self.histories[history["id"]] = history
+        # Unrelated items the listing and index code have to page past
+        now = time.time()
+        for i in range(self.history_size):
+            job = self.create_job(history, "noise", {}, now, duration=0, failed=False)
+            self.add_output(history, job, f"Unrelated dataset {i}", "txt", b"x\n")
+        return history
+
+    def create_job(self, history, tool_id, params, now, duration=None, failed=None):
+        if duration is None:
+            duration = self.random.uniform(*self.job_seconds)
+        if failed is None:
+            failed = self.random.random() < self.failure_rate
+        job = {"id": self.new_id(), "tool_id": tool_id, "history_id": history["id"],
+               "params": {k: json.dumps(v) for k, v in params.items()},
+               "created": now, "started": now + duration * 0.1, "finished": now + duration,
+               "failed": failed, "outputs": {}}
+        self.jobs[job["id"]] = job
+        return job
+
+    def add_output(self, history, job, name, extension, content, output_name="output"):
+        dataset = {"id": self.new_id(), "hid": history["hid_counter"], "name": name,
+                   "extension": extension, "history_id": history["id"], "job": job["id"],
+                   "content": content, "deleted": False, "visible": True}
+        history["hid_counter"] += 1
+        self.datasets[dataset["id"]] = dataset
+        job["outputs"][output_name] = {"id": dataset["id"], "src": "hda"}
+        return dataset
+
+    def job_state(self, job, now):
+        # (state, time of the last state change)
+        if now < job["started"]:
+            return "queued", job["created"]
+        if now < job["finished"]:
+            return "running", job["started"]
+        return ("error" if job["failed"] else "ok"), job["finished"]
+
+    def describe(self, dataset, now):
+        job = self.jobs[dataset["job"]]
+        state, changed = self.job_state(job, now)
+        done = state in ("ok", "error")
+        return {
+            "id": dataset["id"], "hid": dataset["hid"], "name": dataset["name"],
+            "state": state, "extension": dataset["extension"],
+            "file_size": len(dataset["content"]) if done else 0,
+            "hashes": [], "history_content_type": "dataset", "creating_job": job["id"],
+            "history_id": dataset["history_id"], "update_time": timestamp(changed),
+            "deleted": dataset["deleted"], "visible": dataset["visible"],
+        }
+
+    def show_job(self, job, now):
+        state, changed = self.job_state(job, now)
+        shown = {"id": job["id"], "tool_id": job["tool_id"], "state": state,
+                 "history_id": job["history_id"], "params": job["params"],
+                 "outputs": job["outputs"], "create_time": timestamp(job["created"]),
+                 "update_time": timestamp(changed), "job_metrics": []}
+        if state in ("ok", "error"):
+            # What Galaxy's core job metrics plugin reports for a finished job
+            metrics = {"galaxy_slots": "4", "galaxy_memory_mb": "15360",
+                       "start_epoch": f"{job['started']:.7f}", "end_epoch": f"{job['finished']:.7f}",
+                       "runtime_seconds": f"{job['finished'] - job['started']:.7f}"}
+            shown["job_metrics"] = [{"plugin": "core", "name": name, "raw_value": value}
+                                    for name, value in metrics.items()]
+        return shown
+
+    # Tools
+
+    def hid(self, dataset_id):
+        return self.datasets[dataset_id]["hid"]
+
+    def translated_content(self, seed):
+        rng = random.Random(seed)
+        lines = []
+        for i in range(self.output_lines):
+            taxon = rng.randrange(DB_TAXA)
+            lines.append(f"k141_{i}\troot|cellular organisms|Bacteria|Phylum{taxon % 20}|Genus{taxon}\n")
+        return "".join(lines).encode()
+
+    def run_tool(self, payload, now):
+        history = self.histories[payload["history_id"]]
+        inputs = payload.get("inputs") or {}
+        if isinstance(inputs, str):
+            inputs = json.loads(inputs)
+        batch = [key for key, value in inputs.items() if isinstance(value, dict) and value.get("batch")]
+        if batch:
+            return self.map_over(history, payload, inputs, batch[0], now)
+        job = self.run_job(history, payload, inputs, now)
+        outputs = [self.describe(self.datasets[o["id"]], now) for o in job["outputs"].values()]
+        return {"outputs": outputs, "jobs": [self.show_job(job, now)],
+                "output_collections": [], "implicit_collections": []}
+
+    def map_over(self, history, payload, inputs, key, now):
+        # One job per element of the batch collection; each output name
+        # gathers its element datasets into a new list collection
+        source = self.collections[inputs[key]["values"][0]["id"]]
+        jobs, gathered = [], {}
+        for identifier, element in source["elements"]:
+            element_inputs = dict(inputs)
+            del element_inputs[key]
+            if isinstance(element, dict):
+                # paired element given to MEGAHIT's paired_collection input
+                element_inputs["input_option|fastq_input1"] = {"src": "hda", "id": element["forward"]}
+                element_inputs["input_option|fastq_input2"] = {"src": "hda", "id": element["reverse"]}
+            else:
+                element_inputs[key] = {"src": "hda", "id": element}
+            job = self.run_job(history, payload, element_inputs, now)
+            jobs.append(job)
+            for output_name, output in job["outputs"].items():
+                self.datasets[output["id"]]["visible"] = False
+                gathered.setdefault(output_name, []).append((identifier, output["id"]))
+        implicit = []
+        for output_name, elements in gathered.items():
+            name = re.sub(r"data \d+( and data \d+)?", f"collection {source['hid']}",
+                          self.datasets[elements[0][1]]["name"])
+            collection = self.add_collection(history, name, "list", elements)
+            implicit.append(dict(self.show_collection(collection, now), output_name=output_name))
+        return {"outputs": [], "jobs": [self.show_job(job, now) for job in jobs],
+                "output_collections": [], "implicit_collections": implicit}
+
+    def add_collection(self, history, name, collection_type, elements):
+        collection = {"id": self.new_id(), "hid": history["hid_counter"], "name": name,
+                      "collection_type": collection_type, "history_id": history["id"], "elements": elements}
+        history["hid_counter"] += 1
+        self.collections[collection["id"]] = collection
+        return collection
+
+    def create_collection(self, history, payload):
+        # list:paired from nested new_collection elements, or a flat list
+        elements = []
+        for element in payload["element_identifiers"]:
+            if element.get("src") == "new_collection":
+                elements.append((element["name"], {e["name"]: e["id"] for e in element["element_identifiers"]}))
+            else:
+                elements.append((element["name"], element["id"]))
+        return self.add_collection(history, payload["name"], payload["collection_type"], elements)
+
+    def show_collection(self, collection, now):
+        datasets = []
+        for _, element in collection["elements"]:
+            datasets += list(element.values()) if isinstance(element, dict) else [element]
+        summary = Counter(self.job_state(self.jobs[self.datasets[d]["job"]], now)[0] for d in datasets)
+        summary["all_jobs"] = len(datasets)
+        return {"id": collection["id"], "hid": collection["hid"], "name": collection["name"],
+                "collection_type": collection["collection_type"], "history_content_type": "dataset_collection",
+                "populated_state": "ok", "job_state_summary": dict(summary),
+                "element_count": len(collection["elements"]),
+                "elements": [{"element_identifier": identifier, "object": {"id": element}}
+                             for identifier, element in collection["elements"]]}
+
+    def run_job(self, history, payload, inputs, now):
+        tool_id = payload["tool_id"]
+
+        def input_id(key):
+            value = inputs[key]
+            if isinstance(value, list):
+                value = value[0]
+            return value["id"]
+
+        if tool_id == "upload1":
+            path = payload["files_0|ftp_files"]
+            job = self.create_job(history, tool_id, {}, now)
+            ext = "fastqsanger.gz" if path.endswith(".gz") else "auto"
+            self.add_output(history, job, path, ext, b"@r\nACGT\n+\nIIII\n")
+        elif "/megahit/" in tool_id:
+            fwd, rev = input_id("input_option|fastq_input1"), input_id("input_option|fastq_input2")
+            job = self.create_job(history, tool_id, {"input_option": {"choice": "paired"}}, now)
+            self.add_output(history, job, f"MEGAHIT on data {self.hid(rev)} and data {self.hid(fwd)}: Contigs",
+                            "fasta", b">k141_0\nACGT\n")
+        elif "/quast/" in tool_id:
+            contigs = input_id("mode|in|inputs")
+            job = self.create_job(history, tool_id, {}, now)
+            on = f"data {self.hid(contigs)}"
+            self.add_output(history, job, f"Quast on {on}: HTML report", "html", b"<html></html>\n", "report_html")
+            self.add_output(history, job, f"Quast on {on}: tabular report", "tabular",
+                            b"Assembly\tcontigs\n# contigs (>= 0 bp)\t12\n# contigs\t10\nLargest contig\t4000\n"
+                            b"Total length\t15000\nN50\t1000\n", "report_tabular")
+        elif "/kraken/" in tool_id:
+            contigs = input_id("single_paired|input_sequences")
+            job = self.create_job(history, tool_id, {"kraken_database": inputs["kraken_database"]}, now)
+            self.add_output(history, job, f"Kraken on data {self.hid(contigs)}: Classification", "tabular",
+                            b"C\tk141_0\t10239\n")
+        elif "/kraken_translate/" in tool_id:
+            classification = input_id("input")
+            job = self.create_job(history, tool_id, {"kraken_database": inputs["kraken_database"]}, now)
+            self.add_output(history, job, f"Kraken-translate on data {self.hid(classification)}", "tabular",
+                            self.translated_content(classification))
+        elif "/datamash_operations/" in tool_id:
+            table = input_id("in_file")
+            job = self.create_job(history, tool_id, {}, now)
+            counts = Counter(line.split(b"\t")[1] for line in self.datasets[table]["content"].splitlines())
+            self.add_output(history, job, f"Datamash on data {self.hid(table)}", "tabular",
+                            b"".join(b"%s\t%d\n" % (lineage, n) for lineage, n in sorted(counts.items())), "out_file")
+        else:
+            raise KeyError(f"tool not available on the mock server: {tool_id}")
+        return job
+
+    def list_datasets(self, query, now):
+        items = [self.describe(d, now) for d in self.datasets.values()
+                 if "history_id" not in query or d["history_id"] == query["history_id"][0]]
+        for q, qv in zip(query.get("q", []), query.get("qv", [])):
+            field, op = q.rsplit("-", 1)
+            if op == "ge":
+                items = [i for i in items if i[field] >= qv]
+            elif op == "le":
+                items = [i for i in items if i[field] <= qv]
+            elif op == "eq":
+                items = [i for i in items if str(i[field]) == qv]
+        order = query.get("order", ["create_time-dsc"])[0]
+        field, direction = order.rsplit("-", 1)
+        field = "hid" if field == "create_time" else field
+        items.sort(key=lambda i: i[field], reverse=direction == "dsc")
+        offset = int(query.get("offset", [0])[0])
+        limit = int(query.get("limit", [len(items)])[0])
+        items = items[offset:offset + limit]
+        if "keys" in query:
+            keys = query["keys"][0].split(",")
+            items = [{k: i[k] for k in keys if k in i} for i in items]
+        return items
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in one segment; otherwise delayed ACKs add
+    # ~40 ms to every call and swamp what is being measured
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, status, body, content_type="application/json", headers=None):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.galaxy.bytes_out += len(body)
+
+    def route(self, method):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        galaxy = self.server.galaxy
+        path = url.path.rstrip("/")
+        template = re.sub(r"/[0-9a-f]{16}(?=/|$)", "/{id}", path)
+
+        with galaxy.lock:
+            if not path.startswith("/_mock"):
+                galaxy.calls[f"{method} {template}"] += 1
+                galaxy.bytes_in += len(raw)
+            try:
+                return self.dispatch(galaxy, method, path, query, raw, time.time())
+            except KeyError as e:
+                return self.send(404, {"err_msg": f"not found: {e}"})
+
+    def dispatch(self, galaxy, method, path, query, raw, now):
+        payload = json.loads(raw) if raw else {}
+        parts = path.split("/")[1:]
+
+        if path == "/_mock/stats":
+            stats = galaxy.stats()
+            if "reset" in query:
+                galaxy.reset_stats()
+            return self.send(200, stats)
+        if path in ("/api/version", "/api/configuration"):
+            return self.send(200, {"version_major": "24.1", "version_minor": "mock"})
+        if path == "/api/histories":
+            if method == "POST":
+                history = galaxy.create_history(payload.get("name", "Unnamed history"))
+                return self.send(200, {"id": history["id"], "name": history["name"]})
+            return self.send(200, [{"id": h["id"], "name": h["name"]} for h in galaxy.histories.values()])
+        if parts[:2] == ["api", "histories"] and len(parts) == 3 and method == "GET":
+            if parts[2] not in galaxy.histories:
+                return self.send(404, {"err_msg": "History not found"})
+            history = galaxy.histories[parts[2]]
+            return self.send(200, {"id": history["id"], "name": history["name"], "deleted": False, "purged": False})
+        if parts[:2] == ["api", "histories"] and len(parts) == 4 and parts[3] == "contents" and method == "POST":
+            collection = galaxy.create_collection(galaxy.histories[parts[2]], payload)
+            return self.send(200, galaxy.show_collection(collection, now))
+        if parts[:2] == ["api", "histories"] and parts[3:5] == ["contents", "dataset_collections"]:
+            return self.send(200, galaxy.show_collection(galaxy.collections[parts[5]], now))
+        if parts[:2] == ["api", "histories"] and len(parts) == 4 and parts[3] == "contents":
+            query["history_id"] = [parts[2]]
+            query.setdefault("order", ["hid-asc"])
+            return self.send(200, galaxy.list_datasets(query, now))
+        if path == "/api/datasets":
+            return self.send(200, galaxy.list_datasets(query, now))
+        if parts[:2] == ["api", "datasets"] and len(parts) == 3:
+            return self.send(200, galaxy.describe(galaxy.datasets[parts[2]], now))
+        if parts[:2] == ["api", "datasets"] and len(parts) == 4 and parts[3] == "display":
+            return self.display(galaxy.datasets[parts[2]])
+        if path == "/api/tools" and method == "POST":
+            return self.send(200, galaxy.run_tool(payload, now))
+        if parts[:2] == ["api", "jobs"] and len(parts) == 3:
+            return self.send(200, galaxy.show_job(galaxy.jobs[parts[2]], now))
+        return self.send(404, {"err_msg": f"no mock for {method} {path}"})
+
+    def display(self, dataset):
+        content = dataset["content"]
+        match = re.match(r"bytes=(\d+)-$", self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            if start >= len(content):
+                return self.send(416, b"", "text/plain", {"Content-Range": f"bytes */{len(content)}"})
+            return self.send(206, content[start:], "application/octet-stream",
+                             {"Content-Range": f"bytes {start}-{len(content) - 1}/{len(content)}"})
+        return self.send(200, content, "application/octet-stream")
+
+    def do_GET(self):
+        self.route("GET")
+
+    def do_POST(self):
+        self.route("POST")
+
+    def do_PUT(self):
+        self.route("PUT")
+
+    def do_DELETE(self):
+        self.route("DELETE")
+
+def serve(galaxy, port=0):
+    # Start the server on a background thread; returns (server, base url)
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    server.galaxy = galaxy
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+def add_arguments(parser):
+    parser.add_argument("--job-seconds", type=float, nargs=2, default=[0.5, 2.0], metavar=("MIN", "MAX"),
+                        help="range of simulated job durations")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="fraction of jobs that end in error")
+    parser.add_argument("--history-size", type=int, default=0,
+                        help="unrelated datasets placed in every new history")
+    parser.add_argument("--output-lines", type=int, default=1000,
+                        help="lines in each Kraken-translate output")
+    parser.add_argument("--seed", type=int, default=1)
+
+def from_arguments(args):
+    return MockGalaxy(tuple(args.job_seconds), args.failure_rate, args.history_size, args.output_lines, args.seed)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a mock Galaxy API server.")
+    parser.add_argument("--port", type=int, default=8080)
+    add_arguments(parser)
+    args = parser.parse_args()
+    server, url = serve(from_arguments(args), args.port)
+    print(f"Mock Galaxy listening on {url} (GALAXY_URL={url})", flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import urllib.request
+from datetime import datetime
+from mock_galaxy import add_arguments, from_arguments, serve
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = "../outputs/benchmark"
+RESULTS_FILE = "../outputs/benchmark/benchmark.tsv"
+LOG_FILE = "../outputs/benchmark/benchmark.log"
+SAMPLE_COUNTS = [10, 100, 1000]
+
+# Galaxy stages in Makefile order, with the answer to any prompt they ask
+STAGES = [
+    ("upload_to_galaxy", "upload_to_galaxy.py", ""),
+    ("assemble", "assembly.py", ""),
+    ("assembly_qc", "assembly_qc.py", ""),
+    ("download_assembly_qc", "download_assembly_qc.py", ""),
+    ("taxonomy_one", "taxonomy_step_one.py", "V\n"),
+    ("taxonomy_translate", "taxonomy_translate.py", ""),
+    ("download_taxonomy", "download_taxonomy.py", ""),
+    ("job_metrics_report", "job_metrics_report.py", ""),
+]
+
+# The same chain submitted as map-over jobs on a list:paired collection
+COLLECTION_STAGES = [
+    ("upload_to_galaxy", "upload_to_galaxy.py", ""),
+    ("process_collections", "galaxy_collections.py", "V\n"),
+    ("download_taxonomy", "download_taxonomy.py", ""),
+]
+
+def log(message):
+    timestamp = datetime.now().strftime("[%Y-%m-%d %H:%M:%S]")
+    with open(LOG_FILE, "a") as logfile:
+        logfile.write(f"{timestamp} {message}\n")
+    print(f"{timestamp} {message}", flush=True)
+
+def get_stats(url, reset=False):
+    with urllib.request.urlopen(f"{url}/_mock/stats{'?reset=1' if reset else ''}") as response:
+        return json.load(response)
+
+def make_sandbox(root, samples):
+    # Same layout the scripts expect around their working directory:
+    # galaxy/ and download/ inside it, ../outputs next to it
+    work = os.path.join(root, "work")
+    os.makedirs(os.path.join(work, "galaxy"))
+    os.makedirs(os.path.join(work, "download"))
+    with open(os.path.join(work, "galaxy", "key.txt"), "w") as f:
+        f.write("mock-api-key\n")
+    with open(os.path.join(work, "download", "accession.txt"), "w") as f:
+        f.write(f"BENCH{samples}\n")
+    trimmed = os.path.join(root, "outputs", "fastq_trimmed")
+    os.makedirs(trimmed)
+    os.makedirs(os.path.join(root, "outputs", "galaxy"))
+    for i in range(samples):
+        for read in (1, 2):
+            open(os.path.join(trimmed, f"SRR{i:07d}_{read}.fastq.gz"), "w").close()
+    return work
+
+def check_samples(root):
+    # Collection runs must still tie every downloaded file to its sample
+    translated = os.path.join(root, "outputs", "taxonomy", "translated_kraken")
+    for db in sorted(os.listdir(translated)) if os.path.isdir(translated) else []:
+        path = os.path.join(translated, db, "samples.tsv")
+        if not os.path.exists(path) or not os.path.getsize(path):
+            log(f"  CHECK FAILED: {path} is missing or empty")
+            failed_checks.append(path)
+
+def run_pipeline(samples, args):
+    galaxy = from_arguments(args)
+    server, url = serve(galaxy)
+    root = tempfile.mkdtemp(prefix=f"galaxy_bench_{samples}_")
+    work = make_sandbox(root, samples)
+    env = dict(os.environ, GALAXY_URL=url, GALAXY_POLL_INTERVAL=str(args.poll_interval))
+    rows = []
+    try:
+        for stage, script, answer in (COLLECTION_STAGES if args.collections else STAGES):
+            get_stats(url, reset=True)
+            start = time.time()
+            with open(os.path.join(root, f"{stage}.out"), "w") as out:
+                result = subprocess.run([sys.executable, os.path.join(REPO_DIR, script)], cwd=work, env=env,
+                                        input=answer, text=True, stdout=out, stderr=subprocess.STDOUT)
+            wall = time.time() - start
+            stats = get_stats(url)
+            rows.append({"samples": samples, "stage": stage, "exit": result.returncode, "wall_s": wall,
+                         "http_calls": stats["total_calls"], "bytes_in": stats["bytes_in"],
+                         "bytes_out": stats["bytes_out"], "calls": stats["calls"]})
+            log(f"{samples} samples, {stage}: exit {result.returncode}, {wall:.1f}s, "
+                f"{stats['total_calls']} HTTP calls, {stats['bytes_in'] + stats['bytes_out']} bytes")
+            if result.returncode != 0:
+                log(f"  see {os.path.join(root, stage + '.out')}")
+        if args.collections:
+            check_samples(root)
+    finally:
+        server.shutdown()
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+    return rows
+
+def write_results(rows):
+    with open(RESULTS_FILE, "w") as f:
+        f.write("samples\tstage\texit\twall_s\thttp_calls\tbytes_in\tbytes_out\tcalls_by_route\n")
+        for r in rows:
+            routes = ";".join(f"{route}={n}" for route, n in sorted(r["calls"].items()))
+            f.write(f"{r['samples']}\t{r['stage']}\t{r['exit']}\t{r['wall_s']:.2f}\t{r['http_calls']}\t"
+                    f"{r['bytes_in']}\t{r['bytes_out']}\t{routes}\n")
+
+def print_summary(rows):
+    print(f"\n{'samples':>8} {'stage':<20} {'exit':>4} {'wall s':>9} {'HTTP calls':>11} {'MB moved':>9}")
+    for r in rows:
+        moved = (r["bytes_in"] + r["bytes_out"]) / 1e6
+        print(f"{r['samples']:>8} {r['stage']:<20} {r['exit']:>4} {r['wall_s']:>9.1f} {r['http_calls']:>11} {moved:>9.2f}")
+
+parser = argparse.ArgumentParser(description="Run the Galaxy stages against a mock Galaxy server and "
+                                             "report wall time, HTTP calls and bytes per stage.")
+parser.add_argument("--samples", type=int, nargs="+", default=SAMPLE_COUNTS)
+parser.add_argument("--poll-interval", type=float, default=0.5, help="GALAXY_POLL_INTERVAL for the scripts")
+parser.add_argument("--collections", action="store_true",
+                    help="benchmark collection map-over submission instead of per-sample stages")
+parser.add_argument("--keep", action="store_true", help="keep the sandbox directories and stage output")
+add_arguments(parser)
+args = parser.parse_args()
+
+os.makedirs(RESULTS_DIR, exist_ok=True)
+all_rows = []
+failed_checks = []
+for n in args.samples:
+    log(f"=== Benchmark: {n} samples ===")
+    all_rows += run_pipeline(n, args)
+    write_results(all_rows)
+print_summary(all_rows)
+log(f"Results written to {RESULTS_FILE}")
+if failed_checks:
+    exit(1)
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import argparse
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+PROJECT_FILE = "accession.txt"
+SRA_ACCESSION_FILE = "sra_accessions.txt"
+DOWNLOAD_DIR = "../../inputs"
+LOG_FILE = "download.log"
+PREFETCH_JOBS = 4
+CONVERT_JOBS = 2
+THREADS = 4
+
+# Tool commands, overridable so stub binaries can stand in for sra-tools
+PREFETCH = os.environ.get("PREFETCH", "prefetch")
+FASTERQ_DUMP = os.environ.get("FASTERQ_DUMP", "fasterq-dump")
+PIGZ = os.environ.get("PIGZ", "pigz")
+
+_log_lock = threading.Lock()
+
+def log(message):
+    timestamp = datetime.now().strftime("[%Y-%m-%d %H:%M:%S]")
+    with _log_lock:
+        with open(LOG_FILE, "a") as logfile:
+            logfile.write(f"{timestamp} {message}\n")
+        print(f"{timestamp} {message}", flush=True)
+
+def run(cmd):
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    if result.returncode != 0:
+        tail = (result.stdout + result.stderr).strip().splitlines()[-5:]
+        raise RuntimeError(f"{' '.join(cmd)} exited with {result.returncode}: {' | '.join(tail)}")
+
+def fetch_accession_list():
+    with open(PROJECT_FILE) as f:
+        project_id = f.read().strip()
+    log(f"Project ID: {project_id}")
+
+    if os.path.exists(SRA_ACCESSION_FILE) and os.path.getsize(SRA_ACCESSION_FILE) > 0:
+        log("SRA accession list exists.")
+    else:
+        log(f"Fetching SRA accession list for project: {project_id}")
+        subprocess.run(
+            f"esearch -db sra -query '{project_id}' | efetch -format runinfo "
+            f"| cut -d ',' -f1 | tail -n +2 > '{SRA_ACCESSION_FILE}'",
+            shell=True)
+        if not os.path.exists(SRA_ACCESSION_FILE) or os.path.getsize(SRA_ACCESSION_FILE) == 0:
+            log("No accessions found.")
+            exit(1)
+        log(f"SRA accessions saved to {SRA_ACCESSION_FILE}")
+
+    with open(SRA_ACCESSION_FILE) as f:
+        return [line.strip() for line in f if line.strip()]
+
+# Per-accession files. The .dumped marker is written only after fasterq-dump
+# succeeds, so uncompressed FASTQ without it is an interrupted conversion.
+def sra_dir(accession):
+    return os.path.join(DOWNLOAD_DIR, accession)
+
+def dumped_marker(accession):
+    return os.path.join(DOWNLOAD_DIR, f"{accession}.dumped")
+
+def fastq_files(accession):
+    names = [f"{accession}.fastq", f"{accession}_1.fastq", f"{accession}_2.fastq"]
+    return [p for p in (os.path.join(DOWNLOAD_DIR, n) for n in names) if os.path.exists(p)]
+
+def has_output(accession):
+    # Both mates of a paired run, or the one file of a single-end run
+    paired = [os.path.join(DOWNLOAD_DIR, f"{accession}_{n}.fastq.gz") for n in (1, 2)]
+    return (all(os.path.exists(f) for f in paired)
+            or os.path.exists(os.path.join(DOWNLOAD_DIR, f"{accession}.fastq.gz")))
+
+def is_complete(accession):
+    return (has_output(accession)
+            and not fastq_files(accession)
+            and not os.path.exists(dumped_marker(accession)))
+
+def cleanup(accession):
+    shutil.rmtree(sra_dir(accession), ignore_errors=True)
+    if os.path.exists(dumped_marker(accession)):
+        os.remove(dumped_marker(accession))
+
+def prefetch(accession):
+    # prefetch resumes a partial .sra on its own and is a no-op when complete
+    log(f"Prefetching {accession}...")
+    run([PREFETCH, accession, "--output-directory", DOWNLOAD_DIR])
+    log(f"Prefetched {accession}")
+
+def convert(accession):
+    if os.path.exists(dumped_marker(accession)) and not fastq_files(accession) \
+            and not has_output(accession):
+        # The dump is gone without its compressed output; dump again
+        os.remove(dumped_marker(accession))
+    if not os.path.exists(dumped_marker(accession)):
+        log(f"Converting {accession} to FASTQ...")
+        sra_file = os.path.join(sra_dir(accession), f"{accession}.sra")
+        source = sra_file if os.path.exists(sra_file) else accession
+        run([FASTERQ_DUMP, "--split-files", "--force", "--threads", str(THREADS),
+                        "-O", DOWNLOAD_DIR, source])
+        open(dumped_marker(accession), "w").close()
+
+    # pigz -f replaces any .gz left behind by an interrupted compression.
+    # With no .fastq left, compression finished before the marker was
+    # removed (pigz given no files would wait on stdin)
+    if fastq_files(accession):
+        log(f"Compressing {accession}...")
+        run([PIGZ, "-f", "-p", str(THREADS)] + fastq_files(accession))
+    cleanup(accession)
+    log(f"Completed {accession}")
+
+def main():
+    global PREFETCH_JOBS, CONVERT_JOBS, THREADS
+    parser = argparse.ArgumentParser(description="Download SRA runs as gzipped FASTQ.")
+    parser.add_argument("--prefetch-jobs", type=int, default=PREFETCH_JOBS,
+                        help="concurrent prefetch transfers")
+    parser.add_argument("--convert-jobs", type=int, default=CONVERT_JOBS,
+                        help="concurrent fasterq-dump/pigz conversions")
+    parser.add_argument("--threads", type=int, default=THREADS,
+                        help="threads per fasterq-dump and pigz call")
+    parser.add_argument("--list-only", action="store_true",
+                        help="only write the SRA accession list (for make fused_trim)")
+    args = parser.parse_args()
+    PREFETCH_JOBS, CONVERT_JOBS, THREADS = args.prefetch_jobs, args.convert_jobs, args.threads
+
+    log(f"=== {datetime.now()} ===")
+    accessions = fetch_accession_list()
+    if args.list_only:
+        log(f"{len(accessions)} accession(s) listed in {SRA_ACCESSION_FILE}")
+        return
+    os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+    log(f"Starting downloads into {DOWNLOAD_DIR}...")
+
+    pending = []
+    for accession in accessions:
+        if is_complete(accession):
+            log(f"Files for {accession} already exist. Skipping download.")
+            cleanup(accession)
+        else:
+            pending.append(accession)
+
+    # Transfers and conversions run in separate pools, so finished
+    # accessions are converted while others are still downloading.
+    failed = []
+    conversions = []
+    with ThreadPoolExecutor(PREFETCH_JOBS) as transfers, ThreadPoolExecutor(CONVERT_JOBS) as converters:
+        def fetch_then_queue(accession):
+            if not os.path.exists(dumped_marker(accession)):
+                prefetch(accession)
+            conversions.append((accession, converters.submit(convert, accession)))
+
+        fetches = [(acc, transfers.submit(fetch_then_queue, acc)) for acc in pending]
+        for accession, future in fetches:
+            try:
+                future.result()
+            except Exception as e:
+                log(f"ERROR: {accession}: {e}")
+                failed.append(accession)
+    for accession, future in conversions:
+        try:
+            future.result()
+        except Exception as e:
+            log(f"ERROR: {accession}: {e}")
+            failed.append(accession)
+
+    if failed:
+        log(f"ERROR: {len(failed)} accession(s) failed: {sorted(failed)}")
+        exit(1)
+
+    log(f"Download complete! Files saved in {DOWNLOAD_DIR}")
+    log(f"=== {datetime.now()} ===")
+
+if __name__ == "__main__":
+    main()
@@ -1,65 +1,120 @@
 #!/usr/bin/env python3
 
 import os
-import zipfile
-from datetime import datetime
-from bioblend.galaxy import GalaxyInstance
+import re
+from galaxy_session import connect, HistoryIndex
+from galaxy_download import download_datasets
+from galaxy_tools import dataset_samples
+from stage_manifest import StageManifest
+from pipeline_events import stage_logger
 
-API_KEY_FILE = "galaxy/key.txt"
-ACCESSION_FILE = "download/accession.txt"
-GALAXY_URL = "https://usegalaxy.eu"
 DOWNLOAD_DIR = "../outputs/galaxy/quast_downloads"
+SUMMARY_FILE = "../outputs/galaxy/quast_summary.tsv"
 LOG_FILE = "../outputs/galaxy/quast_download.log"
+# Only QUAST's tabular report is needed; the HTML, PDF and icarus outputs
+# are for browsing in Galaxy
+REPORT_NAME = "tabular report"
+# QUAST report row -> summary column
+METRICS = {"N50": "n50", "Total length": "total_length", "# contigs": "contigs", "Largest contig": "largest_contig"}
+COLUMNS = ["sample", "dataset"] + list(METRICS.values())
 
-def log(message):
-    timestamp = datetime.now().strftime("[%Y-%m-%d %H:%M:%S]")
-    with open(LOG_FILE, "a") as logfile:
-        logfile.write(f"{timestamp} {message}\n")
-    print(f"{timestamp} {message}")
+log = stage_logger("download_assembly_qc", LOG_FILE)
 
-if not os.path.exists(API_KEY_FILE) or not os.path.exists(ACCESSION_FILE):
-    log("ERROR: Missing API key or accession file.")
-    exit(1)
+class QuastReport:
+    # Picks the summary metrics out of a QUAST report.tsv while it is being
+    # downloaded, one complete line at a time. Handles both the default
+    # layout (one metric per row) and transposed_report.tsv (one header row).
+    def __init__(self):
+        self.partial = b""
+        self.header = None
+        self.values = {}
 
-with open(API_KEY_FILE, "r") as key_file:
-    api_key = key_file.read().strip()
-with open(ACCESSION_FILE, "r") as accession_file:
-    history_name = accession_file.read().strip()
+    def __call__(self, chunk):
+        lines = (self.partial + chunk).split(b"\n")
+        self.partial = lines.pop()
+        for line in lines:
+            self.line(line.decode(errors="replace").rstrip("\r"))
 
-gi = GalaxyInstance(GALAXY_URL, api_key)
+    def line(self, text):
+        fields = text.split("\t")
+        if self.header is None and fields[0] == "Assembly" and "N50" in fields:
+            self.header = fields
+        elif self.header is not None:
+            row = dict(zip(self.header, fields))
+            self.values = {column: row[metric] for metric, column in METRICS.items() if metric in row}
+        elif len(fields) > 1 and fields[0] in METRICS:
+            self.values[METRICS[fields[0]]] = fields[1]
 
-# Retrieve the specified history
-histories = gi.histories.get_histories(name=history_name)
-if not histories:
-    log(f"ERROR: History '{history_name}' not found.")
-    exit(1)
-history_id = histories[0]["id"]
-log(f"Using history '{history_name}' (ID: {history_id})")
-
-history_contents = gi.histories.show_history(history_id, contents=True)
-quast_outputs = {
-    item["name"]: item["id"]
-    for item in history_contents
-    if item["history_content_type"] == "dataset" and "Quast" in item["name"]
-}
-
-if not quast_outputs:
-    log("ERROR: No QUAST outputs found.")
+    def metrics(self):
+        if self.partial:
+            self.line(self.partial.decode(errors="replace").rstrip("\r"))
+            self.partial = b""
+        return self.values
+
+def read_summary():
+    # {dataset id: row} of the previous run
+    if not os.path.exists(SUMMARY_FILE):
+        return {}
+    with open(SUMMARY_FILE) as f:
+        header = f.readline().rstrip("\n").split("\t")
+        rows = [dict(zip(header, line.rstrip("\n").split("\t"))) for line in f if line.strip()]
+    return {row["dataset"]: row for row in rows if row.get("dataset")}
+
+gi, history_id, history_name = connect(log)
+index = HistoryIndex(gi, history_id)
+index.sync()
+
+quast_reports = [item for item in index.find(name_contains="Quast")
+                 if REPORT_NAME in item["name"] and item["extension"] == "tabular"]
+
+if not quast_reports:
+    log("ERROR: No QUAST tabular reports found.")
     exit(1)
 
-log(f"Found QUAST outputs: {list(quast_outputs.keys())}")
-os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+log(f"Found {len(quast_reports)} QUAST tabular report(s).")
 
-downloaded_files = []
-for name, dataset_id in quast_outputs.items():
-    filename = os.path.join(DOWNLOAD_DIR, dataset_id)
-    log(f"Attempting to download dataset '{name}' (ID: {dataset_id}) to '{filename}'...")
-    try:
-        gi.datasets.download_dataset(dataset_id, file_path=filename, use_default_filename=False)
-        log(f"Successfully downloaded dataset ID '{dataset_id}'")
-        downloaded_files.append((filename, dataset_id))
-    except Exception as e:
-        log(f"ERROR downloading dataset ID '{dataset_id}': {e}")
+ready = []
+for item in quast_reports:
+    if item["state"] != "ok":
+        log(f"Skipping '{item['name']}' (ID: {item['id']}): dataset in state '{item['state']}'")
+        continue
+    ready.append(item)
 
-log("Download script completed.")
+# Reports are saved per sample, as make local_pipeline does; datasets the
+# stage manifest cannot trace back to a sample keep their own name
+sample_of = dataset_samples(index, StageManifest())
+def sample(item):
+    return sample_of.get(item["id"]) or re.sub(r"[^\w\-.]", "_", item["name"])
+
+# A dataset id never changes content, so summarised reports are not fetched again
+summary = read_summary()
+new = [item for item in ready if item["id"] not in summary]
+log(f"{len(ready) - len(new)} report(s) already in {SUMMARY_FILE}; "
+    f"downloading {len(new)} to '{DOWNLOAD_DIR}'...")
+reports = {item["id"]: QuastReport() for item in new}
+downloaded = download_datasets(gi, new, lambda item: os.path.join(DOWNLOAD_DIR, sample(item), "report.tsv"), log,
+                               reader_for=lambda item: reports[item["id"]])
+for item in new:
+    if item["id"] in downloaded:
+        summary[item["id"]] = {"sample": sample(item), "dataset": item["id"], **reports[item["id"]].metrics()}
 
+# One row per sample, from its newest QUAST run; reports no longer in the
+# history drop out
+rows = {}
+for item in ready:
+    if item["id"] in summary:
+        row = summary[item["id"]]
+        row["sample"] = sample(item)
+        rows[row["sample"]] = row
+os.makedirs(os.path.dirname(SUMMARY_FILE), exist_ok=True)
+with open(f"{SUMMARY_FILE}.tmp", "w") as f:
+    f.write("\t".join(COLUMNS) + "\n")
+    for name in sorted(rows):
+        f.write("\t".join(str(rows[name].get(column, "")) for column in COLUMNS) + "\n")
+os.replace(f"{SUMMARY_FILE}.tmp", SUMMARY_FILE)
+
+missing = [name for name, row in rows.items() if not all(row.get(column) for column in METRICS.values())]
+if missing:
+    log(f"WARNING: {len(missing)} report(s) lack some of {', '.join(METRICS)}: {sorted(missing)}")
+log(f"Assembly metrics of {len(rows)} sample(s) written to {SUMMARY_FILE}")
+log("Download script completed.")
@@ -1,69 +1,43 @@
 #!/usr/bin/env python3
 import os
+import gzip
 import time
-from datetime import datetime
-from bioblend.galaxy import GalaxyInstance
+import argparse
+from galaxy_session import connect, HistoryIndex
+from galaxy_jobs import JobCache
+from galaxy_download import default_filename, download_datasets
+from galaxy_polling import wait_for_datasets
+from galaxy_tools import dataset_samples, lineage_counts_request, signature, submit
+from stage_manifest import StageManifest
+from taxonomy_final import COUNTS_SUFFIX, TaxonCounter, write_count_table
+from pipeline_events import stage_logger
 
-API_KEY_FILE = "galaxy/key.txt"
-ACCESSION_FILE = "download/accession.txt"
-GALAXY_URL = "https://usegalaxy.eu"
 OUTPUT_DIR = "../outputs/taxonomy/translated_kraken"
+SAMPLES_FILE = "samples.tsv"  # file name -> read sample, per database directory
 LOG_FILE = "../outputs/galaxy/kraken_translate_download.log"
-
-def log(message):
-    timestamp = datetime.now().strftime("[%Y-%m-%d %H:%M:%S]")
-    with open(LOG_FILE, "a") as logfile:
-        logfile.write(f"{timestamp} {message}\n")
-    print(f"{timestamp} {message}")
-
-def find_kraken_database(dataset_info):
-    job_id = dataset_info.get('creating_job')
-    if job_id:
-        job_info = gi.jobs.show_job(job_id)
-        log(f"Job info: {job_info}")
-        
-        job_params = job_info.get('params', {})
-        log(f"Job params: {job_params}")
-        
-        kraken_db = job_params.get('kraken_database')
-        if kraken_db:
-            # Remove spaces and quotes
-            kraken_db = kraken_db.strip().strip('"')
-            log(f"  Found Kraken database: {kraken_db}")
-            return kraken_db
-        else:
-            log("  ERROR: Kraken database not found in job params.")
-    else:
-        log(f"  ERROR: No job information found for dataset {dataset_info['name']}.")
-
-    return None
-
-if not os.path.exists(API_KEY_FILE) or not os.path.exists(ACCESSION_FILE):
-    log("ERROR: Missing API key or accession file.")
-    exit(1)
-
-with open(API_KEY_FILE, "r") as key_file:
-    api_key = key_file.read().strip()
-
-with open(ACCESSION_FILE, "r") as accession_file:
-    history_name = accession_file.read().strip()
-
-gi = GalaxyInstance(GALAXY_URL, api_key)
-
-# Retrieve the specified history
-histories = gi.histories.get_histories(name=history_name)
-if not histories:
-    log(f"ERROR: History '{history_name}' not found.")
-    exit(1)
-history_id = histories[0]["id"]
-log(f"Using history '{history_name}' (ID: {history_id})")
+CHECK_INTERVAL = 30  # seconds
+RAW_COMPRESSION = 6  # gzip level of the --keep-raw copies
+
+parser = argparse.ArgumentParser(description="Download translated Kraken output from Galaxy.")
+parser.add_argument("--server-counts", action="store_true",
+                    help="count reads per lineage with Datamash in Galaxy and download only the count "
+                         "tables; full tables are downloaded for any dataset that cannot be counted")
+parser.add_argument("--stream-counts", action="store_true",
+                    help="count reads per lineage while each full table streams in and save only the "
+                         "count table; with --server-counts, applies to datasets Galaxy could not count")
+parser.add_argument("--keep-raw", action="store_true",
+                    help="with --stream-counts, also keep a gzipped copy of each full table")
+args = parser.parse_args()
+
+log = stage_logger("download_taxonomy", LOG_FILE)
+
+gi, history_id, history_name = connect(log)
+index = HistoryIndex(gi, history_id)
+index.sync()
+jobs = JobCache(gi, history_id)
 
 # Get datasets containing "Kraken-translate"
-history_contents = gi.histories.show_history(history_id, contents=True)
-kraken_translate_datasets = [
-    item for item in history_contents
-    if item["history_content_type"] == "dataset" and "Kraken-translate" in item["name"]
-]
+kraken_translate_datasets = index.find(name_contains="Kraken-translate")
 
 if not kraken_translate_datasets:
     log("ERROR: No datasets with 'Kraken-translate' found.")
@@ -73,36 +47,150 @@ log(f"Found Kraken-translate datasets:")
 for item in kraken_translate_datasets:
     log(f"  {item['name']} (ID: {item['id']})")
 
-# Process and download Kraken databases
+# Resolve the Kraken database of every finished dataset; jobs the cache
+# has not seen are fetched together up front
+jobs.fetch([item.get("creating_job") for item in kraken_translate_datasets if item.get("state") == "ok"], log)
+to_download = []
+db_of = {}
 for item in kraken_translate_datasets:
     name = item["name"]
     dataset_id = item["id"]
     log(f"Processing Kraken-translate dataset '{name}' (ID: {dataset_id})")
 
-    dataset_info = gi.histories.show_dataset(history_id, dataset_id)
-
     # Check the state
-    state = dataset_info.get("state")
+    state = item.get("state")
     if state != "ok":
         log(f"  Skipping dataset '{name}' (ID: {dataset_id}) (current state: {state}).")
         continue
     
-    # Find Kraken database
-    kraken_db = find_kraken_database(dataset_info)
+    # Kraken database from the parameters of the job that made the dataset
+    kraken_db = jobs.kraken_database(item)
     
     if not kraken_db:
         log(f"  ERROR: Could not determine Kraken database for '{name}' \
             (ID: {dataset_id}).")
         continue
-    
-    # Create directory
-    db_output_dir = os.path.join(OUTPUT_DIR, kraken_db)
-    os.makedirs(db_output_dir, exist_ok=True)
-    log(f"  Created directory for Kraken database: {db_output_dir}")
-
-    # Download the dataset
-    gi.datasets.download_dataset(dataset_id, db_output_dir)
-    log(f"  Downloaded Kraken database '{kraken_db}' as .tabular to {db_output_dir}")
+    db_of[dataset_id] = kraken_db
+    to_download.append(item)
+
+def count_on_server(translated):
+    # {translated dataset id: count table listing} from one Datamash job per
+    # dataset, reused while the stage manifest says it is current. Datasets
+    # left out (tool missing, job failed) fall back to the full download.
+    manifest = StageManifest()
+    tables, pending = {}, {}
+    for item in translated:
+        request = lineage_counts_request(item["id"])
+        sig = signature(manifest, request, {"translated": item["id"]})
+        outputs = [index.get(dsid) for dsid in manifest.outputs("server_counts", item["name"])]
+        if manifest.is_current("server_counts", item["name"], sig) and outputs and \
+                all(out and out["state"] == "ok" and not out.get("deleted") for out in outputs):
+            tables[item["id"]] = outputs[0]
+            continue
+        try:
+            pending[item["id"]] = (item["name"], sig, submit(gi, history_id, request, jobs)[0]["id"])
+        except Exception as e:
+            log(f"WARNING: could not start Datamash on '{item['name']}' ({e}); downloading full tables instead")
+            break
+    log(f"Counting lineages in Galaxy: {len(tables)} count table(s) reused, {len(pending)} job(s) submitted")
+    if pending:
+        states = wait_for_datasets(gi, history_id, [out for _, _, out in pending.values()], log,
+                                   CHECK_INTERVAL, index)
+        for dataset_id, (name, sig, out) in pending.items():
+            if states[out] == "ok":
+                manifest.record("server_counts", name, sig, [out])
+                tables[dataset_id] = index.get(out)
+            else:
+                log(f"WARNING: Datamash on '{name}' ended in state '{states[out]}'; downloading the full table")
+    return tables
+
+def count_filename(item):
+    return default_filename(item)[:-len(".tabular")] + COUNTS_SUFFIX
+
+class StreamedCounts:
+    # download_datasets reader that counts taxa as a full table streams in.
+    # At the end of the data the count table is written and, with
+    # --keep-raw, the gzipped copy moved into place; the uncompressed table
+    # never touches the disk.
+    def __init__(self, counts_path, raw_path=None):
+        self.counts_path = counts_path
+        self.raw_path = raw_path
+        self.counter = TaxonCounter()
+        self.raw = None
+
+    def __call__(self, chunk):
+        self.counter(chunk)
+        if self.raw_path:
+            if self.raw is None:
+                os.makedirs(os.path.dirname(self.raw_path), exist_ok=True)
+                self.raw = gzip.open(f"{self.raw_path}.part", "wb", compresslevel=RAW_COMPRESSION)
+            self.raw.write(chunk)
+        if not chunk:
+            os.makedirs(os.path.dirname(self.counts_path), exist_ok=True)
+            write_count_table(self.counts_path, self.counter.counts)
+            if self.raw:
+                self.raw.close()
+                os.replace(f"{self.raw_path}.part", self.raw_path)
+
+    def abort(self):
+        # Called by download_datasets when the download fails: nothing is
+        # written, and the half-written gzip copy is removed
+        if self.raw:
+            self.raw.close()
+            self.raw = None
+        if self.raw_path and os.path.exists(f"{self.raw_path}.part"):
+            os.remove(f"{self.raw_path}.part")
+
+counted = count_on_server(to_download) if args.server_counts else {}
+# Count tables are saved under the name of the dataset they summarise
+source_of = {counted[item["id"]]["id"]: item for item in to_download if item["id"] in counted}
+datasets = [counted.get(item["id"], item) for item in to_download]
+
+# Everything Galaxy did not count is counted while it downloads; tables
+# counted by an earlier run with the same options are left alone
+manifest = StageManifest()
+streamed = {}
+if args.stream_counts:
+    for item in [item for item in datasets if item["id"] not in source_of]:
+        db_dir = os.path.join(OUTPUT_DIR, db_of[item["id"]])
+        counts_path = os.path.join(db_dir, count_filename(item))
+        raw_path = os.path.join(db_dir, default_filename(item) + ".gz") if args.keep_raw else None
+        sig = manifest.signature(datasets={"translated": item["id"]}, params={"keep_raw": args.keep_raw})
+        if manifest.is_current("stream_counts", item["name"], sig):
+            log(f"  Skipping '{item['name']}': counted by an earlier run ({counts_path})")
+            datasets.remove(item)
+            continue
+        outputs = [counts_path, raw_path] if raw_path else [counts_path]
+        streamed[item["id"]] = (sig, outputs, StreamedCounts(counts_path, raw_path))
+
+# Download in parallel; files already on disk with matching size/hash are skipped
+def destination(item):
+    if item["id"] in streamed:
+        return None
+    if item["id"] in source_of:
+        translated = source_of[item["id"]]
+        return os.path.join(OUTPUT_DIR, db_of[translated["id"]], count_filename(translated))
+    return os.path.join(OUTPUT_DIR, db_of[item["id"]], default_filename(item))
+
+log(f"Downloading {len(datasets) - len(counted) - len(streamed)} Kraken-translate dataset(s) and "
+    f"{len(counted)} count table(s), counting {len(streamed)} while they stream in...")
+downloaded = download_datasets(gi, datasets, destination, log,
+                               reader_for=lambda item: streamed[item["id"]][2] if item["id"] in streamed else None)
+for dataset_id, (sig, outputs, _) in streamed.items():
+    if dataset_id in downloaded:
+        manifest.record("stream_counts", index.get(dataset_id)["name"], sig, outputs)
+
+# Galaxy file names say nothing about the sample; record it next to them
+sample_of = dataset_samples(index, StageManifest())
+for db in sorted(set(db_of.values())):
+    os.makedirs(os.path.join(OUTPUT_DIR, db), exist_ok=True)
+    with open(os.path.join(OUTPUT_DIR, db, SAMPLES_FILE), "w") as f:
+        for item in to_download:
+            if db_of[item["id"]] == db and item["id"] in sample_of:
+                f.write(f"{default_filename(item)}\t{sample_of[item['id']]}\n")
+                f.write(f"{count_filename(item)}\t{sample_of[item['id']]}\n")
+if len(downloaded) < len(datasets):
+    log(f"ERROR: {len(datasets) - len(downloaded)} dataset(s) could not be downloaded.")
+    exit(1)
 
 log("All Kraken-translate datasets processed successfully!")
-
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+import os
+import gzip
+import json
+import zlib
+import queue
+import shutil
+import argparse
+import threading
+import subprocess
+import numpy as np
+from datetime import datetime
+from sample_scheduler import CORES, find_pairs, run_samples
+from stage_manifest import StageManifest
+from pipeline_events import stage_logger
+
+INPUT_DIR = "../outputs/fastq_trimmed"
+STATS_DIR = "../outputs/fastq_stats"
+LOG_FILE = "../outputs/fastq_stats/fastq_stats.log"
+BLOCK_SIZE = 4 << 20  # decompressed bytes parsed per batch
+MAX_QUALITY = 93       # Phred+33 tops out at "~"
+# pigz decompresses in separate reader, writer and check threads; without it
+# each mate is inflated by zlib in its own thread
+PIGZ = os.environ.get("PIGZ", "pigz")
+
+def open_blocks(path, blocks):
+    # Decompressed blocks of path into a queue, from a background thread,
+    # ending with None (or the exception that stopped it)
+    def run():
+        try:
+            if shutil.which(PIGZ):
+                process = subprocess.Popen([PIGZ, "-dc", path], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                for block in iter(lambda: process.stdout.read(BLOCK_SIZE), b""):
+                    blocks.put(block)
+                if process.wait() != 0:
+                    raise IOError(f"{PIGZ} -dc {path}: {process.stderr.read().decode(errors='replace').strip()}")
+            else:
+                with gzip.open(path, "rb") as f:
+                    for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+                        blocks.put(block)
+            blocks.put(None)
+        except Exception as e:
+            blocks.put(e)
+    threading.Thread(target=run, daemon=True).start()
+
+class MateStats:
+    # Running totals for one FASTQ file, updated one batch of whole records
+    # at a time with array operations over the raw bytes
+    def __init__(self):
+        self.reads = 0
+        self.bases = 0
+        self.gc = 0
+        self.malformed = 0
+        self.lengths = np.zeros(1, np.int64)
+        self.qualities = np.zeros(MAX_QUALITY + 1, np.int64)
+        self.read_qualities = np.zeros(MAX_QUALITY + 1, np.int64)
+
+    def add(self, data):
+        # Parses every complete record in data. Returns the number of bytes
+        # used and the read IDs as a (records x width) byte matrix.
+        arr = np.frombuffer(data, np.uint8)
+        newlines = np.flatnonzero(arr == 10)
+        records = len(newlines) // 4
+        if not records:
+            return 0, np.zeros((0, 1), np.uint8)
+        ends = newlines[:4 * records]
+        starts = np.concatenate(([0], ends[:-1] + 1))
+        ends = ends - (arr[np.maximum(ends - 1, 0)] == 13) * (ends > starts)  # CRLF
+        head, seq, plus, qual = (slice(i, None, 4) for i in range(4))
+
+        seq_len = ends[seq] - starts[seq]
+        self.malformed += int(np.count_nonzero((arr[starts[head]] != 64) | (arr[starts[plus]] != 43) |
+                                               (ends[qual] - starts[qual] != seq_len)))
+        self.reads += records
+        self.bases += int(seq_len.sum())
+        self.lengths = add_counts(self.lengths, np.bincount(seq_len))
+
+        # Per-record sums over byte ranges from prefix sums
+        lower = arr | 32
+        gc = np.concatenate(([0], np.cumsum((lower == 99) | (lower == 103), dtype=np.int32)))
+        self.gc += int((gc[ends[seq]] - gc[starts[seq]]).sum())
+        total = np.concatenate(([0], np.cumsum(arr, dtype=np.int64)))
+        qual_len = ends[qual] - starts[qual]
+        qual_sum = total[ends[qual]] - total[starts[qual]] - 33 * qual_len
+        mean = np.clip(qual_sum // np.maximum(qual_len, 1), 0, MAX_QUALITY)
+        self.read_qualities += np.bincount(mean, minlength=MAX_QUALITY + 1)[:MAX_QUALITY + 1]
+
+        # Every quality byte: mark the quality lines and count their values
+        marks = np.zeros(len(arr) + 1, np.int8)
+        np.add.at(marks, starts[qual], 1)
+        np.add.at(marks, ends[qual], -1)
+        scores = arr[np.cumsum(marks[:-1], dtype=np.int8) > 0].astype(np.int64) - 33
+        self.qualities += np.bincount(np.clip(scores, 0, MAX_QUALITY), minlength=MAX_QUALITY + 1)
+
+        return int(newlines[4 * records - 1]) + 1, read_ids(arr, starts[head], ends[head])
+
+    def summary(self):
+        lengths = np.flatnonzero(self.lengths)
+        scores = np.arange(MAX_QUALITY + 1)
+        qualities = self.qualities.sum() or 1
+        return {
+            "reads": self.reads,
+            "bases": self.bases,
+            "malformed_records": self.malformed,
+            "min_length": int(lengths[0]) if len(lengths) else 0,
+            "max_length": int(lengths[-1]) if len(lengths) else 0,
+            "mean_length": self.bases / self.reads if self.reads else 0,
+            "gc_percent": 100 * self.gc / self.bases if self.bases else 0,
+            "mean_quality": float((self.qualities * scores).sum() / qualities),
+            "q20_percent": 100 * float(self.qualities[20:].sum() / qualities),
+            "q30_percent": 100 * float(self.qualities[30:].sum() / qualities),
+            "length_distribution": {int(n): int(self.lengths[n]) for n in lengths},
+            "quality_distribution": {int(q): int(self.qualities[q]) for q in np.flatnonzero(self.qualities)},
+            "read_mean_quality_distribution": {int(q): int(self.read_qualities[q])
+                                               for q in np.flatnonzero(self.read_qualities)},
+        }
+
+def add_counts(a, b):
+    if len(b) > len(a):
+        a, b = b, a
+    a = a.copy()
+    a[:len(b)] += b
+    return a
+
+def read_ids(arr, starts, ends):
+    # Header up to the first space, without "@" and a trailing /1 or /2,
+    # as a zero-padded byte matrix so mates compare row by row
+    spaces = np.flatnonzero(arr == 32)
+    first = spaces[np.minimum(np.searchsorted(spaces, starts), len(spaces) - 1)] if len(spaces) else ends
+    end = np.where((first > starts) & (first < ends), first, ends)
+    mate = (end - starts >= 3) & (arr[np.maximum(end - 2, 0)] == 47) & np.isin(arr[np.maximum(end - 1, 0)], (49, 50))
+    end = end - 2 * mate
+    width = max(int((end - starts - 1).max()), 1)
+    index = starts[:, None] + 1 + np.arange(width)
+    return np.where(index < end[:, None], arr[np.minimum(index, len(arr) - 1)], 0).astype(np.uint8)
+
+def pad(ids, width):
+    return ids if ids.shape[1] >= width else np.pad(ids, ((0, 0), (0, width - ids.shape[1])))
+
+def pair_stats(file1, file2):
+    # Both mates streamed side by side; read IDs are compared in order as
+    # soon as both files have produced them. Only the mate that is behind
+    # is read from, so the IDs waiting for their mate stay within a block
+    mates = [MateStats(), MateStats()]
+    queues = [queue.Queue(maxsize=2), queue.Queue(maxsize=2)]
+    for path, blocks in zip((file1, file2), queues):
+        open_blocks(path, blocks)
+    rest = [b"", b""]
+    pending = [np.zeros((0, 1), np.uint8), np.zeros((0, 1), np.uint8)]
+    open_mates = [True, True]
+    compared = mismatched = 0
+    first_mismatch = None
+    truncated = [False, False]
+    while any(open_mates):
+        behind = [i for i in (0, 1) if open_mates[i] and
+                  (len(pending[i]) <= len(pending[1 - i]) or not open_mates[1 - i])]
+        for i in behind:
+            block = queues[i].get()
+            if isinstance(block, Exception):
+                raise block
+            if block is None:
+                # The last record may lack its newline; anything left
+                # after that is a cut-off record
+                open_mates[i] = False
+                block = b"\n" if rest[i].strip() else b""
+            data = rest[i] + block
+            used, ids = mates[i].add(data)
+            rest[i] = data[used:]
+            width = max(pending[i].shape[1], ids.shape[1])
+            pending[i] = np.concatenate((pad(pending[i], width), pad(ids, width)))
+            truncated[i] = not open_mates[i] and bool(rest[i].strip())
+        n = min(len(pending[0]), len(pending[1]))
+        if n:
+            width = max(pending[0].shape[1], pending[1].shape[1])
+            differs = np.any(pad(pending[0][:n], width) != pad(pending[1][:n], width), axis=1)
+            if first_mismatch is None and differs.any():
+                first_mismatch = compared + int(np.argmax(differs))
+            mismatched += int(differs.sum())
+            compared += n
+            pending = [pending[0][n:], pending[1][n:]]
+        # IDs past the end of a finished mate have nothing to be compared
+        # with; the read counts report the difference
+        for i in (0, 1):
+            if not open_mates[i] and not len(pending[i]):
+                pending[1 - i] = pending[1 - i][:0]
+
+    forward, reverse = (mate.summary() for mate in mates)
+    problems = []
+    if forward["reads"] != reverse["reads"]:
+        problems.append(f"read counts differ ({forward['reads']} vs {reverse['reads']})")
+    if mismatched:
+        problems.append(f"{mismatched} read ID(s) differ between mates, first at read {first_mismatch + 1}")
+    for name, mate, cut in (("_1", forward, truncated[0]), ("_2", reverse, truncated[1])):
+        if mate["malformed_records"]:
+            problems.append(f"{name}: {mate['malformed_records']} malformed record(s)")
+        if cut:
+            problems.append(f"{name}: ends in the middle of a record")
+        if not mate["reads"]:
+            problems.append(f"{name}: no reads")
+    return {"status": "fail" if problems else "pass", "problems": problems,
+            "pairs_compared": compared, "id_mismatches": mismatched, "forward": forward, "reverse": reverse}
+
+def stats_path(accession):
+    return os.path.join(STATS_DIR, f"{accession}.json")
+
+def multiqc_path(accession):
+    return os.path.join(STATS_DIR, f"{accession}_mqc.json")
+
+def write_json(path, value):
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(value, f, indent=1)
+    os.replace(f"{path}.tmp", path)
+
+def write_multiqc(accession, stats):
+    # MultiQC custom content (*_mqc.json): one General Statistics row per
+    # sample; files from all samples share the same id and are merged
+    forward, reverse = stats["forward"], stats["reverse"]
+    write_json(multiqc_path(accession), {
+        "id": "fastq_pair_stats",
+        "section_name": "FASTQ pair check",
+        "plot_type": "generalstats",
+        "pconfig": [
+            {"pair_reads": {"title": "Pairs", "format": "{:,.0f}"}},
+            {"pair_check": {"title": "Pair check"}},
+            {"mean_length": {"title": "Mean length", "suffix": " bp", "format": "{:,.1f}"}},
+            {"q30_percent": {"title": "% Q30", "max": 100, "suffix": "%", "format": "{:,.1f}"}},
+            {"gc_percent": {"title": "% GC", "max": 100, "suffix": "%", "format": "{:,.1f}"}},
+        ],
+        "data": {accession: {
+            "pair_reads": min(forward["reads"], reverse["reads"]),
+            "pair_check": stats["status"],
+            "mean_length": (forward["bases"] + reverse["bases"]) / max(forward["reads"] + reverse["reads"], 1),
+            "q30_percent": (forward["q30_percent"] + reverse["q30_percent"]) / 2,
+            "gc_percent": (forward["gc_percent"] + reverse["gc_percent"]) / 2,
+        }},
+    })
+
+def signature(manifest, file1, file2):
+    return manifest.signature(files={"1": file1, "2": file2}, tool=f"numpy {np.__version__}")
+
+def failed_pairs(directory, manifest):
+    # {accession: problems} for pairs in directory whose current files were
+    # checked and failed; pairs not checked yet are not listed
+    failed = {}
+    for accession, file1, file2 in find_pairs(directory):
+        if not os.path.exists(stats_path(accession)):
+            continue
+        if not manifest.is_current("fastq_stats", accession, signature(manifest, file1, file2)):
+            continue
+        with open(stats_path(accession)) as f:
+            stats = json.load(f)
+        if stats["status"] != "pass":
+            failed[accession] = stats["problems"]
+    return failed
+
+def main():
+    parser = argparse.ArgumentParser(description="Read counts, length and quality distributions and mate "
+                                                 "concordance of every gzipped FASTQ pair.")
+    parser.add_argument("--dir", default=INPUT_DIR, help=f"directory of *_1/_2.fastq.gz pairs (default {INPUT_DIR})")
+    args = parser.parse_args()
+
+    os.makedirs(STATS_DIR, exist_ok=True)
+    log(f"=== {datetime.now()} ===")
+    manifest = StageManifest()
+    pairs = find_pairs(args.dir)
+    todo = [p for p in pairs if not manifest.is_current("fastq_stats", p[0], signature(manifest, p[1], p[2]))]
+    log(f"FASTQ statistics are up to date for {len(pairs) - len(todo)} of {len(pairs)} sample(s)")
+
+    def check(pair):
+        accession, file1, file2 = pair
+        try:
+            stats = pair_stats(file1, file2)
+        except (EOFError, OSError, zlib.error) as e:
+            # A corrupt or cut-off .gz is recorded as a failed check, so
+            # make upload_to_ftp holds the pair back
+            empty = MateStats().summary()
+            stats = {"status": "fail", "problems": [f"could not read the pair: {e}"],
+                     "pairs_compared": 0, "id_mismatches": 0, "forward": empty, "reverse": empty}
+        write_json(stats_path(accession), stats)
+        write_multiqc(accession, stats)
+        manifest.record("fastq_stats", accession, signature(manifest, file1, file2),
+                        [stats_path(accession), multiqc_path(accession)])
+        if stats["status"] != "pass":
+            log(f"ERROR: {accession}: {'; '.join(stats['problems'])}")
+        else:
+            log(f"{accession}: {stats['forward']['reads']} pairs, mean length "
+                f"{stats['forward']['mean_length']:.0f}/{stats['reverse']['mean_length']:.0f}, "
+                f"Q30 {stats['forward']['q30_percent']:.1f}%/{stats['reverse']['q30_percent']:.1f}%")
+        return True
+
+    # Two decompressing threads per pair
+    errors = run_samples(todo, check, max(1, CORES // 2), log)
+    if errors:
+        log(f"ERROR: could not read: {[accession for accession, _, _ in errors]}")
+    failed = failed_pairs(args.dir, manifest)
+    if failed:
+        log(f"ERROR: {len(failed)} pair(s) failed the check and will not be uploaded: {sorted(failed)}")
+    log(f"Per-sample statistics in {STATS_DIR} (*_mqc.json for MultiQC)")
+    log(f"=== {datetime.now()} ===")
+
+if __name__ == "__main__":
+    log = stage_logger("fastq_stats", LOG_FILE)
+    main()
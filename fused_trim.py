@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from sample_scheduler import CORES, split_cores, run_samples, FASTP_MAX_THREADS, FASTP_ARGS
+from stage_manifest import StageManifest, tool_version
+from pipeline_events import stage_logger
+
+SRA_ACCESSION_FILE = "download/sra_accessions.txt"  # written by download.py --list-only
+SRA_DIR = "../inputs"             # prefetched .sra files, removed once trimmed
+RAW_DIR = "../inputs"             # --keep-raw copies
+TRIMMED_DIR = "../outputs/fastq_trimmed"
+SAMPLE_LOG_DIR = "../outputs/fastq_trimmed/logs"
+LOG_FILE = "../outputs/fastq_trimmed/fused_trim.log"
+PREFETCH_JOBS = 4
+DUMP_THREADS = 4
+CHUNK_SIZE = 1 << 20  # bytes copied at a time when keeping raw reads
+# fasterq-dump still spills to temporary files in --stdout mode; keep them
+# on local scratch rather than next to the outputs
+SCRATCH_DIR = os.environ.get("PIPELINE_SCRATCH", tempfile.gettempdir())
+
+# Tool commands, overridable so stub binaries can stand in
+PREFETCH = os.environ.get("PREFETCH", "prefetch")
+FASTERQ_DUMP = os.environ.get("FASTERQ_DUMP", "fasterq-dump")
+FASTP = os.environ.get("FASTP", "fastp")
+PIGZ = os.environ.get("PIGZ", "pigz")
+
+parser = argparse.ArgumentParser(description="Stream each SRA run from fasterq-dump straight into fastp, "
+                                             "keeping only the trimmed pairs and fastp reports.")
+parser.add_argument("--keep-raw", action="store_true",
+                    help="also keep the untrimmed reads as <accession>.interleaved.fastq.gz in ../inputs")
+parser.add_argument("--prefetch-jobs", type=int, default=PREFETCH_JOBS, help="concurrent prefetch transfers")
+args = parser.parse_args()
+
+log = stage_logger("fused_trim", LOG_FILE)
+
+def outputs(accession):
+    # Same files as make trim, so later stages cannot tell the difference
+    return [
+        os.path.join(TRIMMED_DIR, f"{accession}_1.fastq.gz"),
+        os.path.join(TRIMMED_DIR, f"{accession}_2.fastq.gz"),
+        os.path.join(TRIMMED_DIR, f"{accession}.json"),
+        os.path.join(TRIMMED_DIR, f"{accession}.html"),
+    ]
+
+def raw_path(accession):
+    return os.path.join(RAW_DIR, f"{accession}.interleaved.fastq.gz")
+
+def signature(accession):
+    return manifest.signature(tool=f"{tool_version(FASTERQ_DUMP)}; {tool_version(FASTP)}",
+                              params={"accession": accession, "args": FASTP_ARGS, "keep_raw": args.keep_raw})
+
+def prefetch(accession):
+    # prefetch resumes a partial .sra on its own and is a no-op when complete;
+    # if it fails, fasterq-dump fetches the run by accession itself
+    subprocess.run([PREFETCH, accession, "--output-directory", SRA_DIR],
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def copy(source, targets):
+    # Tee for --keep-raw: every chunk of fasterq-dump's output to fastp and pigz
+    try:
+        for chunk in iter(lambda: source.read(CHUNK_SIZE), b""):
+            for target in targets:
+                target.write(chunk)
+    except OSError:
+        pass  # a reader exited early; its exit status reports it
+    finally:
+        for stream in targets + [source]:
+            try:
+                stream.close()
+            except OSError:
+                pass
+
+def fused(accession):
+    # fasterq-dump --split-spot --stdout writes mates interleaved, which fastp
+    # reads from stdin; nothing uncompressed is written to the output disk
+    sra_file = os.path.join(SRA_DIR, accession, f"{accession}.sra")
+    source = sra_file if os.path.exists(sra_file) else accession
+    out1, out2, json_report, html_report = outputs(accession)
+    dump_cmd = [FASTERQ_DUMP, "--split-spot", "--skip-technical", "--stdout",
+                "--threads", str(DUMP_THREADS), "--temp", SCRATCH_DIR, source]
+    fastp_cmd = [FASTP, "--stdin", "--interleaved_in", "-w", str(threads),
+                 "-o", out1, "-O", out2, "-j", json_report, "-h", html_report] + FASTP_ARGS
+    log(f"Processing: {accession}")
+    with open(os.path.join(SAMPLE_LOG_DIR, f"{accession}.log"), "a") as logfile:
+        logfile.write(f"$ {' '.join(dump_cmd)} | {' '.join(fastp_cmd)}\n")
+        logfile.flush()
+        dump = subprocess.Popen(dump_cmd, stdout=subprocess.PIPE, stderr=logfile)
+        if not args.keep_raw:
+            fastp = subprocess.Popen(fastp_cmd, stdin=dump.stdout, stdout=logfile, stderr=subprocess.STDOUT)
+            dump.stdout.close()
+            results = [fastp.wait(), dump.wait()]
+        else:
+            with open(f"{raw_path(accession)}.part", "wb") as raw:
+                fastp = subprocess.Popen(fastp_cmd, stdin=subprocess.PIPE, stdout=logfile, stderr=subprocess.STDOUT)
+                pigz = subprocess.Popen([PIGZ, "-c", "-p", str(DUMP_THREADS)], stdin=subprocess.PIPE, stdout=raw)
+                tee = threading.Thread(target=copy, args=(dump.stdout, [fastp.stdin, pigz.stdin]))
+                tee.start()
+                tee.join()
+                results = [fastp.wait(), dump.wait(), pigz.wait()]
+            if not any(results):
+                os.replace(f"{raw_path(accession)}.part", raw_path(accession))
+    if any(results):
+        log(f"Error: {accession}: fasterq-dump | fastp exited with {results}")
+        return False
+    manifest.record("fused_trim", accession, signature(accession),
+                    outputs(accession) + ([raw_path(accession)] if args.keep_raw else []))
+    shutil.rmtree(os.path.join(SRA_DIR, accession), ignore_errors=True)
+    return True
+
+os.makedirs(SAMPLE_LOG_DIR, exist_ok=True)
+os.makedirs(SRA_DIR, exist_ok=True)
+log(f"=== {datetime.now()} ===")
+
+if not os.path.exists(SRA_ACCESSION_FILE):
+    log(f"ERROR: {SRA_ACCESSION_FILE} not found; make fused_trim writes it with download.py --list-only")
+    exit(1)
+with open(SRA_ACCESSION_FILE) as f:
+    accessions = [line.strip() for line in f if line.strip()]
+
+manifest = StageManifest()
+todo = [acc for acc in accessions if not manifest.is_current("fused_trim", acc, signature(acc))]
+log(f"Fused download and trimming is up to date for {len(accessions) - len(todo)} of {len(accessions)} sample(s)")
+
+# .sra transfers run ahead in their own pool; each sample is dumped and
+# trimmed as soon as its own transfer is done. Each worker's share of the
+# cores also covers the fasterq-dump threads, and pigz's with --keep-raw
+helper_threads = DUMP_THREADS * (2 if args.keep_raw else 1)
+workers, _ = split_cores(len(todo), FASTP_MAX_THREADS + helper_threads, min_threads=helper_threads + 1)
+threads = max(1, min(FASTP_MAX_THREADS, CORES // workers - helper_threads))
+log(f"Processing {len(todo)} sample(s): {workers} at a time, {threads} fastp thread(s) "
+    f"and {helper_threads} fasterq-dump/pigz thread(s) each")
+with ThreadPoolExecutor(args.prefetch_jobs) as transfers:
+    fetched = {acc: transfers.submit(prefetch, acc) for acc in todo}
+
+    def process(sample):
+        fetched[sample[0]].result()
+        return fused(sample[0])
+
+    failed = run_samples([(acc,) for acc in todo], process, workers, log)
+if failed:
+    log(f"ERROR: fasterq-dump | fastp failed for: {[sample[0] for sample in failed]}")
+
+log(f"=== {datetime.now()} ===")
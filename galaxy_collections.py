@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+import os
+from galaxy_session import connect, HistoryIndex
+from galaxy_jobs import JobCache
+from galaxy_polling import wait_for_collections, failed_datasets
+from stage_manifest import StageManifest
+from galaxy_tools import (get_user_databases, read_pairs, signature, map_over, submit_collection,
+                          megahit_collection_request, quast_request, kraken_request, kraken_translate_request,
+                          pairs_collection_signature, build_pairs_collection, collection_samples)
+from pipeline_events import stage_logger
+
+FTP_FILES_DIR = "../outputs/fastq_trimmed"
+CHECK_INTERVAL = 30  # seconds
+LOG_FILE = "../outputs/galaxy/collections.log"
+
+log = stage_logger("galaxy_collections", LOG_FILE)
+
+def run_mapped(stage, request, input_hdca, label, name_contains=None):
+    # One run_tool call for the whole collection; reused when the manifest
+    # shows the same tool already ran on the same collection. Returns the
+    # output collection feeding the next tool (for Kraken, the one whose
+    # name contains "Classification"), recorded first.
+    sig = signature(manifest, request, {"collection": input_hdca})
+    if manifest.is_current(stage, input_hdca, sig):
+        outputs = manifest.outputs(stage, input_hdca)
+        log(f"{label}: already run on collection {input_hdca}, reusing {outputs}")
+        output_collections.extend(outputs)
+        return outputs[0]
+    collections = submit_collection(gi, history_id, request, jobs)
+    primary = [c for c in collections if name_contains is None or name_contains in c["name"]]
+    if not primary:
+        raise ValueError(f"{label}: no output collection named '*{name_contains}*'")
+    ids = [primary[0]["id"]] + [c["id"] for c in collections if c["id"] != primary[0]["id"]]
+    log(f"{label}: submitted over collection {input_hdca} -> {[c['name'] for c in collections]}")
+    submitted.append((stage, input_hdca, sig, ids))
+    output_collections.extend(ids)
+    return ids[0]
+
+os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
+gi, history_id, history_name = connect(log)
+index = HistoryIndex(gi, history_id)
+index.sync()
+jobs = JobCache(gi, history_id)
+manifest = StageManifest()
+
+ftp_files = [f for f in os.listdir(FTP_FILES_DIR) if f.endswith(".fastq.gz")]
+name2id = {item["name"]: item["id"] for item in index.find(state="ok") if item["name"] in ftp_files}
+pairs = {s: ids for s, ids in read_pairs(name2id, log).items() if "forward" in ids and "reverse" in ids}
+databases = get_user_databases()
+log(f"Selected databases: {databases}")
+
+# Only samples whose reads changed since their last collection run
+sample_sig = {s: manifest.signature(datasets=ids, params={"databases": databases}) for s, ids in pairs.items()}
+pending = {s: ids for s, ids in pairs.items() if not manifest.is_current("collection_sample", s, sample_sig[s])}
+if not pending:
+    log(f"Nothing to submit: {len(pairs)} sample(s) already processed.")
+    exit(0)
+
+# The upload stage's list:paired collection when it holds exactly these
+# samples, otherwise a new one
+reads_sig = pairs_collection_signature(manifest, pending)
+if manifest.is_current("reads_collection", history_name, reads_sig):
+    reads = manifest.outputs("reads_collection", history_name)[0]
+else:
+    reads = build_pairs_collection(gi, history_id, pending, f"{history_name} reads ({len(pending)} samples)")
+    manifest.record("reads_collection", history_name, reads_sig, [reads])
+log(f"Processing {len(pending)} sample(s) from list:paired collection {reads}")
+
+# The whole chain is submitted up front: Galaxy holds each mapped job until
+# its element of the upstream collection is ready
+submitted = []
+output_collections = []
+submit_error = None
+try:
+    contigs = run_mapped("collection_assembly", megahit_collection_request(reads), reads, "MEGAHIT")
+    run_mapped("collection_assembly_qc", map_over(quast_request(contigs), contigs), contigs, "QUAST")
+    for db in databases:
+        classification = run_mapped(f"collection_kraken_{db}", map_over(kraken_request(contigs, db), contigs),
+                                    contigs, f"Kraken ({db})", "Classification")
+        run_mapped("collection_kraken_translate",
+                   map_over(kraken_translate_request(classification, db), classification),
+                   classification, f"Kraken-translate ({db})")
+except Exception as e:
+    log(f"ERROR submitting mapped-over jobs: {e}")
+    submit_error = e
+
+watched = [hdca for _, _, _, ids in submitted for hdca in ids]
+if watched:
+    log(f"Waiting for {len(watched)} collection(s) ({len(submitted)} tool submission(s))...")
+    states = wait_for_collections(gi, history_id, watched, log, CHECK_INTERVAL)
+    for stage, input_hdca, sig, ids in submitted:
+        if all(states[hdca] == "ok" for hdca in ids):
+            manifest.record(stage, input_hdca, sig, ids)
+    failed = failed_datasets(states)
+    if failed:
+        log(f"ERROR: {len(failed)} collection(s) have failed jobs: {failed}")
+        exit(1)
+
+if submit_error:
+    exit(1)
+# Each sample's datasets in the output collections, so downloads name
+# them after the sample (galaxy_tools.dataset_samples)
+element_outputs = collection_samples(gi, history_id, output_collections)
+for sample in pending:
+    manifest.record("collection_outputs", sample, sample_sig[sample], element_outputs.get(sample, []))
+    manifest.record("collection_sample", sample, sample_sig[sample])
+log(f"All {len(pending)} sample(s) processed with {len(submitted)} tool submission(s)!")
@@ -0,0 +1,150 @@
+import os
+import re
+import time
+import hashlib
+import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pipeline_events import transfer
+
+CHUNK_SIZE = 1 << 20  # bytes
+DOWNLOAD_JOBS = int(os.environ.get("PIPELINE_DOWNLOAD_JOBS", 4))
+TIMEOUT = 60  # seconds without data before a transfer is abandoned
+# Listing keys the engine needs; pass to show_history(contents=True, keys=...)
+DATASET_KEYS = ["id", "hid", "name", "state", "extension", "file_size", "hashes",
+                "history_content_type", "creating_job"]
+HASH_FUNCTIONS = {"MD5": "md5", "SHA-1": "sha1", "SHA-256": "sha256", "SHA-512": "sha512"}
+
+def default_filename(dataset):
+    # Same name Galaxy's download would suggest: Galaxy<hid>-[<name>].<ext>
+    name = re.sub(r"[^\w\-.,()\[\] ]", "_", dataset["name"])[:150]
+    return f"Galaxy{dataset['hid']}-[{name}].{dataset['extension']}"
+
+def expected_hash(dataset):
+    for entry in dataset.get("hashes") or []:
+        algorithm = HASH_FUNCTIONS.get(entry.get("hash_function"))
+        if algorithm:
+            return algorithm, entry["hash_value"]
+    return None
+
+def file_hash(path, algorithm):
+    digest = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def matches(path, dataset):
+    # Local file agrees with Galaxy's size and, if Galaxy has one, its hash
+    size = dataset.get("file_size")
+    if not os.path.exists(path) or size is None or os.path.getsize(path) != size:
+        return False
+    checksum = expected_hash(dataset)
+    return checksum is None or file_hash(path, checksum[0]) == checksum[1]
+
+def feed(path, reader):
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(CHUNK_SIZE), b""):
+            reader(block)
+
+def fetch(gi, dataset, path, reader=None):
+    # Stream one dataset to path in CHUNK_SIZE pieces. A leftover .part file
+    # is resumed with a Range request; servers that ignore it restart at 0.
+    # reader, if given, is called with every chunk of the dataset in order,
+    # read back from disk for the parts that were not transferred, and then
+    # with b"" once the file is complete and verified.
+    if matches(path, dataset):
+        if reader:
+            feed(path, reader)
+            reader(b"")
+        return "skipped", 0
+
+    part = f"{path}.part"
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    headers = {"x-api-key": gi.key}
+    if offset:
+        headers["Range"] = f"bytes={offset}-"
+    url = f"{gi.url}/datasets/{dataset['id']}/display"
+
+    started = time.time()
+    received = 0
+    mode = "ab"
+    with requests.get(url, headers=headers, params={"to_ext": dataset["extension"]},
+                      stream=True, timeout=TIMEOUT, verify=gi.verify) as response:
+        # 416: the .part file already holds the whole dataset
+        if response.status_code != 416:
+            response.raise_for_status()
+            mode = "ab" if offset and response.status_code == 206 else "wb"
+            if reader and mode == "ab":
+                feed(part, reader)
+            with open(part, mode) as out:
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    out.write(chunk)
+                    if reader:
+                        reader(chunk)
+                    received += len(chunk)
+        elif reader:
+            feed(part, reader)
+    transfer("down", dataset["name"], started, received, dataset=dataset["id"])
+
+    if dataset.get("file_size") is not None and os.path.getsize(part) != dataset["file_size"]:
+        size = os.path.getsize(part)
+        if size > dataset["file_size"]:
+            os.remove(part)
+        raise IOError(f"size mismatch ({size} of {dataset['file_size']} bytes)")
+    checksum = expected_hash(dataset)
+    if checksum and file_hash(part, checksum[0]) != checksum[1]:
+        os.remove(part)
+        raise IOError(f"{checksum[0]} mismatch")
+    os.replace(part, path)
+    if reader:
+        reader(b"")
+    return ("resumed" if offset and mode == "ab" else "downloaded"), received
+
+def stream(gi, dataset, reader):
+    # Hand a dataset to reader chunk by chunk without storing it; reader(b"")
+    # follows once all of Galaxy's file_size has arrived
+    started = time.time()
+    received = 0
+    url = f"{gi.url}/datasets/{dataset['id']}/display"
+    with requests.get(url, headers={"x-api-key": gi.key}, params={"to_ext": dataset["extension"]},
+                      stream=True, timeout=TIMEOUT, verify=gi.verify) as response:
+        response.raise_for_status()
+        for chunk in response.iter_content(CHUNK_SIZE):
+            reader(chunk)
+            received += len(chunk)
+    transfer("down", dataset["name"], started, received, dataset=dataset["id"])
+    if dataset.get("file_size") is not None and received != dataset["file_size"]:
+        raise IOError(f"size mismatch ({received} of {dataset['file_size']} bytes)")
+    reader(b"")
+    return "streamed", received
+
+def download_datasets(gi, datasets, dest_for, log, jobs=DOWNLOAD_JOBS, reader_for=None):
+    # Download datasets (listing dicts with DATASET_KEYS) concurrently.
+    # dest_for(dataset) gives the local path, reader_for(dataset) an optional
+    # fetch() reader. A dataset whose path is None is only streamed to its
+    # reader. A reader with an abort() method has it called when its
+    # download fails. Returns {dataset id: path} for every dataset that
+    # arrived whole.
+    done = {}
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {}
+        for dataset in datasets:
+            path = dest_for(dataset)
+            reader = reader_for(dataset) if reader_for else None
+            if path is None:
+                futures[pool.submit(stream, gi, dataset, reader)] = (dataset, path, reader)
+                continue
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            futures[pool.submit(fetch, gi, dataset, path, reader)] = (dataset, path, reader)
+        for future in as_completed(futures):
+            dataset, path, reader = futures[future]
+            try:
+                status, received = future.result()
+            except Exception as e:
+                log(f"ERROR downloading '{dataset['name']}' (ID: {dataset['id']}): {e}")
+                if hasattr(reader, "abort"):
+                    reader.abort()
+                continue
+            log(f"  {status} '{dataset['name']}'{f' -> {path}' if path else ''} ({received} bytes transferred)")
+            done[dataset["id"]] = path
+    return done
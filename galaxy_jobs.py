@@ -0,0 +1,97 @@
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+from galaxy_session import _load_json, _save_json
+
+JOB_CACHE_DIR = "../outputs/galaxy/job_cache"
+FETCH_JOBS = 8  # concurrent show_job calls for jobs not in the cache
+FINISHED_JOB_STATES = {"ok", "error", "failed", "deleted", "skipped"}
+
+def _decode(value):
+    # show_job reports parameters JSON-encoded ('"Viral"'); submitted
+    # inputs are plain values
+    if isinstance(value, str):
+        try:
+            return json.loads(value)
+        except ValueError:
+            return value.strip().strip('"')
+    return value
+
+class JobCache:
+    # On-disk tool id and parameters of the jobs that created a history's
+    # datasets. Jobs submitted by the pipeline are recorded from the
+    # run_tool response, so resolving them needs no API call; any other job
+    # is fetched with show_job once and kept, since a job never changes.
+
+    def __init__(self, gi, history_id):
+        self.gi = gi
+        self.history_id = history_id
+        self.path = os.path.join(JOB_CACHE_DIR, f"{history_id}.json")
+        self.jobs = _load_json(self.path, {})
+        self.changed = False
+
+    def remember(self, job_id, tool_id, params):
+        entry = self.jobs.setdefault(job_id, {})
+        known = {"tool_id": tool_id, "params": {key: _decode(value) for key, value in params.items()}}
+        if any(entry.get(key) != value for key, value in known.items()):
+            entry.update(known)
+            self.changed = True
+
+    def record(self, response, request):
+        # Jobs of a run_tool response, with the flat inputs that built them
+        tool_id, inputs, _, _ = request
+        params = {key: value for key, value in inputs.items() if not isinstance(value, (dict, list))}
+        for job in response.get("jobs", []):
+            self.remember(job["id"], job.get("tool_id", tool_id), params)
+        self.save()
+
+    def fetch(self, job_ids, log=None):
+        # show_job for every job not cached yet, a few at a time
+        missing = sorted({job_id for job_id in job_ids if job_id and job_id not in self.jobs})
+        if missing:
+            if log:
+                log(f"Fetching parameters of {len(missing)} job(s) not in the job cache...")
+            with ThreadPoolExecutor(max_workers=FETCH_JOBS) as pool:
+                for job in pool.map(self.gi.jobs.show_job, missing):
+                    self.remember(job["id"], job.get("tool_id"), job.get("params", {}))
+            self.save()
+        return len(missing)
+
+    def details(self, job_ids, log=None):
+        # State, create_time and job metrics (runtime, cores, memory, start
+        # and end epoch) from show_job full details. Kept once a job has
+        # finished; jobs still queued or running are asked again next time.
+        missing = sorted({job_id for job_id in job_ids if job_id and "metrics" not in self.jobs.get(job_id, {})})
+        if missing:
+            if log:
+                log(f"Fetching metrics of {len(missing)} job(s)...")
+            with ThreadPoolExecutor(max_workers=FETCH_JOBS) as pool:
+                for job in pool.map(lambda job_id: self.gi.jobs.show_job(job_id, full_details=True), missing):
+                    self.remember(job["id"], job.get("tool_id"), job.get("params", {}))
+                    if job.get("state") in FINISHED_JOB_STATES:
+                        self.jobs[job["id"]].update(
+                            state=job["state"], create_time=job.get("create_time"),
+                            update_time=job.get("update_time"),
+                            metrics={m["name"]: m.get("raw_value") for m in job.get("job_metrics") or []})
+                        self.changed = True
+            self.save()
+        return {job_id: self.jobs.get(job_id, {}) for job_id in job_ids if job_id}
+
+    def params(self, dataset):
+        # Parameters of the job that created a dataset (a listing dict with
+        # creating_job), or None when Galaxy does not say which job it was
+        job_id = dataset.get("creating_job")
+        if not job_id:
+            return None
+        self.fetch([job_id])
+        return self.jobs[job_id]["params"]
+
+    def kraken_database(self, dataset):
+        params = self.params(dataset) or {}
+        db = params.get("kraken_database")
+        return db.strip() if isinstance(db, str) and db.strip() else None
+
+    def save(self):
+        if self.changed:
+            _save_json(self.path, self.jobs)
+            self.changed = False
@@ -0,0 +1,137 @@
+import os
+import time
+from collections import Counter
+
+PAGE_SIZE = 500
+MIN_INTERVAL = 5     # seconds
+MAX_INTERVAL = 300   # seconds
+# GALAXY_POLL_INTERVAL replaces the scripts' starting interval and the lower
+# bound, for fast local servers such as benchmark/mock_galaxy.py
+POLL_INTERVAL = float(os.environ.get("GALAXY_POLL_INTERVAL", 0))
+if POLL_INTERVAL:
+    MIN_INTERVAL = POLL_INTERVAL
+TERMINAL_STATES = {"ok", "error", "failed_metadata", "deleted", "discarded", "paused"}
+# Polls in a row an id may be absent from the history (purged, mistyped or
+# in another history) before it counts as finished and failed
+MISSING_POLLS = 5
+
+def fetch_states(gi, history_id, dataset_ids):
+    # The history listing, paged newest first, instead of one show_dataset
+    # call per dataset. The listing is not filtered by id; it stops as soon
+    # as every id is found, which for fresh outputs is the first page, but
+    # an id that is not there costs the whole history. Callers that poll
+    # often pass a HistoryIndex to wait_for_datasets instead.
+    wanted = set(dataset_ids)
+    states = {}
+    offset = 0
+    while wanted - states.keys():
+        page = gi.datasets.get_datasets(history_id=history_id, limit=PAGE_SIZE, offset=offset)
+        for item in page:
+            if item["id"] in wanted:
+                states[item["id"]] = item["state"]
+        if len(page) < PAGE_SIZE:
+            break
+        offset += PAGE_SIZE
+    for dsid in wanted - states.keys():
+        states[dsid] = "missing"
+    return states
+
+def summarize(states):
+    counts = Counter(states.values())
+    done = sum(n for s, n in counts.items() if s in TERMINAL_STATES)
+    parts = ", ".join(f"{s}: {n}" for s, n in sorted(counts.items()))
+    return f"{done}/{len(states)} finished ({parts})"
+
+def next_interval(interval, changed):
+    if changed:
+        return max(interval / 2, MIN_INTERVAL)
+    return min(interval * 1.5, MAX_INTERVAL)
+
+def note_times(timeline, states, now):
+    # First poll that saw each dataset running and finished
+    for dsid, st in states.items():
+        seen = timeline.setdefault(dsid, {})
+        if st == "running":
+            seen.setdefault("running", now)
+        elif st in TERMINAL_STATES:
+            seen.setdefault("finished", now)
+
+def wait_for_datasets(gi, history_id, dataset_ids, log, interval=30, index=None, timeline=None):
+    # Poll until every dataset reaches a terminal state. The interval halves
+    # when states are moving and grows by half when nothing changed. With a
+    # HistoryIndex each tick is one incremental sync of changed items.
+    # timeline, if given, is filled by note_times. An id still "missing"
+    # after MISSING_POLLS polls is given up on, and failed_datasets reports it.
+    interval = POLL_INTERVAL or min(max(interval, MIN_INTERVAL), MAX_INTERVAL)
+    states = {}
+    missing = Counter()
+    while True:
+        time.sleep(interval)
+        try:
+            if index is not None:
+                index.sync()
+                current = index.states(dataset_ids)
+            else:
+                current = fetch_states(gi, history_id, dataset_ids)
+        except Exception as e:
+            interval = min(interval * 2, MAX_INTERVAL)
+            log(f"WARNING: state query failed ({e}), retrying in {interval:.0f}s")
+            continue
+
+        if timeline is not None:
+            note_times(timeline, current, time.time())
+        changed = sum(1 for dsid, st in current.items() if states.get(dsid) != st)
+        states = current
+        for dsid, st in states.items():
+            missing[dsid] = missing[dsid] + 1 if st == "missing" else 0
+        gone = [dsid for dsid, n in missing.items() if n == MISSING_POLLS]
+        if gone:
+            log(f"WARNING: {len(gone)} dataset(s) not in the history after {MISSING_POLLS} checks, "
+                f"giving up on them: {gone}")
+        if all(st in TERMINAL_STATES or missing[dsid] >= MISSING_POLLS for dsid, st in states.items()):
+            log(f"All {len(states)} dataset(s) finished: {summarize(states)}")
+            return states
+
+        interval = next_interval(interval, changed)
+        log(f"{summarize(states)}; next check in {interval:.0f}s")
+
+def collection_state(hdca):
+    # One state for a mapped-over collection from its job state summary:
+    # ok once every job is ok, error once every job finished and any failed
+    if hdca.get("populated_state") == "failed":
+        return "error"
+    summary = hdca.get("job_state_summary") or {}
+    total = summary.get("all_jobs", 0)
+    if hdca.get("populated_state") != "ok" or not total:
+        return "queued"
+    failed = sum(summary.get(st, 0) for st in ("error", "failed", "deleted", "paused"))
+    if summary.get("ok", 0) + summary.get("skipped", 0) + failed < total:
+        return "running"
+    return "error" if failed else "ok"
+
+def wait_for_collections(gi, history_id, hdca_ids, log, interval=30):
+    # Like wait_for_datasets, but one request per collection however many
+    # samples it holds
+    interval = POLL_INTERVAL or min(max(interval, MIN_INTERVAL), MAX_INTERVAL)
+    states = {}
+    while True:
+        time.sleep(interval)
+        try:
+            current = {hdca_id: collection_state(gi.histories.show_dataset_collection(history_id, hdca_id))
+                       for hdca_id in hdca_ids}
+        except Exception as e:
+            interval = min(interval * 2, MAX_INTERVAL)
+            log(f"WARNING: collection query failed ({e}), retrying in {interval:.0f}s")
+            continue
+
+        changed = sum(1 for hdca_id, st in current.items() if states.get(hdca_id) != st)
+        states = current
+        if all(st in TERMINAL_STATES for st in states.values()):
+            log(f"All {len(states)} collection(s) finished: {summarize(states)}")
+            return states
+
+        interval = next_interval(interval, changed)
+        log(f"{summarize(states)}; next check in {interval:.0f}s")
+
+def failed_datasets(states):
+    return [dsid for dsid, st in states.items() if st != "ok"]
@@ -0,0 +1,174 @@
+import os
+import json
+import time
+import requests
+from bioblend.galaxy import GalaxyInstance
+from galaxy_download import DATASET_KEYS
+from pipeline_events import api_call
+
+API_KEY_FILE = "galaxy/key.txt"
+ACCESSION_FILE = "download/accession.txt"
+GALAXY_URL = os.environ.get("GALAXY_URL", "https://usegalaxy.eu")
+SESSION_FILE = "../outputs/galaxy/session.json"
+INDEX_DIR = "../outputs/galaxy/history_index"
+INDEX_KEYS = DATASET_KEYS + ["update_time", "deleted", "visible"]
+PAGE_SIZE = 500
+
+def _load_json(path, default):
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return default
+
+def _save_json(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+def _size(body, stream=False):
+    # A streamed response is not read here, so only its header size counts
+    if isinstance(body, requests.Response):
+        return int(body.headers.get("Content-Length") or 0) if stream else len(body.content)
+    return len(json.dumps(body)) if body is not None else 0
+
+class TimedGalaxyInstance(GalaxyInstance):
+    # Every API request goes through these methods; each one is reported to
+    # pipeline_events with its latency and size. Sizes of decoded JSON
+    # responses are those of the re-encoded body.
+
+    def _timed(self, method, url, call, payload=None, stream=False):
+        started = time.time()
+        try:
+            result = call()
+        except Exception:
+            api_call(method, url, started, "error", _size(payload), 0)
+            raise
+        status = result.status_code if isinstance(result, requests.Response) else 200
+        api_call(method, url, started, status, _size(payload), _size(result, stream))
+        return result
+
+    def make_get_request(self, url, **kwargs):
+        return self._timed("GET", url, lambda: super(TimedGalaxyInstance, self).make_get_request(url, **kwargs),
+                           stream=kwargs.get("stream", False))
+
+    def make_post_request(self, url, payload=None, params=None, files_attached=False):
+        return self._timed("POST", url, lambda: super(TimedGalaxyInstance, self).make_post_request(
+            url, payload=payload, params=params, files_attached=files_attached),
+            None if files_attached else payload)
+
+    def make_put_request(self, url, payload=None, params=None):
+        return self._timed("PUT", url, lambda: super(TimedGalaxyInstance, self).make_put_request(
+            url, payload=payload, params=params), payload)
+
+    def make_patch_request(self, url, payload=None, params=None):
+        return self._timed("PATCH", url, lambda: super(TimedGalaxyInstance, self).make_patch_request(
+            url, payload=payload, params=params), payload)
+
+    def make_delete_request(self, url, payload=None, params=None):
+        return self._timed("DELETE", url, lambda: super(TimedGalaxyInstance, self).make_delete_request(
+            url, payload=payload, params=params), payload)
+
+def connect(log, create=False):
+    # GalaxyInstance plus the project history, whose id is cached in
+    # SESSION_FILE so later stages skip the get_histories lookup. The cached
+    # id is checked with one show_history call and looked up again when the
+    # history is gone, deleted or renamed.
+    if not os.path.exists(API_KEY_FILE) or not os.path.exists(ACCESSION_FILE):
+        log("ERROR: Missing API key or accession file.")
+        exit(1)
+    with open(API_KEY_FILE) as f:
+        api_key = f.read().strip()
+    with open(ACCESSION_FILE) as f:
+        history_name = f.read().strip()
+
+    gi = TimedGalaxyInstance(GALAXY_URL, api_key)
+    session = _load_json(SESSION_FILE, {})
+    key = f"{GALAXY_URL} {history_name}"
+    history_id = session.get(key)
+    if history_id:
+        try:
+            history = gi.histories.show_history(history_id)
+        except Exception:
+            history = {}
+        if history.get("name") == history_name and not history.get("deleted") and not history.get("purged"):
+            log(f"Using history '{history_name}' (ID: {history_id})")
+            return gi, history_id, history_name
+        log(f"Cached history {history_id} for '{history_name}' is gone, deleted or renamed; looking it up again")
+
+    # Deleted histories are left out of the listing
+
+    histories = gi.histories.get_histories(name=history_name)
+    if histories:
+        history_id = histories[0]["id"]
+        log(f"Using history '{history_name}' (ID: {history_id})")
+    elif create:
+        history_id = gi.histories.create_history(name=history_name)["id"]
+        log(f"Created new history: {history_name} (ID: {history_id})")
+    else:
+        log(f"ERROR: History '{history_name}' not found.")
+        exit(1)
+    session[key] = history_id
+    _save_json(SESSION_FILE, session)
+    return gi, history_id, history_name
+
+class HistoryIndex:
+    # On-disk copy of a history's dataset listing keyed by dataset id.
+    # sync() only asks Galaxy for items updated since the newest
+    # update_time already seen, so repeat lookups never rescan the history.
+
+    def __init__(self, gi, history_id):
+        self.gi = gi
+        self.history_id = history_id
+        self.path = os.path.join(INDEX_DIR, f"{history_id}.json")
+        data = _load_json(self.path, {})
+        self.synced_until = data.get("synced_until")
+        self.items = data.get("items", {})
+
+    def sync(self):
+        # Pages are walked by update_time cursor rather than plain offset, so
+        # items updated mid-sync cannot shift others out of the listing.
+        cursor, offset, changed = self.synced_until, 0, 0
+        while True:
+            params = {"history_id": self.history_id, "keys": ",".join(INDEX_KEYS),
+                      "order": "update_time-asc", "limit": PAGE_SIZE, "offset": offset}
+            if cursor:
+                params.update({"q": "update_time-ge", "qv": cursor})
+            response = self.gi.make_get_request(f"{self.gi.url}/datasets", params=params)
+            response.raise_for_status()
+            page = response.json()
+            for item in page:
+                if self.items.get(item["id"]) != item:
+                    self.items[item["id"]] = item
+                    changed += 1
+            if not page:
+                break
+            newest = page[-1]["update_time"]
+            self.synced_until = max(self.synced_until or newest, newest)
+            if len(page) < PAGE_SIZE:
+                break
+            if newest == cursor:
+                offset += PAGE_SIZE
+            else:
+                cursor, offset = newest, 0
+        if changed:
+            _save_json(self.path, {"synced_until": self.synced_until, "items": self.items})
+        return changed
+
+    def get(self, dataset_id):
+        return self.items.get(dataset_id)
+
+    def find(self, name_contains=None, state=None):
+        # Live datasets in history order, optionally filtered
+        found = [
+            item for item in self.items.values()
+            if not item.get("deleted")
+            and (name_contains is None or name_contains in item["name"])
+            and (state is None or item["state"] == state)
+        ]
+        return sorted(found, key=lambda item: item["hid"])
+
+    def states(self, dataset_ids):
+        return {dsid: self.items[dsid]["state"] if dsid in self.items else "missing"
+                for dsid in dataset_ids}
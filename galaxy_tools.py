@@ -0,0 +1,220 @@
+import re
+
+MEGAHIT_TOOL_ID = "toolshed.g2.bx.psu.edu/repos/iuc/megahit/megahit/1.2.9+galaxy2"
+QUAST_TOOL_ID = "toolshed.g2.bx.psu.edu/repos/iuc/quast/quast/5.3.0+galaxy0"
+KRAKEN_TOOL_ID = "toolshed.g2.bx.psu.edu/repos/devteam/kraken/kraken/1.3.1"
+KRAKEN_TRANSLATE_TOOL_ID = "toolshed.g2.bx.psu.edu/repos/devteam/kraken_translate/kraken-translate/1.3.1"
+DATAMASH_TOOL_ID = "toolshed.g2.bx.psu.edu/repos/iuc/datamash_ops/datamash_operations/1.8+galaxy0"
+
+DATABASES_FILE = "galaxy/databases.txt"
+
+DATABASE_OPTIONS = {
+    "V": "Viral",
+    "B": "Bacteria",
+    "P": "Plasmid",
+    "A": "Archaea"
+}
+
+READ_PAIR_PATTERN = re.compile(r"^(.+?)[._-]([12])\.fastq\.gz$", re.IGNORECASE)
+
+# Each request is (tool id, tool inputs, extra run_tool kwargs, parameters
+# recorded in the stage manifest). Scripts and the DAG scheduler build
+# identical jobs and manifest signatures from these.
+
+def megahit_request(fwd, rev):
+    inputs = {
+        "input_option|choice": "paired",
+        "input_option|fastq_input1": [ {"src":"hda","id":fwd} ],
+        "input_option|fastq_input2": [ {"src":"hda","id":rev} ],
+    }
+    return MEGAHIT_TOOL_ID, inputs, {"input_format": "legacy"}, {"choice": "paired"}
+
+def megahit_collection_request(pairs_hdca_id):
+    # MEGAHIT mapped over a list:paired collection, one job per pair
+    inputs = {
+        "input_option|choice": "paired_collection",
+        "input_option|fastq_input": collection_input(pairs_hdca_id, "paired"),
+    }
+    return MEGAHIT_TOOL_ID, inputs, {"input_format": "legacy"}, {"choice": "paired_collection"}
+
+def quast_request(assembly_id):
+    inputs = {
+        "mode|mode": "individual",
+        "mode|in|custom": "false",
+        "mode|in|inputs": { "src": "hda", "id": assembly_id },
+        "assembly|type": "metagenome"
+    }
+    return QUAST_TOOL_ID, inputs, {}, {"mode": "individual", "type": "metagenome"}
+
+def kraken_request(assembly_id, db):
+    inputs = {
+        "mode|mode": "individual",
+        "kraken_database": db,
+        "split_reads": True,
+        "single_paired|input_sequences": {
+            "src": "hda",
+            "id": assembly_id
+        }
+    }
+    return KRAKEN_TOOL_ID, inputs, {}, {"kraken_database": db, "split_reads": True}
+
+def kraken_translate_request(classification_id, db):
+    inputs = {
+        "kraken_database": db,
+        "input": { "src": "hda", "id": classification_id }
+    }
+    # A classification dataset always comes from one database, so its id
+    # alone identifies the translation
+    return KRAKEN_TRANSLATE_TOOL_ID, inputs, {}, {}
+
+def lineage_counts_request(translated_id):
+    # Datamash over kraken-translate output: reads per lineage (column 2),
+    # one "lineage<TAB>count" line per lineage
+    inputs = {
+        "in_file": { "src": "hda", "id": translated_id },
+        "grouping": "2",
+        "header_in": False,
+        "header_out": False,
+        "need_sort": True,
+        "ignore_case": False,
+        "operations_0|op_name": "count",
+        "operations_0|op_column": "2"
+    }
+    return DATAMASH_TOOL_ID, inputs, {}, {"grouping": "2", "op": "count"}
+
+def collection_input(hdca_id, map_over_type=None):
+    # Batch value that makes Galaxy run the tool once per collection element
+    value = {"src": "hdca", "id": hdca_id}
+    if map_over_type:
+        value["map_over_type"] = map_over_type
+    return {"batch": True, "values": [value]}
+
+def map_over(request, hdca_id):
+    # The same single-input request with its dataset replaced by a collection
+    tool_id, inputs, kwargs, params = request
+    inputs = {key: collection_input(hdca_id) if connection_source(value) is not None else value
+              for key, value in inputs.items()}
+    return tool_id, inputs, kwargs, params
+
+def signature(manifest, request, datasets):
+    tool_id, _, _, params = request
+    return manifest.signature(datasets=datasets, tool=tool_id, params=params)
+
+def submit(gi, history_id, request, jobs=None):
+    # Run the tool and return its output dataset dicts; the jobs are noted
+    # in the JobCache when one is given
+    tool_id, inputs, kwargs, _ = request
+    response = gi.tools.run_tool(history_id=history_id, tool_id=tool_id, tool_inputs=inputs, **kwargs)
+    if jobs is not None:
+        jobs.record(response, request)
+    return response["outputs"]
+
+def submit_collection(gi, history_id, request, jobs=None):
+    # Run a mapped-over tool and return the collections it creates
+    tool_id, inputs, kwargs, _ = request
+    response = gi.tools.run_tool(history_id=history_id, tool_id=tool_id, tool_inputs=inputs, **kwargs)
+    if jobs is not None:
+        jobs.record(response, request)
+    return response["implicit_collections"]
+
+def pairs_collection_signature(manifest, pairs):
+    return manifest.signature(datasets={sample: f"{ids['forward']},{ids['reverse']}"
+                                        for sample, ids in pairs.items()})
+
+def build_pairs_collection(gi, history_id, pairs, name):
+    # list:paired collection of {sample: {"forward": id, "reverse": id}};
+    # returns its id
+    elements = [
+        {"name": sample, "src": "new_collection", "collection_type": "paired",
+         "element_identifiers": [{"name": "forward", "src": "hda", "id": ids["forward"]},
+                                 {"name": "reverse", "src": "hda", "id": ids["reverse"]}]}
+        for sample, ids in sorted(pairs.items())
+    ]
+    description = {"collection_type": "list:paired", "name": name, "element_identifiers": elements}
+    return gi.histories.create_dataset_collection(history_id, description)["id"]
+
+def read_pairs(name2id, log):
+    # Group uploaded read datasets into {sample: {"forward": id, "reverse": id}}
+    pairs = {}
+    for fn, dsid in name2id.items():
+        m = READ_PAIR_PATTERN.match(fn)
+        if not m:
+            log(f"WARNING: filename {fn} does not match *_1.fastq.gz or *_2.fastq.gz pattern; skipping")
+            continue
+        base, num = m.groups()
+        side = "forward" if num=="1" else "reverse"
+        pairs.setdefault(base, {})[side] = dsid
+    return pairs
+
+def collection_samples(gi, history_id, hdca_ids):
+    # {element identifier: [dataset ids]} over mapped-over output
+    # collections, whose elements keep the sample names of the list:paired
+    # input; datasets of nested elements go to the top-level identifier
+    samples = {}
+
+    def datasets(element):
+        if element.get("element_type") == "dataset_collection":
+            return [dsid for child in element["object"].get("elements", []) for dsid in datasets(child)]
+        return [element["object"]["id"]]
+
+    for hdca_id in hdca_ids:
+        for element in gi.histories.show_dataset_collection(history_id, hdca_id)["elements"]:
+            samples.setdefault(element["element_identifier"], []).extend(datasets(element))
+    return samples
+
+def dataset_samples(index, manifest):
+    # {dataset id: read sample} for the Galaxy outputs recorded in the stage
+    # manifest. Stages after assembly are keyed by the name of their input
+    # dataset ("MEGAHIT on data 3 and data 7: Contigs"), so names are
+    # followed back to the sample the assembly was recorded under.
+    # Collection runs record each sample's element outputs directly.
+    sample_of, by_name = {}, {}
+    changed = True
+    while changed:
+        changed = False
+        for stage, runs in manifest.entries.items():
+            for key, entry in runs.items():
+                sample = key if stage in ("assembly", "collection_outputs") else by_name.get(key)
+                for dsid in entry.get("outputs", []) if sample else []:
+                    if dsid not in sample_of and index.get(dsid):
+                        sample_of[dsid] = sample
+                        by_name[index.get(dsid)["name"]] = sample
+                        changed = True
+    return sample_of
+
+def get_user_databases():
+    while True:
+        print("\nSelect Kraken databases to use:")
+        print("  V = Viral")
+        print("  B = Bacteria")
+        print("  P = Plasmid")
+        print("  A = Archaea")
+        choice = input("Enter one or more: ").upper().replace(" ", "")
+        selected = [DATABASE_OPTIONS[c] for c in choice if c in DATABASE_OPTIONS]
+        if selected and len(selected) == len(set(choice)):
+            with open(DATABASES_FILE, "w") as dbfile:
+                dbfile.write(" ".join(selected) + "\n")
+            return selected
+        print("Invalid input. Please enter only V, B, P, or A.")
+
+def tool_state(inputs):
+    # Nest "a|b" keys into {"a": {"b": ...}}, leaving out dataset inputs,
+    # which become workflow connections instead
+    state = {}
+    for key, value in inputs.items():
+        if connection_source(value) is not None:
+            continue
+        *parents, name = key.split("|")
+        node = state
+        for parent in parents:
+            node = node.setdefault(parent, {})
+        node[name] = value
+    return state
+
+def connection_source(value):
+    # The dataset id in {"src": ..., "id": ...} (or a one-item list of it)
+    if isinstance(value, list) and len(value) == 1:
+        value = value[0]
+    if isinstance(value, dict) and "src" in value:
+        return value["id"]
+    return None
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+import os
+import json
+import time
+import hashlib
+from galaxy_session import connect, HistoryIndex
+from galaxy_jobs import JobCache
+from galaxy_polling import next_interval
+from stage_manifest import StageManifest
+from galaxy_tools import (get_user_databases, read_pairs, signature, tool_state, connection_source,
+                          megahit_request, quast_request, kraken_request, kraken_translate_request)
+from pipeline_events import stage_logger
+
+FTP_FILES_DIR = "../outputs/fastq_trimmed"
+CHECK_INTERVAL = 30  # seconds
+LOG_FILE = "../outputs/galaxy/workflow_invocation.log"
+
+# Tool output names wired between workflow steps
+MEGAHIT_CONTIGS = "output"
+KRAKEN_CLASSIFICATION = "output"
+
+# Job states after which a workflow job will not change any more; paused
+# jobs are waiting on a failed upstream job
+FINISHED_JOB_STATES = {"ok", "error", "failed", "deleted", "skipped", "paused"}
+
+log = stage_logger("galaxy_workflow", LOG_FILE)
+
+def workflow_step(request, sources):
+    # Format2 step from a tool request built with placeholder dataset ids;
+    # sources maps each placeholder to the step output feeding it
+    tool_id, inputs, _, _ = request
+    connections = {key: {"source": sources[connection_source(value)]}
+                   for key, value in inputs.items() if connection_source(value) is not None}
+    return {"tool_id": tool_id, "tool_state": tool_state(inputs), "in": connections}
+
+def build_workflow(databases):
+    # MEGAHIT -> QUAST, MEGAHIT -> Kraken per database -> kraken-translate
+    steps = {
+        "assembly": workflow_step(megahit_request("forward", "reverse"),
+                                  {"forward": "forward", "reverse": "reverse"}),
+        "assembly_qc": workflow_step(quast_request("contigs"),
+                                     {"contigs": f"assembly/{MEGAHIT_CONTIGS}"}),
+    }
+    for db in databases:
+        steps[f"kraken_{db}"] = workflow_step(kraken_request("contigs", db),
+                                              {"contigs": f"assembly/{MEGAHIT_CONTIGS}"})
+        steps[f"kraken_translate_{db}"] = workflow_step(
+            kraken_translate_request("classification", db),
+            {"classification": f"kraken_{db}/{KRAKEN_CLASSIFICATION}"})
+    workflow = {
+        "class": "GalaxyWorkflow",
+        "inputs": {"forward": {"type": "data"}, "reverse": {"type": "data"}},
+        "steps": steps,
+    }
+    # The name carries a digest of the definition, so a changed workflow is
+    # imported afresh instead of reusing a stale one
+    digest = hashlib.sha1(json.dumps(workflow, sort_keys=True).encode()).hexdigest()[:8]
+    workflow["label"] = f"Metagenome assembly and taxonomy ({'+'.join(databases)}) {digest}"
+    return workflow
+
+def get_workflow_id(workflow):
+    existing = gi.workflows.get_workflows(name=workflow["label"])
+    if existing:
+        log(f"Reusing workflow '{workflow['label']}' (ID: {existing[0]['id']})")
+        return existing[0]["id"]
+    workflow_id = gi.workflows.import_workflow_dict(workflow)["id"]
+    log(f"Imported workflow '{workflow['label']}' (ID: {workflow_id})")
+    return workflow_id
+
+def step_outputs(invocation_id):
+    # {step label: [output dataset ids]} of a finished invocation
+    outputs = {}
+    for step in gi.invocations.show_invocation(invocation_id)["steps"]:
+        label = step.get("workflow_step_label")
+        if label and step.get("job_id"):
+            job = gi.jobs.show_job(step["job_id"])
+            jobs.remember(job["id"], job["tool_id"], job.get("params", {}))
+            outputs[label] = [o["id"] for o in job["outputs"].values()]
+    jobs.save()
+    return outputs
+
+def record_stages(sample, fwd, rev, outputs):
+    # Record each tool run under the same stage names and keys as the
+    # stage-by-stage scripts, so those treat the sample as done
+    assembly = outputs["assembly"]
+    request = megahit_request(fwd, rev)
+    manifest.record("assembly", sample, signature(manifest, request, {"forward": fwd, "reverse": rev}), assembly)
+    contigs = assembly[0]
+    contigs_name = index.get(contigs)["name"]
+    request = quast_request(contigs)
+    manifest.record("assembly_qc", contigs_name, signature(manifest, request, {"assembly": contigs}),
+                    outputs["assembly_qc"])
+    for db in databases:
+        kraken = outputs[f"kraken_{db}"]
+        request = kraken_request(contigs, db)
+        manifest.record(f"kraken_{db}", contigs_name, signature(manifest, request, {"assembly": contigs}), kraken)
+        classification = next(d for d in kraken if "Classification" in index.get(d)["name"])
+        request = kraken_translate_request(classification, db)
+        manifest.record("kraken_translate", index.get(classification)["name"],
+                        signature(manifest, request, {"classification": classification}),
+                        outputs[f"kraken_translate_{db}"])
+
+os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
+gi, history_id, history_name = connect(log)
+index = HistoryIndex(gi, history_id)
+jobs = JobCache(gi, history_id)
+index.sync()
+manifest = StageManifest()
+
+ftp_files = [f for f in os.listdir(FTP_FILES_DIR) if f.endswith(".fastq.gz")]
+name2id = {item["name"]: item["id"] for item in index.find(state="ok") if item["name"] in ftp_files}
+pairs = read_pairs(name2id, log)
+databases = get_user_databases()
+log(f"Selected databases: {databases}")
+
+workflow = build_workflow(databases)
+workflow_id = get_workflow_id(workflow)
+expected_jobs = len(workflow["steps"])
+
+# One invocation per sample; Galaxy schedules the whole chain itself
+invocations = {}
+up_to_date = 0
+for sample, reads in sorted(pairs.items()):
+    fwd, rev = reads.get("forward"), reads.get("reverse")
+    if not (fwd and rev):
+        log(f"Skipping '{sample}': incomplete pair ({list(reads)})")
+        continue
+    sig = manifest.signature(datasets={"forward": fwd, "reverse": rev}, tool=workflow["label"])
+    if manifest.is_current("workflow", sample, sig):
+        log(f"Skipping '{sample}': workflow already run on these reads")
+        up_to_date += 1
+        continue
+    try:
+        invocation = gi.workflows.invoke_workflow(
+            workflow_id, inputs={"forward": {"src": "hda", "id": fwd}, "reverse": {"src": "hda", "id": rev}},
+            history_id=history_id, inputs_by="name")
+    except Exception as e:
+        log(f"ERROR invoking workflow for '{sample}': {e}")
+        continue
+    log(f"Invoked workflow for '{sample}' (invocation: {invocation['id']})")
+    invocations[invocation["id"]] = (sample, fwd, rev, sig)
+
+if not invocations:
+    if up_to_date:
+        log(f"Nothing to submit: {up_to_date} sample(s) already processed."); exit(0)
+    log("ERROR: No workflow invocations were started."); exit(1)
+
+# Track invocations rather than individual datasets: one job summary
+# request per unfinished sample and check
+interval = CHECK_INTERVAL
+pending = set(invocations)
+failed = []
+while pending:
+    time.sleep(interval)
+    finished = 0
+    for invocation_id in sorted(pending):
+        sample, fwd, rev, sig = invocations[invocation_id]
+        try:
+            summary = gi.invocations.get_invocation_summary(invocation_id)
+        except Exception as e:
+            log(f"WARNING: could not check invocation for '{sample}' ({e})")
+            continue
+        states = summary.get("states", {})
+        if summary.get("populated_state") == "failed":
+            log(f"ERROR: workflow for '{sample}' could not be scheduled")
+        elif sum(states.values()) < expected_jobs or not set(states) <= FINISHED_JOB_STATES:
+            continue
+        elif set(states) != {"ok"}:
+            log(f"ERROR: workflow for '{sample}' finished with job states {states}")
+        else:
+            index.sync()
+            record_stages(sample, fwd, rev, step_outputs(invocation_id))
+            manifest.record("workflow", sample, sig)
+            log(f"Workflow for '{sample}' completed")
+            pending.discard(invocation_id)
+            finished += 1
+            continue
+        failed.append(sample)
+        pending.discard(invocation_id)
+        finished += 1
+    interval = next_interval(interval, finished)
+    if pending:
+        log(f"{len(invocations) - len(pending)}/{len(invocations)} invocation(s) finished; next check in {interval:.0f}s")
+
+if failed:
+    log(f"ERROR: {len(failed)} workflow invocation(s) failed: {failed}")
+    exit(1)
+
+log("All workflow invocations completed successfully!")
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+import os
+import json
+import statistics
+from collections import defaultdict
+from datetime import datetime, timezone
+from galaxy_session import connect, HistoryIndex
+from galaxy_jobs import JobCache
+from galaxy_tools import READ_PAIR_PATTERN, dataset_samples
+from stage_manifest import StageManifest
+from pipeline_events import EVENTS_FILE, stage_logger
+
+REPORT_FILE = "../outputs/galaxy/job_metrics_report.tsv"
+STAGE_REPORT_FILE = "../outputs/galaxy/job_metrics_stages.tsv"
+LOG_FILE = "../outputs/galaxy/job_metrics.log"
+SLOW_FACTOR = 2.0  # samples this many times their stage's median total are flagged
+TOP = 5            # slowest samples listed in the log
+
+log = stage_logger("job_metrics_report", LOG_FILE)
+
+def epoch(galaxy_time):
+    # Galaxy timestamps are UTC without a zone
+    if not galaxy_time:
+        return None
+    return datetime.fromisoformat(galaxy_time).replace(tzinfo=timezone.utc).timestamp()
+
+def number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def read_events():
+    # Latest "sample" event per (step, sample), and every transfer
+    samples, transfers = {}, []
+    if not os.path.exists(EVENTS_FILE):
+        return samples, transfers
+    with open(EVENTS_FILE) as f:
+        for line in f:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            if event["event"] == "sample":
+                samples[(event["step"], event["sample"])] = event
+            elif event["event"] == "transfer":
+                transfers.append(event)
+    return samples, transfers
+
+def server_times(jobs):
+    # Queue wait and compute time of a run's jobs from Galaxy: create_time
+    # to the start_epoch metric, and runtime_seconds
+    created = [epoch(job.get("create_time")) for job in jobs]
+    started = [number(job.get("metrics", {}).get("start_epoch")) for job in jobs]
+    ended = [number(job.get("metrics", {}).get("end_epoch")) for job in jobs]
+    runtime = [number(job.get("metrics", {}).get("runtime_seconds")) for job in jobs]
+    known = lambda values: [v for v in values if v is not None]
+    queue = compute = None
+    if known(created) and known(started):
+        queue = max(min(known(started)) - min(known(created)), 0)
+    if known(runtime):
+        compute = sum(known(runtime))
+    elif known(started) and known(ended):
+        compute = max(known(ended)) - min(known(started))
+    cores = max((number(job.get("metrics", {}).get("galaxy_slots")) or 0 for job in jobs), default=0)
+    memory = max((number(job.get("metrics", {}).get("galaxy_memory_mb")) or 0 for job in jobs), default=0)
+    return queue, compute, cores, memory
+
+def fmt(value):
+    return "" if value is None else f"{value:.1f}"
+
+os.makedirs(os.path.dirname(REPORT_FILE), exist_ok=True)
+events, transfers = read_events()
+if not events:
+    log(f"No per-sample timings in {EVENTS_FILE}; run the Galaxy stages first.")
+    exit(0)
+
+gi, history_id, history_name = connect(log)
+index = HistoryIndex(gi, history_id)
+index.sync()
+job_cache = JobCache(gi, history_id)
+
+# Galaxy jobs of every run, fetched once and kept in the job cache
+jobs_of = {key: sorted({(index.get(dsid) or {}).get("creating_job") for dsid in event["datasets"]} - {None})
+           for key, event in events.items()}
+details = job_cache.details([job_id for ids in jobs_of.values() for job_id in ids], log)
+
+# Downloads are charged to the run that made the dataset; FTP uploads to
+# the sample whose reads they are
+run_of = {dsid: key for key, event in events.items() for dsid in event["datasets"]}
+moved = defaultdict(lambda: [0.0, 0])
+for t in transfers:
+    if t.get("dataset") in run_of:
+        key = run_of[t["dataset"]]
+    elif t["direction"] == "up" and READ_PAIR_PATTERN.match(t["name"]):
+        key = ("upload_to_ftp", READ_PAIR_PATTERN.match(t["name"]).group(1))
+    else:
+        continue
+    moved[key][0] += t["seconds"]
+    moved[key][1] += t["bytes"]
+
+# Stages after assembly are keyed by their input dataset's name
+sample_of = {index.get(dsid)["name"]: sample for dsid, sample in dataset_samples(index, StageManifest()).items()}
+rows = []
+for key in sorted(set(events) | set(moved)):
+    step, name = key
+    event = events.get(key, {})
+    queue, compute, cores, memory = server_times([details[j] for j in jobs_of.get(key, [])])
+    # Client-side fallbacks when Galaxy does not report job metrics
+    queue = event.get("queued_s") if queue is None else queue
+    compute = event.get("running_s") if compute is None else compute
+    client = event.get("total_s")
+    # Polling lag, metadata and output handling: seen by the client but
+    # neither queued nor computing
+    other = max(client - (queue or 0) - (compute or 0), 0) if client is not None else None
+    transfer_s, transfer_bytes = moved.get(key, (0.0, 0))
+    total = (client if client is not None else (queue or 0) + (compute or 0)) + transfer_s
+    rows.append({"sample": sample_of.get(name, name), "step": step, "run": name, "state": event.get("state", ""),
+                 "jobs": ",".join(jobs_of.get(key, [])), "queue_s": queue, "compute_s": compute,
+                 "other_s": other, "transfer_s": transfer_s, "transfer_mb": transfer_bytes / 1e6,
+                 "total_s": total, "cores": cores, "memory_mb": memory, "flag": ""})
+
+# Flag samples far slower than the rest of their stage
+by_step = defaultdict(list)
+for row in rows:
+    by_step[row["step"]].append(row)
+for step_rows in by_step.values():
+    median = statistics.median(row["total_s"] for row in step_rows)
+    slowest = max(step_rows, key=lambda row: row["total_s"])
+    for row in step_rows:
+        if median and row["total_s"] >= SLOW_FACTOR * median:
+            row["flag"] = "slow"
+    if len(step_rows) > 1:
+        slowest["flag"] = "slowest"
+
+with open(REPORT_FILE, "w") as f:
+    f.write("sample\tstep\trun\tstate\tjobs\tqueue_s\tcompute_s\tother_s\ttransfer_s\ttransfer_mb\t"
+            "total_s\tcores\tmemory_mb\tflag\n")
+    for row in sorted(rows, key=lambda row: (row["sample"], row["step"])):
+        f.write(f"{row['sample']}\t{row['step']}\t{row['run']}\t{row['state']}\t{row['jobs']}\t"
+                f"{fmt(row['queue_s'])}\t{fmt(row['compute_s'])}\t{fmt(row['other_s'])}\t"
+                f"{fmt(row['transfer_s'])}\t{row['transfer_mb']:.2f}\t{fmt(row['total_s'])}\t"
+                f"{row['cores']:.0f}\t{row['memory_mb']:.0f}\t{row['flag']}\n")
+
+# Per stage: where the time went, slowest stage first
+stages = []
+for step, step_rows in by_step.items():
+    parts = {part: sum(row[f"{part}_s"] or 0 for row in step_rows)
+             for part in ("queue", "compute", "other", "transfer")}
+    stages.append((step, len(step_rows), max(row["total_s"] for row in step_rows), parts))
+stages.sort(key=lambda stage: stage[2], reverse=True)
+with open(STAGE_REPORT_FILE, "w") as f:
+    f.write("step\tsamples\tslowest_s\tqueue_s\tcompute_s\tother_s\ttransfer_s\tmostly\n")
+    for step, count, slowest, parts in stages:
+        f.write(f"{step}\t{count}\t{slowest:.1f}\t" + "\t".join(f"{parts[p]:.1f}" for p in parts) +
+                f"\t{max(parts, key=parts.get)}\n")
+
+for step, count, slowest, parts in stages:
+    spent = sum(parts.values()) or 1
+    log(f"{step}: {count} run(s), slowest {slowest:.0f}s; " +
+        ", ".join(f"{p} {100 * s / spent:.0f}%" for p, s in parts.items()))
+log(f"Slowest stage: {stages[0][0]} ({stages[0][2]:.0f}s for its slowest sample)")
+for row in sorted(rows, key=lambda row: row["total_s"], reverse=True)[:TOP]:
+    log(f"  {row['sample']} {row['step']}: {row['total_s']:.0f}s (queue {fmt(row['queue_s'])}s, "
+        f"compute {fmt(row['compute_s'])}s, transfer {row['transfer_s']:.1f}s)")
+log(f"Per-sample breakdown written to {REPORT_FILE}, per-stage totals to {STAGE_REPORT_FILE}")
@@ -0,0 +1,68 @@
+import os
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+def total_memory_gb():
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1e9
+    except (ValueError, OSError):
+        return 8.0
+
+# Memory available to local tools; PIPELINE_MEMORY_GB overrides the detected size
+MEMORY_GB = float(os.environ.get("PIPELINE_MEMORY_GB", total_memory_gb()))
+
+class Slots:
+    # Counting pool of CPU cores and GB of memory. acquire() blocks until
+    # both fit; a request larger than the whole pool is clamped to it, so
+    # an oversized tool runs alone rather than never.
+
+    def __init__(self, cores, memory_gb):
+        self.cores, self.memory_gb = cores, memory_gb
+        self.free_cores, self.free_memory = cores, memory_gb
+        self.cond = threading.Condition()
+
+    def clamp(self, cores, memory_gb):
+        return min(cores, self.cores), min(memory_gb, self.memory_gb)
+
+    def acquire(self, cores, memory_gb):
+        cores, memory_gb = self.clamp(cores, memory_gb)
+        with self.cond:
+            self.cond.wait_for(lambda: self.free_cores >= cores and self.free_memory >= memory_gb)
+            self.free_cores -= cores
+            self.free_memory -= memory_gb
+
+    def release(self, cores, memory_gb):
+        cores, memory_gb = self.clamp(cores, memory_gb)
+        with self.cond:
+            self.free_cores += cores
+            self.free_memory += memory_gb
+            self.cond.notify_all()
+
+class LocalExecutor:
+    # Runs tool commands as separate processes, as many at once as the CPU
+    # and memory slots allow. submit() returns a future of the exit code.
+
+    def __init__(self, cores, memory_gb):
+        self.slots = Slots(cores, memory_gb)
+        # Waiting threads are cheap; the slots decide what actually runs
+        self.pool = ThreadPoolExecutor(max_workers=max(2, cores * 2))
+
+    def run(self, cmd, log_path, cores, memory_gb, stdout_path=None):
+        self.slots.acquire(cores, memory_gb)
+        try:
+            with open(log_path, "a") as logfile:
+                logfile.write(f"$ {' '.join(cmd)}\n")
+                logfile.flush()
+                if stdout_path:
+                    with open(stdout_path, "w") as out:
+                        return subprocess.run(cmd, stdout=out, stderr=logfile).returncode
+                return subprocess.run(cmd, stdout=logfile, stderr=subprocess.STDOUT).returncode
+        finally:
+            self.slots.release(cores, memory_gb)
+
+    def submit(self, fn, *args):
+        return self.pool.submit(fn, *args)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
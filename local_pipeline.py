@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+import os
+import glob
+import shutil
+import argparse
+import threading
+from sample_scheduler import CORES, find_pairs
+from local_executor import MEMORY_GB, LocalExecutor
+from stage_manifest import StageManifest, tool_version
+from galaxy_tools import get_user_databases
+from pipeline_events import stage_logger
+
+TRIMMED_DIR = "../outputs/fastq_trimmed"
+ASSEMBLY_DIR = "../outputs/assembly"
+QUAST_DIR = "../outputs/galaxy/quast_downloads"
+KRAKEN_DIR = "../outputs/taxonomy/kraken"
+OUTPUT_DIR = "../outputs/taxonomy/translated_kraken"
+SAMPLE_LOG_DIR = "../outputs/local/logs"
+LOG_FILE = "../outputs/local/local_pipeline.log"
+
+# One directory per Kraken database, named as in the Galaxy database choice
+KRAKEN_DB_DIR = os.environ.get("KRAKEN_DB_DIR", "../databases/kraken")
+
+# Tool commands, overridable so stub binaries can stand in for the real tools
+MEGAHIT = os.environ.get("MEGAHIT", "megahit")
+QUAST = os.environ.get("QUAST", "quast.py")
+KRAKEN = os.environ.get("KRAKEN", "kraken")
+KRAKEN_TRANSLATE = os.environ.get("KRAKEN_TRANSLATE", "kraken-translate")
+
+# (cores, GB of memory) each tool run reserves; Kraken also reserves the
+# size of its database, which it loads whole
+MEGAHIT_SLOTS = (8, 16)
+QUAST_SLOTS = (4, 4)
+KRAKEN_SLOTS = (4, 1)
+KRAKEN_TRANSLATE_SLOTS = (1, 1)
+
+log = stage_logger("local_pipeline", LOG_FILE)
+
+def database_path(db):
+    return os.path.join(KRAKEN_DB_DIR, db)
+
+def database_gb(db):
+    size = sum(os.path.getsize(p) for p in glob.glob(os.path.join(database_path(db), "*")) if os.path.isfile(p))
+    return size / 1e9
+
+def contigs_path(sample):
+    return os.path.join(ASSEMBLY_DIR, sample, "final.contigs.fa")
+
+def kraken_path(sample, db):
+    return os.path.join(KRAKEN_DIR, db, f"{sample}.kraken")
+
+def translated_path(sample, db):
+    return os.path.join(OUTPUT_DIR, db, f"{sample}.tabular")
+
+def sample_log(stage, key):
+    # One log per sample and stage (and database, for keys "sample db"), as
+    # a sample's stages may run at the same time
+    return os.path.join(SAMPLE_LOG_DIR, ".".join([key.split()[0], stage] + key.split()[1:]) + ".log")
+
+# Each stage is stage(sample, ...) -> True when its outputs exist and are
+# recorded; it is skipped when the manifest shows them current.
+
+def run_stage(stage, key, files, tool, params, outputs, cmd, slots, stdout_path=None, out_dir=None):
+    sig = manifest.signature(files=files, tool=tool_version(tool), params=params)
+    if manifest.is_current(stage, key, sig):
+        log(f"{key}: {stage} already up to date")
+        return True
+    log(f"{key}: running {stage}")
+    if out_dir:
+        shutil.rmtree(out_dir, ignore_errors=True)
+    if executor.run(cmd, sample_log(stage, key), *slots, stdout_path=stdout_path) != 0:
+        log(f"ERROR: {key}: {stage} failed, see {sample_log(stage, key)}")
+        return False
+    missing = [p for p in outputs if not os.path.exists(p)]
+    if missing:
+        log(f"ERROR: {key}: {stage} did not write {missing}")
+        return False
+    manifest.record(stage, key, sig, outputs)
+    log(f"{key}: {stage} completed")
+    return True
+
+def assemble(sample, file1, file2):
+    out_dir = os.path.join(ASSEMBLY_DIR, sample)
+    cores, memory_gb = executor.slots.clamp(*MEGAHIT_SLOTS)
+    cmd = [MEGAHIT, "-1", file1, "-2", file2, "-o", out_dir,
+           "-t", str(cores), "-m", str(int(memory_gb * 1e9))]
+    os.makedirs(ASSEMBLY_DIR, exist_ok=True)
+    # MEGAHIT refuses to write into an existing output directory
+    return run_stage("local_assembly", sample, {"forward": file1, "reverse": file2}, MEGAHIT, None,
+                     [contigs_path(sample)], cmd, (cores, memory_gb), out_dir=out_dir)
+
+def assembly_qc(sample):
+    out_dir = os.path.join(QUAST_DIR, sample)
+    cores = executor.slots.clamp(*QUAST_SLOTS)[0]
+    cmd = [QUAST, contigs_path(sample), "-o", out_dir, "-t", str(cores), "--silent"]
+    return run_stage("local_assembly_qc", sample, {"assembly": contigs_path(sample)}, QUAST, None,
+                     [os.path.join(out_dir, "report.tsv")], cmd, QUAST_SLOTS)
+
+def classify(sample, db):
+    os.makedirs(os.path.dirname(kraken_path(sample, db)), exist_ok=True)
+    cores = executor.slots.clamp(*KRAKEN_SLOTS)[0]
+    cmd = [KRAKEN, "--db", database_path(db), "--threads", str(cores),
+           "--output", kraken_path(sample, db), contigs_path(sample)]
+    slots = (KRAKEN_SLOTS[0], KRAKEN_SLOTS[1] + database_gb(db))
+    return run_stage(f"local_kraken_{db}", sample, {"assembly": contigs_path(sample)}, KRAKEN,
+                     {"db": database_path(db)}, [kraken_path(sample, db)], cmd, slots)
+
+def translate(sample, db):
+    os.makedirs(os.path.dirname(translated_path(sample, db)), exist_ok=True)
+    cmd = [KRAKEN_TRANSLATE, "--db", database_path(db), kraken_path(sample, db)]
+    return run_stage("local_kraken_translate", f"{sample} {db}", {"classification": kraken_path(sample, db)},
+                     KRAKEN_TRANSLATE, {"db": database_path(db)}, [translated_path(sample, db)], cmd,
+                     KRAKEN_TRANSLATE_SLOTS, stdout_path=translated_path(sample, db))
+
+# Each sample moves on as soon as its own previous stage is done:
+# MEGAHIT -> QUAST, MEGAHIT -> Kraken per database -> kraken-translate
+def after_assembly(sample):
+    schedule(assembly_qc, sample)
+    for db in databases:
+        schedule(classify, sample, db, then=lambda s=sample, d=db: schedule(translate, s, d))
+
+def schedule(stage, *args, then=None):
+    global outstanding
+    with done:
+        outstanding += 1
+
+    def job():
+        global outstanding
+        try:
+            ok = stage(*args)
+        except Exception as e:
+            log(f"ERROR: {args[0]}: {stage.__name__} raised {e}")
+            ok = False
+        if ok and then:
+            then()
+        elif not ok:
+            failed.append((args[0], stage.__name__))
+        with done:
+            outstanding -= 1
+            done.notify_all()
+
+    executor.submit(job)
+
+parser = argparse.ArgumentParser(description="Run assembly, assembly QC and Kraken locally instead of on Galaxy.")
+parser.add_argument("--cores", type=int, default=CORES, help="CPU cores shared by all tool runs")
+parser.add_argument("--memory-gb", type=float, default=MEMORY_GB, help="memory shared by all tool runs")
+args = parser.parse_args()
+
+os.makedirs(SAMPLE_LOG_DIR, exist_ok=True)
+pairs = find_pairs(TRIMMED_DIR)
+if not pairs:
+    log(f"ERROR: no trimmed read pairs in {TRIMMED_DIR}")
+    exit(1)
+databases = get_user_databases()
+missing = [db for db in databases if not os.path.isdir(database_path(db))]
+if missing:
+    log(f"ERROR: Kraken database directories not found: {[database_path(db) for db in missing]}")
+    exit(1)
+log(f"Running {len(pairs)} sample(s) with databases {databases} on {args.cores} core(s), {args.memory_gb:.0f} GB")
+
+manifest = StageManifest()
+executor = LocalExecutor(args.cores, args.memory_gb)
+done = threading.Condition()
+outstanding = 0
+failed = []
+
+for sample, file1, file2 in pairs:
+    schedule(assemble, sample, file1, file2, then=lambda s=sample: after_assembly(s))
+with done:
+    done.wait_for(lambda: outstanding == 0)
+executor.shutdown()
+
+if failed:
+    log(f"ERROR: {len(failed)} stage run(s) failed: {failed}")
+    exit(1)
+log("All samples processed locally!")
@@ -0,0 +1,170 @@
+import os
+import json
+import hashlib
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.compute as pc
+
+# NCBI taxdump (nodes.dmp, names.dmp): TAXONOMY_DIR, or the taxonomy/
+# directory of a Kraken database under KRAKEN_DB_DIR when it has one
+TAXONOMY_DIR = os.environ.get("TAXONOMY_DIR", "../databases/taxonomy")
+KRAKEN_DB_DIR = os.environ.get("KRAKEN_DB_DIR", "../databases/kraken")
+ARRAY_DIR = "../outputs/taxonomy/taxdump_arrays"
+BLOCK_SIZE = 16 << 20  # bytes of Kraken output parsed per batch
+# kraken-translate --mpa-format rank prefixes; NCBI renamed superkingdom
+# to domain in 2025
+MPA_PREFIXES = {"superkingdom": "d", "domain": "d", "kingdom": "k", "phylum": "p", "class": "c",
+                "order": "o", "family": "f", "genus": "g", "species": "s"}
+
+def taxonomy_dir(db=None):
+    own = os.path.join(KRAKEN_DB_DIR, db, "taxonomy") if db else None
+    return own if own and os.path.exists(os.path.join(own, "nodes.dmp")) else TAXONOMY_DIR
+
+def read_dmp(path, columns):
+    # .dmp rows are "field\t|\tfield\t|...\t|"; every other tab-separated
+    # column is a "|"
+    table = pacsv.read_csv(
+        path,
+        read_options=pacsv.ReadOptions(autogenerate_column_names=True, block_size=BLOCK_SIZE),
+        parse_options=pacsv.ParseOptions(delimiter="\t", quote_char=False),
+        convert_options=pacsv.ConvertOptions(include_columns=[f"f{2 * i}" for i in columns]))
+    return [table[f"f{2 * i}"].combine_chunks() for i in columns]
+
+def string_bytes(array):
+    # The values of a string or binary array back to back, without copying
+    large = pa.types.is_large_string(array.type) or pa.types.is_large_binary(array.type)
+    offsets = np.frombuffer(array.buffers()[1], np.int64 if large else np.int32)[array.offset:array.offset + len(array) + 1]
+    if not len(array):
+        return np.zeros(0, np.uint8)
+    return np.frombuffer(array.buffers()[2], np.uint8)[offsets[0]:offsets[-1]]
+
+def build_arrays(source, target):
+    # parent.npy and rank.npy indexed by taxid, scientific names back to back
+    # in names.bin with name_offsets.npy, and rank codes in ranks.json
+    taxid, parent, rank = read_dmp(os.path.join(source, "nodes.dmp"), [0, 1, 2])
+    size = int(pc.max(taxid).as_py()) + 1
+    rank = rank.dictionary_encode()
+    parents = np.zeros(size, np.int32)
+    parents[taxid.to_numpy()] = parent.to_numpy()
+    ranks = np.zeros(size, np.uint8)  # 0: no such taxid
+    ranks[taxid.to_numpy()] = rank.indices.to_numpy() + 1
+
+    name_taxid, name, name_class = read_dmp(os.path.join(source, "names.dmp"), [0, 1, 3])
+    scientific = pc.equal(name_class, "scientific name")
+    name_taxid, name = name_taxid.filter(scientific), name.filter(scientific).cast(pa.large_binary())
+    order = pc.sort_indices(name_taxid)
+    name_taxid, name = name_taxid.take(order).to_numpy(), name.take(order)
+    lengths = np.zeros(size + 1, np.int64)
+    lengths[name_taxid + 1] = pc.binary_length(name).to_numpy()
+    offsets = np.cumsum(lengths)
+
+    os.makedirs(target, exist_ok=True)
+    np.save(os.path.join(target, "parent.npy"), parents)
+    np.save(os.path.join(target, "rank.npy"), ranks)
+    np.save(os.path.join(target, "name_offsets.npy"), offsets)
+    string_bytes(name).tofile(os.path.join(target, "names.bin"))
+    with open(os.path.join(target, "ranks.json"), "w") as f:
+        json.dump([None] + rank.dictionary.to_pylist(), f)
+
+class Taxonomy:
+    # NCBI taxonomy as memory-mapped arrays indexed by taxid. The arrays are
+    # built from the .dmp files once and rebuilt only when they change;
+    # after that, loading costs a few page faults. Lineage strings are
+    # memoised, so each taxon is walked up to the root at most once.
+    def __init__(self, source, manifest, mpa=False, log=None):
+        self.source = source
+        self.mpa = mpa
+        key = hashlib.sha1(os.path.abspath(source).encode()).hexdigest()[:12]
+        target = os.path.join(ARRAY_DIR, key)
+        sig = manifest.signature(files={"nodes": os.path.join(source, "nodes.dmp"),
+                                        "names": os.path.join(source, "names.dmp")})
+        if not manifest.is_current("taxdump_arrays", source, sig):
+            if log:
+                log(f"Building taxonomy arrays from {source} in {target}")
+            build_arrays(source, target)
+            manifest.record("taxdump_arrays", source, sig,
+                            [os.path.join(target, name) for name in
+                             ("parent.npy", "rank.npy", "name_offsets.npy", "names.bin", "ranks.json")])
+        # Plain ndarray views of the mappings index faster than np.memmap
+        self.parent = np.load(os.path.join(target, "parent.npy"), mmap_mode="r").view(np.ndarray)
+        self.rank = np.load(os.path.join(target, "rank.npy"), mmap_mode="r").view(np.ndarray)
+        self.offsets = np.load(os.path.join(target, "name_offsets.npy"), mmap_mode="r").view(np.ndarray)
+        self.names = np.memmap(os.path.join(target, "names.bin"), np.uint8, "r").view(np.ndarray) \
+            if self.offsets[-1] else np.zeros(0, np.uint8)
+        with open(os.path.join(target, "ranks.json")) as f:
+            self.rank_names = json.load(f)
+        self.lineages = {}
+        self.by_parent = None
+        self.children = {}
+
+    def name(self, taxid):
+        return self.names[self.offsets[taxid]:self.offsets[taxid + 1]].tobytes().decode(errors="replace")
+
+    def rank_name(self, taxid):
+        return self.rank_names[self.rank[taxid]]
+
+    def child(self, taxid, name):
+        # Taxid of the child of taxid with this scientific name, or None.
+        # Taxids sorted by parent on first use; each parent's children are
+        # named once
+        if self.by_parent is None:
+            self.by_parent = np.argsort(self.parent, kind="stable")
+            self.sorted_parents = self.parent[self.by_parent]
+        if taxid not in self.children:
+            first, last = np.searchsorted(self.sorted_parents, [taxid, taxid + 1])
+            self.children[taxid] = {self.name(int(c)): int(c) for c in self.by_parent[first:last]
+                                    if c != taxid and self.rank[c]}
+        return self.children[taxid].get(name)
+
+    def lineage(self, taxid):
+        # kraken-translate's string for taxid: every name from the root down,
+        # ";"-separated, or with mpa only the ranked ones as "d__...|p__..."
+        # ("root" if there are none). None for a taxid not in the taxonomy.
+        if taxid in self.lineages:
+            return self.lineages[taxid]
+        if not 0 < taxid < len(self.rank) or not self.rank[taxid]:
+            return None
+        parent = int(self.parent[taxid])
+        above = self.lineage(parent) if parent != taxid else None
+        if self.mpa:
+            prefix = MPA_PREFIXES.get(self.rank_names[self.rank[taxid]])
+            own = f"{prefix}__{self.name(taxid)}" if prefix else None
+            above = None if above == "root" else above
+            text = "|".join(part for part in (above, own) if part) or "root"
+        else:
+            text = f"{above};{self.name(taxid)}" if above else self.name(taxid)
+        self.lineages[taxid] = text
+        return text
+
+    def translate(self, kraken_path, out_path):
+        # Kraken output (C/U, sequence id, taxid, ...) to kraken-translate
+        # output: "sequence id<TAB>lineage" for every classified sequence.
+        # Parsed and joined in batches by pyarrow; Python only sees each
+        # distinct taxid once. Returns (sequences, taxids missing from the
+        # taxonomy).
+        sequences, missing = 0, set()
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+        with open(f"{out_path}.tmp", "wb") as out:
+            if os.path.getsize(kraken_path):
+                reader = pacsv.open_csv(
+                    kraken_path,
+                    read_options=pacsv.ReadOptions(autogenerate_column_names=True, block_size=BLOCK_SIZE),
+                    parse_options=pacsv.ParseOptions(delimiter="\t", quote_char=False,
+                                                     invalid_row_handler=lambda row: "skip"),
+                    convert_options=pacsv.ConvertOptions(include_columns=["f0", "f1", "f2"],
+                                                         column_types={"f0": pa.string(), "f1": pa.string(),
+                                                                       "f2": pa.int64()}))
+                for batch in reader:
+                    batch = batch.filter(pc.equal(batch["f0"], "C"))
+                    taxids = pc.unique(batch["f2"]).to_pylist()
+                    lineages = [self.lineage(taxid) for taxid in taxids]
+                    missing.update(taxid for taxid, text in zip(taxids, lineages) if text is None)
+                    lineage = pc.take(pa.array(lineages, pa.string()), pc.index_in(batch["f2"], pa.array(taxids)))
+                    known = pc.is_valid(lineage)
+                    lines = pc.binary_join_element_wise(batch["f1"].filter(known), lineage.filter(known), "\t")
+                    lines = pc.binary_join_element_wise(lines, "", "\n")
+                    out.write(string_bytes(lines))
+                    sequences += len(lines)
+        os.replace(f"{out_path}.tmp", out_path)
+        return sequences, sorted(missing)
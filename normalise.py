@@ -0,0 +1,407 @@
+#!/usr/bin/env python3
+import os
+import gzip
+import json
+import queue
+import shutil
+import argparse
+import subprocess
+import numpy as np
+from datetime import datetime
+from sample_scheduler import find_pairs, run_samples
+from stage_manifest import StageManifest
+from fastq_stats import open_blocks, stats_path, signature as stats_signature
+from pipeline_events import stage_logger
+
+INPUT_DIR = "../outputs/fastq_trimmed"
+OUTPUT_DIR = "../outputs/fastq_normalised"
+SUMMARY_FILE = "../outputs/fastq_normalised/normalisation.tsv"
+LOG_FILE = "../outputs/fastq_normalised/normalise.log"
+K = 20
+TARGET_COVERAGE = 20
+SKETCH_MB = 1024     # count-min sketch per sample
+SKETCH_ROWS = 4
+MAX_COUNT = 255      # 8-bit counters; coverage above this makes no difference
+# Pairs are judged against the sketch a few hundred at a time; pairs in the
+# same group do not see each other's k-mers
+GROUP_PAIRS = 256
+JOBS = 2
+SEED = 1
+SUBSAMPLE_CHUNK = 1 << 24  # pair positions hashed at a time when picking the subsample
+COMPRESSION = 4      # fastp's default gzip level
+PIGZ = os.environ.get("PIGZ", "pigz")
+COLUMNS = ["sample", "mode", "pairs_in", "pairs_out", "bases_in", "bases_out", "kept_percent", "sketch_fp_rate"]
+
+# A, C, G, T -> 0..3, anything else (N, newline) -> 4
+BASE_CODES = np.full(256, 4, np.uint8)
+for code, bases in enumerate(("Aa", "Cc", "Gg", "Tt")):
+    for base in bases:
+        BASE_CODES[ord(base)] = code
+# Odd multipliers of the multiply-shift hash, one per sketch row
+HASH_MULTIPLIERS = np.array([0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9, 0xD6E8FEB86659FD93,
+                             0xFF51AFD7ED558CCD, 0xC4CEB9FE1A85EC53, 0x94D049BB133111EB, 0xBF58476D1CE4E5B9],
+                            np.uint64)
+
+class MateReader:
+    # One mate's decompressed stream, split into whole records as blocks
+    # arrive. Every byte is scanned for newlines once; records leave the
+    # buffer as soon as they are taken.
+    def __init__(self, path):
+        self.blocks = queue.Queue(maxsize=2)
+        open_blocks(path, self.blocks)
+        self.data = b""
+        self.newlines = np.zeros(0, np.int64)
+        self.open = True
+
+    def records(self):
+        return len(self.newlines) // 4
+
+    def tail(self):
+        # Bytes after the last complete record
+        count = self.records()
+        return self.data[int(self.newlines[4 * count - 1]) + 1 if count else 0:]
+
+    def read(self):
+        block = self.blocks.get()
+        if isinstance(block, Exception):
+            raise block
+        if block is None:
+            # The last record may lack its newline
+            self.open = False
+            block = b"\n" if self.data and not self.data.endswith(b"\n") else b""
+        found = np.flatnonzero(np.frombuffer(block, np.uint8) == 10) + len(self.data)
+        self.data += block
+        self.newlines = np.concatenate((self.newlines, found))
+
+    def take(self, n):
+        # Line start and newline offsets of the first n records, as
+        # (n x 4) arrays into the returned byte array
+        arr = np.frombuffer(self.data, np.uint8)
+        ends = self.newlines[:4 * n]
+        starts = np.concatenate(([0], ends + 1))[:-1]
+        used = int(ends[-1]) + 1
+        self.data = self.data[used:]
+        self.newlines = self.newlines[4 * n:] - used
+        return arr, starts.reshape(n, 4), ends.reshape(n, 4)
+
+def ranges(arr, starts, ends):
+    # The [start, end) ranges of arr back to back, and the offset of each
+    lengths = ends - starts
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    return arr[np.arange(offsets[-1]) + np.repeat(starts - offsets[:-1], lengths)], offsets
+
+def kmers(arr, starts, ends, k):
+    # Canonical k-mers of the sequence lines, as 2-bit packed integers, with
+    # the record each one came from. Windows are built by doubling, so the
+    # work grows with log(k), not k.
+    sequence, offsets = ranges(arr, starts[:, 1], ends[:, 1] + 1)  # newline kept as a separator
+    codes = BASE_CODES[sequence]
+    invalid = np.concatenate(([0], np.cumsum(codes == 4, dtype=np.int32)))
+    positions = np.flatnonzero(invalid[k:] == invalid[:-k])
+    if not len(positions):
+        return np.zeros(0, np.uint64), np.zeros(0, np.int64)
+
+    bases = codes.astype(np.uint64) & np.uint64(3)
+    piece, piece_rc, length = bases, np.uint64(3) - bases, 1
+    forward = reverse = None
+    done = 0
+    for bit in range(k.bit_length()):
+        if k >> bit & 1:
+            # Append the window of `length` bases that starts `done` bases in
+            size = len(bases) - done - length + 1
+            part, part_rc = piece[done:done + size], piece_rc[done:done + size]
+            if forward is None:
+                forward, reverse = part, part_rc
+            else:
+                forward = forward[:size] << np.uint64(2 * length) | part
+                reverse = reverse[:size] | part_rc << np.uint64(2 * done)
+            done += length
+        if 2 * length <= k:
+            shift = np.uint64(2 * length)
+            piece, piece_rc = (piece[:-length] << shift | piece[length:],
+                               piece_rc[length:] << shift | piece_rc[:-length])
+            length *= 2
+    record = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    return np.minimum(forward[positions], reverse[positions]), record[positions]
+
+def splitmix(values):
+    # Well-mixed 64-bit hash of integers, for reproducible subsampling
+    with np.errstate(over="ignore"):
+        z = values.astype(np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return z ^ (z >> np.uint64(31))
+
+class Normaliser:
+    # Digital normalisation: a pair is kept while the median count of its
+    # k-mers, in either mate, is below the target; the k-mers of kept pairs
+    # are then added to a count-min sketch of fixed size
+    def __init__(self, k, target, sketch_bytes, rows=SKETCH_ROWS):
+        self.k = k
+        self.target = target
+        self.bits = max(int(sketch_bytes // rows).bit_length() - 1, 10)
+        self.table = np.zeros((rows, 1 << self.bits), np.uint8)
+
+    def slots(self, values):
+        shift = np.uint64(64 - self.bits)
+        with np.errstate(over="ignore"):
+            return [(values * HASH_MULTIPLIERS[row]) >> shift for row in range(len(self.table))]
+
+    def keep(self, mates, pairs):
+        # mates: [(k-mer values, pair index)] of the forward and reverse reads
+        keep = np.ones(pairs, bool)
+        bounds = [np.searchsorted(pair, np.arange(0, pairs + GROUP_PAIRS, GROUP_PAIRS)) for _, pair in mates]
+        for group, first in enumerate(range(0, pairs, GROUP_PAIRS)):
+            size = min(GROUP_PAIRS, pairs - first)
+            votes = np.zeros(size, bool)
+            seen = np.zeros(size, bool)
+            parts = []
+            for (values, pair), bound in zip(mates, bounds):
+                lo, hi = bound[group], bound[group + 1]
+                values, pair = values[lo:hi], pair[lo:hi] - first
+                slots = self.slots(values)
+                counts = self.table[0][slots[0]]
+                for row in range(1, len(self.table)):
+                    counts = np.minimum(counts, self.table[row][slots[row]])
+                # Median below the target <=> more than half the k-mers are
+                total = np.bincount(pair, minlength=size)
+                low = np.bincount(pair[counts < self.target], minlength=size)
+                votes |= (total > 0) & (low > total // 2)
+                seen |= total > 0
+                parts.append((pair, values))
+            # Pairs with no k-mer at all (shorter than k, all N) are kept
+            kept = votes | ~seen
+            keep[first:first + size] = kept
+            # Every occurrence of a k-mer in the group's kept pairs counts.
+            # Pairs are still judged against the sketch as it was before
+            # the group, so a group may keep a few more copies of a region
+            # than the target: an approximation bounded by GROUP_PAIRS.
+            values, occurrences = np.unique(np.concatenate([values[kept[pair]] for pair, values in parts]),
+                                            return_counts=True)
+            if not len(values):
+                continue
+            slots = self.slots(values)
+            counts = self.table[0][slots[0]]
+            for row in range(1, len(self.table)):
+                counts = np.minimum(counts, self.table[row][slots[row]])
+            # Conservative update: raise each counter only to the new
+            # estimate, which keeps collisions from inflating it
+            raised = np.minimum(counts.astype(np.int64) + occurrences, MAX_COUNT).astype(np.uint8)
+            for row, slot in enumerate(slots):
+                np.maximum.at(self.table[row], slot, raised)
+        return keep
+
+    def false_positive_rate(self):
+        # Chance that an unseen k-mer hits an occupied counter in every row
+        return float(np.prod([np.count_nonzero(row) / len(row) for row in self.table]))
+
+class Subsampler:
+    # Keeps exactly min(max_pairs, total) pairs: those whose seeded hash of
+    # their position in the file is among the max_pairs smallest. The hash
+    # is a bijection, so there are no ties, and reruns keep the same pairs.
+    k = None  # no k-mers needed
+
+    def __init__(self, max_pairs, total, seed):
+        self.key = splitmix(np.array([seed], np.uint64))
+        self.seen = 0
+        if max_pairs >= total:
+            self.threshold = np.uint64(2 ** 64 - 1)
+            return
+        # The max_pairs-th smallest hash, found a chunk of positions at a
+        # time so memory stays at max_pairs hashes plus one chunk
+        smallest = np.zeros(0, np.uint64)
+        for first in range(0, total, SUBSAMPLE_CHUNK):
+            hashes = self.hash(np.arange(first, min(first + SUBSAMPLE_CHUNK, total), dtype=np.uint64))
+            smallest = np.concatenate((smallest, hashes))
+            if len(smallest) > max_pairs:
+                smallest = np.partition(smallest, max_pairs - 1)[:max_pairs]
+        self.threshold = smallest.max() if max_pairs else None
+
+    def hash(self, index):
+        return splitmix(index ^ self.key)
+
+    def keep(self, mates, pairs):
+        index = np.arange(self.seen, self.seen + pairs, dtype=np.uint64)
+        self.seen += pairs
+        if self.threshold is None:
+            return np.zeros(pairs, bool)
+        return self.hash(index) <= self.threshold
+
+def open_writer(path):
+    if shutil.which(PIGZ):
+        f = open(path, "wb")
+        process = subprocess.Popen([PIGZ, "-c", f"-{COMPRESSION}", "-p", "2"], stdin=subprocess.PIPE, stdout=f)
+        f.close()
+        return process
+    return gzip.GzipFile(path, "wb", compresslevel=COMPRESSION, mtime=0)
+
+def close_writer(writer):
+    if isinstance(writer, subprocess.Popen):
+        writer.stdin.close()
+        if writer.wait() != 0:
+            raise IOError(f"{PIGZ} exited with {writer.returncode}")
+    else:
+        writer.close()
+
+def count_pairs(manifest, accession, file1, file2):
+    # From make fastq_stats when it has seen these files, else one pass
+    # over the forward reads
+    if os.path.exists(stats_path(accession)) and \
+            manifest.is_current("fastq_stats", accession, stats_signature(manifest, file1, file2)):
+        with open(stats_path(accession)) as f:
+            return json.load(f)["forward"]["reads"]
+    blocks = queue.Queue(maxsize=2)
+    open_blocks(file1, blocks)
+    lines = 0
+    last = b"\n"
+    while True:
+        block = blocks.get()
+        if isinstance(block, Exception):
+            raise block
+        if block is None:
+            break
+        lines += block.count(b"\n")
+        last = block[-1:]
+    return (lines + (last != b"\n")) // 4
+
+def normalise_pair(file1, file2, out1, out2, selector):
+    # Streams both mates side by side and writes the pairs the selector
+    # keeps. Only a mate with no complete record buffered is read from, so
+    # neither buffer grows past a block or so, however the read lengths of
+    # the mates differ: memory is the sketch plus a few blocks per mate.
+    mates = [MateReader(file1), MateReader(file2)]
+    writers = [open_writer(f"{out1}.part"), open_writer(f"{out2}.part")]
+    totals = {"pairs_in": 0, "pairs_out": 0, "bases_in": 0, "bases_out": 0}
+    try:
+        while True:
+            pairs = min(mate.records() for mate in mates)
+            if not pairs:
+                waiting = [mate for mate in mates if mate.open and not mate.records()]
+                if waiting:
+                    waiting[0].read()
+                    continue
+                # A mate has ended; the other must have nothing left either
+                if any(mate.records() or mate.tail().strip() for mate in mates):
+                    raise ValueError("mates have different numbers of reads, or a file is cut off")
+                break
+
+            parsed = [mate.take(pairs) for mate in mates]
+            kmer_mates = [kmers(arr, starts, ends, selector.k) for arr, starts, ends in parsed] \
+                if selector.k else None
+            keep = selector.keep(kmer_mates, pairs)
+            for writer, (arr, starts, ends) in zip(writers, parsed):
+                lengths = ends[:, 1] - starts[:, 1]
+                totals["bases_in"] += int(lengths.sum())
+                totals["bases_out"] += int(lengths[keep].sum())
+                write(writer, ranges(arr, starts[keep, 0], ends[keep, 3] + 1)[0].tobytes())
+            totals["pairs_in"] += pairs
+            totals["pairs_out"] += int(keep.sum())
+    except BaseException:
+        for writer, path in zip(writers, (out1, out2)):
+            try:
+                close_writer(writer)
+                os.remove(f"{path}.part")
+            except Exception:
+                pass
+        raise
+    for writer in writers:
+        close_writer(writer)
+    os.replace(f"{out1}.part", out1)
+    os.replace(f"{out2}.part", out2)
+    return totals
+
+def write(writer, data):
+    (writer.stdin if isinstance(writer, subprocess.Popen) else writer).write(data)
+
+def read_summary():
+    if not os.path.exists(SUMMARY_FILE):
+        return {}
+    with open(SUMMARY_FILE) as f:
+        header = f.readline().rstrip("\n").split("\t")
+        rows = [dict(zip(header, line.rstrip("\n").split("\t"))) for line in f if line.strip()]
+    return {row["sample"]: row for row in rows}
+
+def main():
+    parser = argparse.ArgumentParser(description="Reduce redundant coverage in trimmed read pairs, by k-mer "
+                                                 "digital normalisation or reproducible subsampling.")
+    parser.add_argument("--target-coverage", type=int, default=TARGET_COVERAGE,
+                        help=f"keep a pair while its median k-mer count is below this (default {TARGET_COVERAGE})")
+    parser.add_argument("-k", type=int, default=K, help=f"k-mer length, at most 32 (default {K})")
+    parser.add_argument("--sketch-mb", type=int, default=SKETCH_MB,
+                        help=f"count-min sketch size per sample in MB (default {SKETCH_MB})")
+    parser.add_argument("--max-pairs", type=int,
+                        help="subsample each sample to exactly this many pairs (all, if it has fewer) "
+                             "instead of normalising")
+    parser.add_argument("--seed", type=int, default=SEED, help="subsampling seed")
+    parser.add_argument("--jobs", type=int, default=JOBS, help=f"samples processed at once (default {JOBS})")
+    parser.add_argument("--dir", default=INPUT_DIR, help=f"directory of *_1/_2.fastq.gz pairs (default {INPUT_DIR})")
+    args = parser.parse_args()
+    if not 0 < args.k <= 32 or args.target_coverage > MAX_COUNT:
+        parser.error(f"-k must be 1-32 and --target-coverage at most {MAX_COUNT}")
+
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    log(f"=== {datetime.now()} ===")
+    manifest = StageManifest()
+    if args.max_pairs:
+        params = {"mode": "subsample", "max_pairs": args.max_pairs, "seed": args.seed}
+    else:
+        params = {"mode": "normalise", "k": args.k, "target": args.target_coverage, "sketch_mb": args.sketch_mb}
+
+    def outputs(accession):
+        return [os.path.join(OUTPUT_DIR, f"{accession}_1.fastq.gz"), os.path.join(OUTPUT_DIR, f"{accession}_2.fastq.gz")]
+
+    def signature(pair):
+        accession, file1, file2 = pair
+        return manifest.signature(files={"1": file1, "2": file2}, tool=f"numpy {np.__version__}", params=params)
+
+    pairs = find_pairs(args.dir)
+    todo = [p for p in pairs if not manifest.is_current("normalise", p[0], signature(p))]
+    log(f"Read reduction is up to date for {len(pairs) - len(todo)} of {len(pairs)} sample(s)")
+    if args.max_pairs:
+        log(f"Subsampling {len(todo)} sample(s) to at most {args.max_pairs} pairs each, {args.jobs} at a time")
+    else:
+        log(f"Normalising {len(todo)} sample(s) to k-mer coverage {args.target_coverage} (k={args.k}, "
+            f"{args.sketch_mb} MB sketch each), {args.jobs} at a time")
+
+    summary = read_summary()
+
+    def reduce(pair):
+        accession, file1, file2 = pair
+        if args.max_pairs:
+            total = count_pairs(manifest, accession, file1, file2)
+            selector = Subsampler(args.max_pairs, total, args.seed)
+        else:
+            selector = Normaliser(args.k, args.target_coverage, args.sketch_mb << 20)
+        out1, out2 = outputs(accession)
+        totals = normalise_pair(file1, file2, out1, out2, selector)
+        fp_rate = selector.false_positive_rate() if isinstance(selector, Normaliser) else None
+        kept = 100 * totals["pairs_out"] / max(totals["pairs_in"], 1)
+        summary[accession] = {"sample": accession, "mode": params["mode"], **totals,
+                              "kept_percent": f"{kept:.2f}", "sketch_fp_rate": "" if fp_rate is None else f"{fp_rate:.4f}"}
+        manifest.record("normalise", accession, signature(pair), outputs(accession))
+        log(f"{accession}: kept {totals['pairs_out']} of {totals['pairs_in']} pairs ({kept:.1f}%), "
+            f"{totals['bases_out'] / 1e6:.1f} of {totals['bases_in'] / 1e6:.1f} Mbases")
+        if fp_rate is not None and fp_rate > 0.2:
+            log(f"WARNING: {accession}: the sketch is {fp_rate:.0%} saturated; counts are inflated and too many "
+                f"reads were dropped. Rerun with a larger NORMALISE_ARGS=--sketch-mb.")
+        return True
+
+    errors = run_samples(todo, reduce, args.jobs, log)
+    if errors:
+        log(f"ERROR: read reduction failed for: {[accession for accession, _, _ in errors]}")
+
+    # One row per sample still in the input directory
+    rows = [summary[accession] for accession, _, _ in pairs if accession in summary]
+    with open(f"{SUMMARY_FILE}.tmp", "w") as f:
+        f.write("\t".join(COLUMNS) + "\n")
+        for row in rows:
+            f.write("\t".join(str(row.get(column, "")) for column in COLUMNS) + "\n")
+    os.replace(f"{SUMMARY_FILE}.tmp", SUMMARY_FILE)
+    pairs_in = sum(int(row["pairs_in"]) for row in rows)
+    pairs_out = sum(int(row["pairs_out"]) for row in rows)
+    log(f"{pairs_out} of {pairs_in} pairs kept over {len(rows)} sample(s); per-sample reduction in {SUMMARY_FILE}")
+    log(f"=== {datetime.now()} ===")
+
+if __name__ == "__main__":
+    log = stage_logger("normalise", LOG_FILE)
+    main()
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from galaxy_session import connect, HistoryIndex
+from galaxy_jobs import JobCache
+from galaxy_polling import TERMINAL_STATES, next_interval
+from galaxy_download import DOWNLOAD_JOBS, default_filename, fetch
+from galaxy_tools import (get_user_databases, read_pairs, signature, submit, megahit_request,
+                          quast_request, kraken_request, kraken_translate_request)
+from stage_manifest import StageManifest
+from pipeline_events import stage_logger, emit
+
+FTP_FILES_DIR = "../outputs/fastq_trimmed"
+OUTPUT_DIR = "../outputs/taxonomy/translated_kraken"
+REPORT_FILE = "../outputs/galaxy/pipeline_dag_report.tsv"
+LOG_FILE = "../outputs/galaxy/pipeline_dag.log"
+CHECK_INTERVAL = 30  # seconds
+
+# Steps in the order the stage-by-stage Makefile targets run them
+STEPS = ["assembly", "assembly_qc", "kraken", "kraken_translate", "download"]
+
+log = stage_logger("pipeline_dag", LOG_FILE)
+
+class Node:
+    # One tool run (or download) for one sample; it starts as soon as its
+    # parent's output is ok, independently of every other sample.
+
+    def __init__(self, sample, step, parent=None, db=None, reads=None):
+        self.sample, self.step, self.parent, self.db, self.reads = sample, step, parent, db, reads
+        self.children = []
+        if parent:
+            parent.children.append(self)
+        self.state = "waiting"   # waiting, running, ok, failed, skipped
+        self.outputs = []        # Galaxy dataset ids
+        self.primary = None      # dataset handed to the children
+        self.sig = None
+        self.future = None
+        self.started = self.finished = None
+
+    def label(self):
+        return f"{self.step}[{self.db}]" if self.db else self.step
+
+def describe(node):
+    # (manifest stage, manifest sample key, request, signature inputs),
+    # keyed exactly as the stage scripts key them
+    upstream = node.parent.primary if node.parent else None
+    if node.step == "assembly":
+        fwd, rev = node.reads["forward"], node.reads["reverse"]
+        return "assembly", node.sample, megahit_request(fwd, rev), {"forward": fwd, "reverse": rev}
+    name = index.get(upstream)["name"]
+    if node.step == "assembly_qc":
+        return "assembly_qc", name, quast_request(upstream), {"assembly": upstream}
+    if node.step == "kraken":
+        return f"kraken_{node.db}", name, kraken_request(upstream, node.db), {"assembly": upstream}
+    return ("kraken_translate", name, kraken_translate_request(upstream, node.db),
+            {"classification": upstream})
+
+def pick_primary(node, outputs):
+    # outputs: [(id, name)]; Kraken's classification is the dataset translated
+    if node.step == "kraken":
+        for dsid, name in outputs:
+            if "Classification" in name:
+                return dsid
+    return outputs[0][0] if outputs else None
+
+def start(node, now):
+    node.started = now
+    if node.step == "download":
+        item = index.get(node.parent.primary)
+        dest = os.path.join(OUTPUT_DIR, node.db, default_filename(item))
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        node.future = downloads.submit(fetch, gi, item, dest)
+        node.state = "running"
+        return
+
+    stage, key, request, inputs = describe(node)
+    node.sig = signature(manifest, request, inputs)
+    # Reuse a recorded run only while its outputs are still ok in the history
+    reused = [index.get(d) for d in manifest.outputs(stage, key)]
+    if (manifest.is_current(stage, key, node.sig) and reused
+            and all(item and item["state"] == "ok" and not item.get("deleted") for item in reused)):
+        node.outputs = [item["id"] for item in reused]
+        node.primary = pick_primary(node, [(item["id"], item["name"]) for item in reused])
+        node.state, node.started, node.finished = "ok", None, now
+        log(f"{node.sample}: {node.label()} already done, reusing {node.outputs}")
+        return
+
+    outputs = submit(gi, history_id, request, jobs)
+    node.outputs = [o["id"] for o in outputs]
+    node.primary = pick_primary(node, [(o["id"], o["name"]) for o in outputs])
+    node.state = "running"
+    log(f"{node.sample}: submitted {node.label()} -> {node.outputs}")
+
+def check(node, now):
+    if node.step == "download":
+        if not node.future.done():
+            return
+        try:
+            node.future.result()
+            node.state = "ok"
+        except Exception as e:
+            log(f"ERROR: {node.sample}: download failed: {e}")
+            node.state = "failed"
+    else:
+        states = index.states(node.outputs)
+        if not all(st in TERMINAL_STATES for st in states.values()):
+            return
+        node.state = "ok" if all(st == "ok" for st in states.values()) else "failed"
+        if node.state == "ok":
+            stage, key, _, _ = describe(node)
+            manifest.record(stage, key, node.sig, node.outputs)
+        else:
+            log(f"ERROR: {node.sample}: {node.label()} failed: {states}")
+    node.finished = now
+
+def advance(nodes, now):
+    # Start every waiting node whose parent is ok, repeatedly, because
+    # nodes reused from the manifest finish immediately
+    progressed = True
+    while progressed:
+        progressed = False
+        for node in nodes:
+            if node.state != "waiting":
+                continue
+            parent_state = node.parent.state if node.parent else "ok"
+            if parent_state in ("failed", "skipped"):
+                node.state, node.finished = "skipped", now
+                progressed = True
+            elif parent_state == "ok":
+                try:
+                    start(node, now)
+                except Exception as e:
+                    log(f"ERROR: {node.sample}: could not start {node.label()}: {e}")
+                    node.state, node.finished = "failed", now
+                progressed = True
+
+def report(nodes, t0, t_end):
+    os.makedirs(os.path.dirname(REPORT_FILE), exist_ok=True)
+    with open(REPORT_FILE, "w") as f:
+        f.write("sample\tstep\tdatabase\tstate\tstart_s\tend_s\tduration_s\n")
+        for n in nodes:
+            end_s = n.finished - t0 if n.finished else 0
+            start_s = n.started - t0 if n.started else end_s
+            f.write(f"{n.sample}\t{n.step}\t{n.db or ''}\t{n.state}\t{start_s:.0f}\t{end_s:.0f}\t{end_s - start_s:.0f}\n")
+            if n.started and n.finished and n.step != "download":
+                emit("sample", step=describe(n)[0], sample=n.sample, state=n.state, datasets=n.outputs,
+                     submitted=n.started, running=None, finished=n.finished, queued_s=None, running_s=None,
+                     total_s=round(n.finished - n.started, 3))
+
+    # Critical path: walk back from the node that finished last
+    done = [n for n in nodes if n.finished and n.started]
+    if done:
+        last = max(done, key=lambda n: n.finished)
+        sample, path = last.sample, []
+        while last:
+            took = f"{last.finished - last.started:.0f}s" if last.started else "reused"
+            path.append(f"{last.label()} {took}")
+            last = last.parent
+        log(f"Critical path ({sample}): {' -> '.join(reversed(path))}")
+
+    # With stage-wide barriers every step waits for the slowest sample of
+    # the step before it
+    wall = t_end - t0
+    barrier = sum(
+        max((n.finished - n.started for n in done if n.step == step), default=0)
+        for step in STEPS
+    )
+    log(f"Wall time {wall:.0f}s; stage-by-stage estimate {barrier:.0f}s; "
+        f"saved about {max(barrier - wall, 0):.0f}s")
+    log(f"Per-step timings written to {REPORT_FILE}")
+
+os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
+gi, history_id, history_name = connect(log)
+index = HistoryIndex(gi, history_id)
+jobs = JobCache(gi, history_id)
+index.sync()
+manifest = StageManifest()
+
+# Uploaded read pairs, as assembly.py finds them
+ftp_files = [f for f in os.listdir(FTP_FILES_DIR) if f.endswith(".fastq.gz")]
+name2id = {item["name"]: item["id"] for item in index.find(state="ok") if item["name"] in ftp_files}
+pairs = read_pairs(name2id, log)
+databases = get_user_databases()
+log(f"Selected databases: {databases}")
+
+# MEGAHIT -> QUAST, MEGAHIT -> Kraken per database -> kraken-translate -> download
+nodes = []
+for sample, reads in sorted(pairs.items()):
+    if not ("forward" in reads and "reverse" in reads):
+        log(f"Skipping '{sample}': incomplete pair ({list(reads)})")
+        continue
+    assembly = Node(sample, "assembly", reads=reads)
+    nodes += [assembly, Node(sample, "assembly_qc", assembly)]
+    for db in databases:
+        kraken = Node(sample, "kraken", assembly, db)
+        translate = Node(sample, "kraken_translate", kraken, db)
+        nodes += [kraken, translate, Node(sample, "download", translate, db)]
+
+if not nodes:
+    log("ERROR: No complete read pairs found in history.")
+    exit(1)
+
+log(f"Scheduling {len(nodes)} step(s) for {len(pairs)} sample(s)")
+t0 = time.time()
+interval = CHECK_INTERVAL
+with ThreadPoolExecutor(max_workers=DOWNLOAD_JOBS) as downloads:
+    advance(nodes, time.time())
+    while any(n.state in ("waiting", "running") for n in nodes):
+        time.sleep(interval)
+        try:
+            index.sync()
+        except Exception as e:
+            log(f"WARNING: history sync failed ({e})")
+            interval = next_interval(interval, False)
+            continue
+        now = time.time()
+        before = [n.state for n in nodes]
+        for node in nodes:
+            if node.state == "running":
+                check(node, now)
+        advance(nodes, now)
+        changed = sum(1 for n, b in zip(nodes, before) if n.state != b)
+        interval = next_interval(interval, changed)
+        counts = {}
+        for n in nodes:
+            counts[n.state] = counts.get(n.state, 0) + 1
+        log(f"Steps: {', '.join(f'{s}: {c}' for s, c in sorted(counts.items()))}; next check in {interval:.0f}s")
+
+report(nodes, t0, time.time())
+failed = [f"{n.sample}:{n.label()}" for n in nodes if n.state in ("failed", "skipped")]
+if failed:
+    log(f"ERROR: {len(failed)} step(s) failed or were skipped: {failed}")
+    exit(1)
+log("All samples processed!")
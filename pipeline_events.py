@@ -0,0 +1,177 @@
+import os
+import re
+import sys
+import json
+import time
+import queue
+import atexit
+import threading
+from collections import defaultdict
+from datetime import datetime
+
+EVENTS_FILE = os.environ.get("PIPELINE_EVENTS_FILE", "../outputs/events/events.jsonl")
+# Point this at the node exporter's --collector.textfile.directory to scrape it
+METRICS_DIR = os.environ.get("PIPELINE_METRICS_DIR", "../outputs/events/metrics")
+FLUSH_INTERVAL = 1.0     # seconds between writes of buffered lines
+METRICS_INTERVAL = 15.0  # seconds between rewrites of the metrics file
+ID_PATTERN = re.compile(r"/[0-9a-f]{16}(?=/|$)")
+
+class Writer:
+    # Appends lines to files from one background thread: each flush opens
+    # every file once for everything queued since the last one, instead of
+    # once per message
+    def __init__(self):
+        self.lines = queue.Queue()
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="pipeline-events", daemon=True)
+        self.thread.start()
+
+    def write(self, path, line):
+        self.lines.put((path, line))
+
+    def flush(self):
+        batch = defaultdict(list)
+        while True:
+            try:
+                path, line = self.lines.get_nowait()
+            except queue.Empty:
+                break
+            batch[path].append(line)
+        for path, lines in batch.items():
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with open(path, "a") as f:
+                f.writelines(lines)
+
+    def run(self):
+        last_metrics = time.time()
+        while not self.stop.wait(FLUSH_INTERVAL):
+            try:
+                self.flush()
+                if stage["name"] and time.time() - last_metrics >= METRICS_INTERVAL:
+                    write_metrics()
+                    last_metrics = time.time()
+            except OSError as e:
+                print(f"WARNING: could not write pipeline events: {e}", file=sys.stderr)
+
+    def close(self):
+        self.stop.set()
+        self.thread.join()
+        self.flush()
+
+_writer = Writer()
+atexit.register(_writer.close)
+_lock = threading.Lock()
+# Metric name -> {label tuple: value}, for this process only
+_metrics = defaultdict(lambda: defaultdict(float))
+stage = {"name": None, "start": None, "errors": 0, "exception": None}
+
+def emit(event, **fields):
+    # One JSON line in EVENTS_FILE, tagged with the running stage
+    record = {"time": round(time.time(), 3), "stage": stage["name"], "pid": os.getpid(), "event": event}
+    record.update(fields)
+    count(record)
+    _writer.write(EVENTS_FILE, json.dumps(record, default=str) + "\n")
+
+def count(record):
+    name = record["stage"] or os.path.basename(sys.argv[0])
+    with _lock:
+        if record["event"] == "api":
+            labels = (("stage", name), ("method", record["method"]), ("route", record["route"]))
+            _metrics["pipeline_api_requests_total"][labels] += 1
+            _metrics["pipeline_api_request_seconds_total"][labels] += record["seconds"]
+            if record["status"] == "error" or int(record["status"]) >= 400:
+                _metrics["pipeline_api_errors_total"][labels] += 1
+            for direction in ("in", "out"):
+                _metrics["pipeline_api_bytes_total"][(("stage", name), ("direction", direction))] += \
+                    record[f"bytes_{direction}"]
+        elif record["event"] == "transfer":
+            labels = (("stage", name), ("direction", record["direction"]))
+            _metrics["pipeline_transfer_bytes_total"][labels] += record["bytes"]
+            _metrics["pipeline_transfer_seconds_total"][labels] += record["seconds"]
+        elif record["event"] == "sample":
+            _metrics["pipeline_samples_total"][(("stage", name), ("state", record["state"]))] += 1
+            for phase in ("queued", "running"):
+                if record.get(f"{phase}_s") is not None:
+                    _metrics[f"pipeline_sample_{phase}_seconds_total"][(("stage", name),)] += record[f"{phase}_s"]
+
+def write_metrics(end=None):
+    # Prometheus text format, one file per stage so runs of different
+    # scripts do not overwrite each other; replaced atomically
+    name = stage["name"]
+    labels = (("stage", name),)
+    with _lock:
+        metrics = {metric: dict(values) for metric, values in _metrics.items()}
+    metrics["pipeline_stage_start_time_seconds"] = {labels: stage["start"]}
+    metrics["pipeline_stage_errors"] = {labels: stage["errors"]}
+    if end is not None:
+        metrics["pipeline_stage_end_time_seconds"] = {labels: end}
+        metrics["pipeline_stage_duration_seconds"] = {labels: end - stage["start"]}
+        metrics["pipeline_stage_success"] = {labels: 0 if stage["errors"] or stage["exception"] else 1}
+    lines = []
+    for metric in sorted(metrics):
+        lines.append(f"# TYPE {metric} {'counter' if metric.endswith('_total') else 'gauge'}\n")
+        for key, value in sorted(metrics[metric].items()):
+            label_text = ",".join(f'{k}="{v}"' for k, v in key)
+            lines.append(f"{metric}{{{label_text}}} {float(value)!r}\n")
+    path = os.path.join(METRICS_DIR, f"{name}.prom")
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    with open(f"{path}.tmp", "w") as f:
+        f.writelines(lines)
+    os.replace(f"{path}.tmp", path)
+
+def stage_logger(name, log_file):
+    # Starts the stage and returns its log(): messages are printed at once
+    # and appended to log_file by the background writer. stage_end is
+    # emitted at exit, failed if an ERROR was logged or an exception escaped.
+    stage.update(name=name, start=time.time())
+    emit("stage_start", argv=sys.argv[1:])
+    print_lock = threading.Lock()
+
+    def log(message):
+        timestamp = datetime.now().strftime("[%Y-%m-%d %H:%M:%S]")
+        if "ERROR" in str(message):
+            stage["errors"] += 1
+        _writer.write(log_file, f"{timestamp} {message}\n")
+        with print_lock:
+            print(f"{timestamp} {message}", flush=True)
+
+    excepthook = sys.excepthook
+
+    def record_exception(kind, value, traceback):
+        stage["exception"] = kind.__name__
+        excepthook(kind, value, traceback)
+
+    def end():
+        finished = time.time()
+        failed = stage["errors"] or stage["exception"]
+        emit("stage_end", seconds=round(finished - stage["start"], 3), status="error" if failed else "ok",
+             errors=stage["errors"], exception=stage["exception"])
+        try:
+            write_metrics(finished)
+        except OSError as e:
+            print(f"WARNING: could not write metrics: {e}", file=sys.stderr)
+
+    sys.excepthook = record_exception
+    atexit.register(end)
+    return log
+
+def api_call(method, url, started, status, bytes_out, bytes_in):
+    route = ID_PATTERN.sub("/{id}", url.split("?")[0].split("/api", 1)[-1])
+    emit("api", method=method, route=route, status=status, seconds=round(time.time() - started, 4),
+         bytes_out=bytes_out, bytes_in=bytes_in)
+
+def transfer(direction, name, started, size, **fields):
+    emit("transfer", direction=direction, name=name, bytes=size, seconds=round(time.time() - started, 3), **fields)
+
+def sample_timing(step, sample, submitted_at, ids, timeline, states):
+    # One "sample" event from a wait loop's timeline (galaxy_polling.note_times).
+    # Queue wait runs to the first poll that saw a job running, or finished
+    # for jobs quicker than one poll, so it is only as fine as the interval.
+    seen = [timeline.get(dsid, {}) for dsid in ids]
+    finished = max((s["finished"] for s in seen if "finished" in s), default=None)
+    running = min((s.get("running", s.get("finished")) for s in seen if s), default=None)
+    emit("sample", step=step, sample=sample, state="ok" if all(states.get(d) == "ok" for d in ids) else "error",
+         datasets=ids, submitted=submitted_at, running=running, finished=finished,
+         queued_s=None if running is None else round(running - submitted_at, 3),
+         running_s=None if running is None or finished is None else round(finished - running, 3),
+         total_s=None if finished is None else round(finished - submitted_at, 3))
@@ -0,0 +1,22 @@
+#!/usr/bin/env python3
+import os
+from datetime import datetime
+from sample_scheduler import fastqc_stage
+from stage_manifest import StageManifest
+from pipeline_events import stage_logger
+
+INPUT_DIR = "../inputs"
+OUTPUT_DIR = "../outputs/fastqc"
+LOG_FILE = "../outputs/quality_control.log"
+MULTIQC_NAME = "multiqc_non_trimmed.html"
+
+log = stage_logger("quality_control", LOG_FILE)
+
+os.makedirs(OUTPUT_DIR, exist_ok=True)
+log(f"=== {datetime.now()} ===")
+
+failed = fastqc_stage("fastqc", INPUT_DIR, OUTPUT_DIR, MULTIQC_NAME, StageManifest(), log)
+if failed:
+    log(f"ERROR: FastQC failed for: {[accession for accession, _, _ in failed]}")
+
+log(f"=== {datetime.now()} ===")
@@ -0,0 +1,88 @@
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from stage_manifest import tool_version
+
+# Cores available to local tools; PIPELINE_CORES overrides the detected count
+CORES = int(os.environ.get("PIPELINE_CORES", os.cpu_count() or 1))
+FASTQC_MAX_THREADS = 2   # FastQC uses one thread per input file
+FASTP_MAX_THREADS = 16   # fastp does not scale past 16 worker threads
+FASTP_ARGS = ["--verbose"]  # shared by make trim and make fused_trim
+MULTIQC_DIR = "../outputs/multiqc"
+
+def find_pairs(directory):
+    pairs = []
+    for name in sorted(os.listdir(directory)):
+        if name.endswith("_1.fastq.gz"):
+            accession = name[:-len("_1.fastq.gz")]
+            file1 = os.path.join(directory, name)
+            file2 = os.path.join(directory, f"{accession}_2.fastq.gz")
+            pairs.append((accession, file1, file2))
+    return pairs
+
+def split_cores(n_jobs, max_threads, cores=CORES, min_threads=1):
+    # Threads per tool call and number of concurrent calls so that
+    # workers * threads stays within the available cores.
+    threads = max(min_threads, min(max_threads, cores // max(1, n_jobs)))
+    workers = max(1, min(n_jobs, cores // threads))
+    return workers, threads
+
+def run_tool(cmd, log_path):
+    # Tool output goes to the sample's own log, never the shared stage log
+    with open(log_path, "a") as logfile:
+        logfile.write(f"$ {' '.join(cmd)}\n")
+        logfile.flush()
+        return subprocess.run(cmd, stdout=logfile, stderr=subprocess.STDOUT).returncode
+
+def run_samples(samples, job, workers, log):
+    # Run job(sample) for every sample on a bounded pool and return the
+    # samples whose job failed. Returns only once every job has finished.
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(job, sample): sample for sample in samples}
+        for done, future in enumerate(as_completed(futures), 1):
+            sample = futures[future]
+            try:
+                ok = future.result()
+            except Exception as e:
+                log(f"ERROR: {sample[0]}: {e}")
+                ok = False
+            if not ok:
+                failed.append(sample)
+            log(f"[{done}/{len(futures)}] {'Completed' if ok else 'FAILED'}: {sample[0]}")
+    return failed
+
+def fastqc_stage(stage, input_dir, output_dir, multiqc_name, manifest, log):
+    pairs = find_pairs(input_dir)
+    signatures = {
+        accession: manifest.signature(files={"1": file1, "2": file2}, tool=tool_version("fastqc"))
+        for accession, file1, file2 in pairs
+    }
+    todo = [p for p in pairs if not manifest.is_current(stage, p[0], signatures[p[0]])]
+    log(f"FastQC is up to date for {len(pairs) - len(todo)} of {len(pairs)} sample(s)")
+
+    workers, threads = split_cores(len(todo), FASTQC_MAX_THREADS)
+    log(f"Running FastQC on {len(todo)} sample(s): {workers} at a time, {threads} thread(s) each")
+
+    def fastqc(pair):
+        accession, file1, file2 = pair
+        sample_dir = os.path.join(output_dir, accession)
+        os.makedirs(sample_dir, exist_ok=True)
+        cmd = ["fastqc", "-t", str(threads), file1, file2, f"--outdir={sample_dir}"]
+        if run_tool(cmd, os.path.join(sample_dir, "fastqc.log")) != 0:
+            return False
+        reports = [
+            os.path.join(sample_dir, os.path.basename(f).replace(".fastq.gz", "_fastqc.html"))
+            for f in (file1, file2)
+        ]
+        manifest.record(stage, accession, signatures[accession], reports)
+        return True
+
+    failed = run_samples(todo, fastqc, workers, log)
+
+    # MultiQC only once every sample is finished, and only if anything changed
+    multiqc_report = os.path.join(MULTIQC_DIR, multiqc_name)
+    if todo or not os.path.exists(multiqc_report):
+        log("Running MultiQC...")
+        subprocess.run(["multiqc", "-f", output_dir, "-o", MULTIQC_DIR, "--filename", multiqc_name])
+    return failed
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import hashlib
+import threading
+import subprocess
+from functools import lru_cache
+
+MANIFEST_FILE = "../outputs/stage_manifest.json"
+# PIPELINE_FORCE=1 reruns everything; PIPELINE_HASH_INPUTS=1 fingerprints
+# local files by SHA-256 instead of size and mtime.
+FORCE = os.environ.get("PIPELINE_FORCE") == "1"
+HASH_INPUTS = os.environ.get("PIPELINE_HASH_INPUTS") == "1"
+
+def file_fingerprint(path):
+    st = os.stat(path)
+    if HASH_INPUTS:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        return f"sha256:{digest.hexdigest()}"
+    return f"{st.st_size}:{st.st_mtime_ns}"
+
+@lru_cache(maxsize=None)
+def tool_version(tool):
+    # First line a tool prints for --version, or "unknown"
+    try:
+        result = subprocess.run([tool, "--version"], capture_output=True, text=True)
+    except OSError:
+        return "unknown"
+    lines = (result.stdout + result.stderr).strip().splitlines()
+    return lines[0] if lines else "unknown"
+
+class StageManifest:
+    # Per-stage, per-sample record of the inputs, tool version and parameters
+    # a result was produced from, so reruns only redo what changed.
+
+    def __init__(self, path=MANIFEST_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def signature(self, files=None, datasets=None, tool="", params=None):
+        # files maps a role to a local path, datasets a role to a Galaxy
+        # dataset id; a new upload or rerun upstream means a new id.
+        inputs = {role: file_fingerprint(path) for role, path in (files or {}).items()}
+        inputs.update(datasets or {})
+        return {"inputs": inputs, "tool": tool, "params": params or {}}
+
+    def is_current(self, stage, sample, signature):
+        if FORCE:
+            return False
+        with self.lock:
+            entry = self.entries.get(stage, {}).get(sample)
+        if not entry or entry["signature"] != signature:
+            return False
+        # Local outputs must still be on disk as they were written
+        for path, fingerprint in entry.get("files", {}).items():
+            if not os.path.exists(path) or file_fingerprint(path) != fingerprint:
+                return False
+        return True
+
+    def outputs(self, stage, sample):
+        with self.lock:
+            return self.entries.get(stage, {}).get(sample, {}).get("outputs", [])
+
+    def record(self, stage, sample, signature, outputs=()):
+        files = {p: file_fingerprint(p) for p in outputs if os.path.exists(p)}
+        with self.lock:
+            self.entries.setdefault(stage, {})[sample] = {
+                "signature": signature,
+                "outputs": list(outputs),
+                "files": files,
+            }
+            self._save()
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+
+# Shell stages: "pending STAGE PARAMS FILE..." prints the files whose
+# fingerprint changed since "record STAGE PARAMS FILE..." last saw them.
+if __name__ == "__main__":
+    if len(sys.argv) < 4 or sys.argv[1] not in ("pending", "record"):
+        sys.exit(f"usage: {sys.argv[0]} pending|record STAGE PARAMS FILE...")
+    command, stage, params, files = sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4:]
+    manifest = StageManifest()
+    for path in files:
+        sample = os.path.basename(path)
+        signature = manifest.signature(files={"file": path}, params={"args": params})
+        if command == "pending" and not manifest.is_current(stage, sample, signature):
+            print(path)
+        elif command == "record":
+            manifest.record(stage, sample, signature)
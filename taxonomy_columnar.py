@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+import os
+import re
+import glob
+import argparse
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.fs as pafs
+from stage_manifest import StageManifest
+from pipeline_events import stage_logger
+
+TRANSLATED_DIR = "../outputs/taxonomy/translated_kraken"
+COLUMNAR_DIR = "../outputs/taxonomy/columnar"
+LOG_FILE = "../outputs/taxonomy/columnar/columnar.log"
+SAMPLES_FILE = "samples.tsv"  # written by download_taxonomy.py
+RANK_SEPARATOR = re.compile(r"[|;]")  # "root|...|Genus" or "d__...;p__...;s__..."
+BATCH_ROWS = 1 << 20
+
+dictionary = pa.dictionary(pa.int32(), pa.string())
+SCHEMA = pa.schema([
+    ("sample", dictionary),
+    ("database", dictionary),
+    ("sequence", pa.string()),
+    ("lineage", dictionary),
+    ("taxon", dictionary),
+])
+
+def leaf(lineage):
+    names = [name for name in RANK_SEPARATOR.split(lineage) if name]
+    return names[-1] if names else lineage
+
+def constant(value, length):
+    return pa.DictionaryArray.from_arrays(pa.repeat(pa.scalar(0, pa.int32()), length), pa.array([value]))
+
+def read_translated(path):
+    # Kraken-translate output: sequence id, tab, lineage. Extra columns
+    # are ignored.
+    if os.path.getsize(path) == 0:
+        return pa.array([], pa.string()), pa.array([], pa.string())
+    table = pacsv.read_csv(
+        path,
+        read_options=pacsv.ReadOptions(autogenerate_column_names=True),
+        parse_options=pacsv.ParseOptions(delimiter="\t", quote_char=False, invalid_row_handler=lambda row: "skip"),
+        convert_options=pacsv.ConvertOptions(include_columns=["f0", "f1"],
+                                             column_types={"f0": pa.string(), "f1": pa.string()}))
+    return table["f0"].combine_chunks(), table["f1"].combine_chunks()
+
+def convert(tabular, arrow, sample, db):
+    # Lineages repeat across millions of rows, so each is stored once in a
+    # dictionary; taxon codes (the lineage's last name) are derived from the
+    # lineage codes without parsing any row. Uncompressed so that readers
+    # can memory-map the file.
+    sequence, lineage = read_translated(tabular)
+    lineage = lineage.dictionary_encode()
+    leaves = [leaf(value) for value in lineage.dictionary.to_pylist()]
+    taxa = sorted(set(leaves))
+    code = {taxon: i for i, taxon in enumerate(taxa)}
+    taxon_of_lineage = pa.array([code[taxon] for taxon in leaves], pa.int32())
+    taxon = pa.DictionaryArray.from_arrays(pc.take(taxon_of_lineage, lineage.indices), pa.array(taxa, pa.string()))
+    table = pa.table([constant(sample, len(sequence)), constant(db, len(sequence)), sequence,
+                      lineage.cast(dictionary), taxon], schema=SCHEMA)
+    os.makedirs(os.path.dirname(arrow), exist_ok=True)
+    # Dot-prefixed while written, so dataset scans skip it
+    tmp = os.path.join(os.path.dirname(arrow), f".{os.path.basename(arrow)}.tmp")
+    with pa.OSFile(tmp, "wb") as sink:
+        with pa.ipc.new_file(sink, SCHEMA) as writer:
+            writer.write_table(table, max_chunksize=BATCH_ROWS)
+    os.replace(tmp, arrow)
+    return len(sequence), len(taxa)
+
+def read_sample(path, columns=None):
+    # Zero-copy read: the table's buffers point into the mapped file
+    table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+    return table.select(columns) if columns else table
+
+def open_database(db):
+    # Every sample of one database as one memory-mapped dataset; scans only
+    # touch the columns asked for
+    return ds.dataset(os.path.join(COLUMNAR_DIR, db), format="ipc",
+                      filesystem=pafs.LocalFileSystem(use_mmap=True))
+
+def top_taxa(db, n, by="taxon"):
+    # [(name, rows)] for the n most frequent values of a dictionary column
+    # across all samples, counted on the dictionary codes
+    column = open_database(db).to_table(columns=[by]).unify_dictionaries()[by]
+    if column.num_chunks == 0:
+        return []
+    codes = pa.chunked_array([chunk.indices for chunk in column.chunks], pa.int32())
+    names = column.chunk(0).dictionary
+    counts = pc.value_counts(codes)
+    counts = pa.table({"code": counts.field("values"), "rows": counts.field("counts")})
+    top = counts.take(pc.select_k_unstable(counts, n, [("rows", "descending")]))
+    return [(names[row["code"]].as_py(), row["rows"]) for row in top.to_pylist()]
+
+def sample_names(db_dir):
+    path = os.path.join(db_dir, SAMPLES_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return dict(line.rstrip("\n").split("\t", 1) for line in f if "\t" in line)
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert translated Kraken output to memory-mappable "
+                                                 "Arrow IPC files with dictionary-encoded columns.")
+    parser.add_argument("--top", type=int, metavar="N", help="also print the N most frequent taxa per database")
+    args = parser.parse_args()
+
+    manifest = StageManifest()
+    for db_dir in sorted(glob.glob(os.path.join(TRANSLATED_DIR, "*/"))):
+        db = os.path.basename(os.path.normpath(db_dir))
+        names = sample_names(db_dir)
+        out_dir = os.path.join(COLUMNAR_DIR, db)
+        wanted = set()
+        text_bytes = arrow_bytes = 0
+        for tabular in sorted(glob.glob(os.path.join(db_dir, "*.tabular"))):
+            filename = os.path.basename(tabular)
+            stem = filename[:-len(".tabular")]
+            sample = names.get(filename, stem)
+            arrow = os.path.join(out_dir, f"{stem}.arrow")
+            wanted.add(arrow)
+            key = f"{db}/{filename}"
+            sig = manifest.signature(files={"tabular": tabular}, tool=f"pyarrow {pa.__version__}",
+                                     params={"sample": sample})
+            if not manifest.is_current("columnar", key, sig):
+                rows, taxa = convert(tabular, arrow, sample, db)
+                manifest.record("columnar", key, sig, [arrow])
+                log(f"{db}: {filename} -> {arrow} ({rows} rows, {taxa} taxa, sample '{sample}')")
+            text_bytes += os.path.getsize(tabular)
+            arrow_bytes += os.path.getsize(arrow)
+
+        # Arrow files whose translated output is gone are stale
+        for arrow in glob.glob(os.path.join(out_dir, "*.arrow")):
+            if arrow not in wanted:
+                os.remove(arrow)
+                log(f"{db}: removed {arrow}, its translated output no longer exists")
+        if wanted:
+            log(f"{db}: {len(wanted)} file(s), {text_bytes / 1e6:.1f} MB of text stored in "
+                f"{arrow_bytes / 1e6:.1f} MB of Arrow IPC")
+        if args.top and wanted:
+            for taxon, rows in top_taxa(db, args.top):
+                log(f"  {rows}\t{taxon}")
+    log("Columnar conversion finished.")
+
+if __name__ == "__main__":
+    log = stage_logger("taxonomy_columnar", LOG_FILE)
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+import os
+import glob
+import heapq
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from pipeline_events import stage_logger
+
+OUTPUT_DIR = "../outputs/taxonomy/translated_kraken"
+RESULTS_DIR = "../outputs/taxonomy/results"
+LOG_FILE = "../outputs/taxonomy/results/kraken_processing.log"
+TOP_N = 10
+WORKERS = os.cpu_count() or 1
+READ_BUFFER = 1 << 20  # bytes
+# "lineage<TAB>reads" tables, counted in Galaxy or while downloading
+# (download_taxonomy.py --server-counts / --stream-counts)
+COUNTS_SUFFIX = ".counts.tsv"
+
+class TaxonCounter:
+    # Counts columns 2-3 of translated Kraken output fed in arbitrary
+    # chunks; only the unfinished last line is held between chunks. An
+    # empty chunk marks the end of the data.
+    def __init__(self):
+        self.counts = Counter()
+        self.partial = b""
+
+    def __call__(self, chunk):
+        lines = (self.partial + chunk).split(b"\n")
+        self.partial = lines.pop() if chunk else b""
+        counts = self.counts
+        for line in lines:
+            fields = line.rstrip(b"\r").split(b"\t", 3)
+            if len(fields) < 2:
+                continue
+            counts[b"\t".join(fields[1:3])] += 1
+
+def translated_files(db_dir):
+    # One file per Galaxy dataset: its count table when there is one,
+    # otherwise the full translated table
+    tables = {path[:-len(".tabular")]: path for path in glob.glob(os.path.join(db_dir, "*.tabular"))}
+    tables.update({path[:-len(COUNTS_SUFFIX)]: path for path in glob.glob(os.path.join(db_dir, f"*{COUNTS_SUFFIX}"))})
+    return sorted(tables.values())
+
+def count_file(path):
+    # Taxon counts for one translated Kraken file: columns 2-3 per read,
+    # counted in a single streaming pass. Count tables are added up as they are.
+    counts = Counter()
+    with open(path, "rb", buffering=READ_BUFFER) as f:
+        if path.endswith(COUNTS_SUFFIX):
+            for line in f:
+                taxon, _, reads = line.rstrip(b"\r\n").rpartition(b"\t")
+                if taxon and reads.isdigit():
+                    counts[taxon] += int(reads)
+            return path, counts
+        counter = TaxonCounter()
+        for block in iter(lambda: f.read(READ_BUFFER), b""):
+            counter(block)
+        counter(b"")
+    return path, counter.counts
+
+def write_count_table(path, counts):
+    # COUNTS_SUFFIX layout, most reads first; replaced atomically
+    with open(f"{path}.tmp", "wb") as f:
+        for taxon, n in sorted(counts.items(), key=lambda kv: (-kv[1], kv[0])):
+            f.write(b"%s\t%d\n" % (taxon, n))
+    os.replace(f"{path}.tmp", path)
+
+def write_counts(path, counts):
+    with open(path, "wb") as f:
+        for taxon, n in sorted(counts.items(), key=lambda kv: (-kv[1], kv[0])):
+            f.write(b"%d\t%s\n" % (n, taxon))
+
+def write_top(path, counts, n):
+    with open(path, "wb") as f:
+        for taxon, count in heapq.nlargest(n, counts.items(), key=lambda kv: kv[1]):
+            f.write(b"%d\t%s\n" % (count, taxon))
+
+def main():
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    log("Starting Kraken dataset processing...")
+
+    db_files = {
+        os.path.basename(os.path.normpath(db_dir)): translated_files(db_dir)
+        for db_dir in sorted(glob.glob(os.path.join(OUTPUT_DIR, "*/")))
+    }
+    db_of = {path: db for db, files in db_files.items() for path in files}
+    totals = {db: Counter() for db in db_files}
+    for db, files in db_files.items():
+        if not files:
+            log(f"WARNING: No .tabular or {COUNTS_SUFFIX} files for Kraken database: {db}")
+
+    # Files from every database share one pool
+    with ProcessPoolExecutor(max_workers=WORKERS) as pool:
+        for path, counts in pool.map(count_file, db_of, chunksize=1):
+            totals[db_of[path]].update(counts)
+            log(f"Counted {sum(counts.values())} reads, {len(counts)} taxa in {path}")
+
+    for db, counts in totals.items():
+        db_results_dir = os.path.join(RESULTS_DIR, db)
+        os.makedirs(db_results_dir, exist_ok=True)
+        write_counts(os.path.join(db_results_dir, "combined_counts.txt"), counts)
+        write_top(os.path.join(db_results_dir, f"top_{db}_taxa.txt"), counts, TOP_N)
+        log(f"Kraken database {db}: {sum(counts.values())} reads, {len(counts)} taxa, top {TOP_N} written")
+
+    log("All Kraken datasets processed!")
+
+if __name__ == "__main__":
+    log = stage_logger("taxonomy_final", LOG_FILE)
+    main()
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+import os
+import re
+import glob
+import json
+import argparse
+from collections import defaultdict
+import pyarrow.compute as pc
+from stage_manifest import StageManifest
+from ncbi_taxonomy import MPA_PREFIXES, Taxonomy, taxonomy_dir
+from taxonomy_columnar import TRANSLATED_DIR, read_translated, sample_names
+from taxonomy_final import COUNTS_SUFFIX, count_file, translated_files
+from pipeline_events import stage_logger
+
+MATRIX_DIR = "../outputs/taxonomy/matrix"
+LOG_FILE = "../outputs/taxonomy/matrix/taxonomy_matrix.log"
+STATE_FILE = "lineage_index.json"  # per database directory
+RANK_SEPARATOR = re.compile(r"[|;]")
+# mpa-style rank prefixes as written by kraken-translate --mpa-format
+RANK_PREFIXES = {"d": "domain", "k": "kingdom", "p": "phylum", "c": "class",
+                 "o": "order", "f": "family", "g": "genus", "s": "species"}
+RANKS = ["domain", "kingdom", "phylum", "class", "order", "family", "genus", "species"]
+ROOT_TAXID = 1
+MATRIX_FILES = ["{}.tsv", "{}.mtx", "{}.samples.txt", "{}.taxa.txt"]
+
+def rank_of(name):
+    # "g__Escherichia" -> "genus"; names without a prefix have no rank
+    prefix, sep, _ = name.partition("__")
+    return RANK_PREFIXES.get(prefix) if sep else None
+
+class LineageIndex:
+    # Prefix tree of every lineage seen in one database, plus the reads
+    # each translated file assigned to each node. Files are added and
+    # dropped one at a time; rank totals are summed up the tree on output.
+
+    def __init__(self, path):
+        self.path = path
+        state = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+        # node id -> [parent id, name, rank]; node 0 is the root
+        self.nodes = state.get("nodes", [[None, "", None]])
+        self.child = {(parent, name): i for i, (parent, name, _) in enumerate(self.nodes) if i}
+        # file name -> {"sample": ..., "counts": {node id: reads}}
+        self.files = state.get("files", {})
+
+    def insert(self, lineage):
+        node = 0
+        for name in RANK_SEPARATOR.split(lineage):
+            if not name:
+                continue
+            key = (node, name)
+            if key not in self.child:
+                self.child[key] = len(self.nodes)
+                self.nodes.append([node, name, rank_of(name)])
+            node = self.child[key]
+        return node
+
+    def add_file(self, filename, sample, lineage_counts):
+        counts = defaultdict(int)
+        for lineage, reads in lineage_counts:
+            counts[self.insert(lineage)] += reads
+        self.files[filename] = {"sample": sample, "counts": {str(node): n for node, n in counts.items()}}
+
+    def unresolved(self):
+        # Names with neither a rank prefix nor a taxonomy lookup yet
+        return sum(1 for _, _, rank in self.nodes[1:] if rank is None)
+
+    def assign_ranks(self, taxonomy):
+        # Ranks of kraken-translate's default "root;...;species" names, by
+        # following each lineage down the NCBI tree from root. Names found
+        # without a matrix rank, or not found, get "" so they are looked up
+        # once. Nodes are numbered after their parents, so one pass does.
+        taxids = {0: None}
+        resolved = 0
+        for node in range(1, len(self.nodes)):
+            parent, name, rank = self.nodes[node]
+            if parent == 0:
+                taxid = ROOT_TAXID if name == taxonomy.name(ROOT_TAXID) else None
+            else:
+                taxid = taxonomy.child(taxids[parent], name) if taxids[parent] else None
+            taxids[node] = taxid
+            if rank is None:
+                ncbi_rank = taxonomy.rank_name(taxid) if taxid else None
+                self.nodes[node][2] = RANK_PREFIXES.get(MPA_PREFIXES.get(ncbi_rank), "")
+                resolved += bool(self.nodes[node][2])
+        return resolved
+
+    def drop_file(self, filename):
+        self.files.pop(filename, None)
+
+    def label(self, node):
+        names = []
+        while node:
+            parent, name, _ = self.nodes[node]
+            names.append(name)
+            node = parent
+        return "|".join(reversed(names))
+
+    def sample_counts(self):
+        # Per sample, reads assigned exactly to each node and reads at the
+        # node or below it. Nodes are numbered after their parents, so one
+        # reverse pass sums every subtree.
+        direct, totals = {}, {}
+        for entry in self.files.values():
+            counts = direct.setdefault(entry["sample"], [0] * len(self.nodes))
+            for node, reads in entry["counts"].items():
+                counts[int(node)] += reads
+        for sample, counts in direct.items():
+            total = list(counts)
+            for node in range(len(self.nodes) - 1, 0, -1):
+                if total[node]:
+                    total[self.nodes[node][0]] += total[node]
+            totals[sample] = total
+        return direct, totals
+
+    def ranked(self, rank):
+        return [i for i, (_, _, node_rank) in enumerate(self.nodes) if node_rank == rank]
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(f"{self.path}.tmp", "w") as f:
+            json.dump({"nodes": self.nodes, "files": self.files}, f)
+        os.replace(f"{self.path}.tmp", self.path)
+
+def lineage_counts(path):
+    # (lineage, reads) pairs of one translated file, counted on the
+    # dictionary codes instead of per line in Python
+    if path.endswith(COUNTS_SUFFIX):
+        return [(lineage.decode(errors="replace"), reads) for lineage, reads in count_file(path)[1].items()]
+    _, lineage = read_translated(path)
+    lineage = lineage.dictionary_encode()
+    counts = pc.value_counts(lineage.indices)
+    names = lineage.dictionary.to_pylist()
+    return [(names[code], reads) for code, reads in
+            zip(counts.field("values").to_pylist(), counts.field("counts").to_pylist())]
+
+def write_dense(path, samples, labels, rows):
+    # samples x taxa, tab separated, with a header of taxon labels
+    with open(path, "w") as f:
+        f.write("sample\t" + "\t".join(labels) + "\n")
+        for sample, row in zip(samples, rows):
+            f.write(sample + "\t" + "\t".join(map(str, row)) + "\n")
+
+def write_sparse(path, samples, labels, rows):
+    # Matrix Market coordinate format (scipy.io.mmread, R Matrix::readMM),
+    # with row and column names alongside
+    entries = [(i + 1, j + 1, n) for i, row in enumerate(rows) for j, n in enumerate(row) if n]
+    with open(f"{path}.mtx", "w") as f:
+        f.write("%%MatrixMarket matrix coordinate integer general\n")
+        f.write(f"{len(samples)} {len(labels)} {len(entries)}\n")
+        f.writelines(f"{i} {j} {n}\n" for i, j, n in entries)
+    with open(f"{path}.samples.txt", "w") as f:
+        f.writelines(f"{sample}\n" for sample in samples)
+    with open(f"{path}.taxa.txt", "w") as f:
+        f.writelines(f"{label}\n" for label in labels)
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-database sample x taxon abundance matrices at every rank, "
+                                                 "updated only for new or changed translated Kraken files.")
+    parser.add_argument("--format", choices=["dense", "sparse", "both"], default="both")
+    args = parser.parse_args()
+
+    manifest = StageManifest()
+    taxonomies = {}
+    for db_dir in sorted(glob.glob(os.path.join(TRANSLATED_DIR, "*/"))):
+        db = os.path.basename(os.path.normpath(db_dir))
+        out_dir = os.path.join(MATRIX_DIR, db)
+        index = LineageIndex(os.path.join(out_dir, STATE_FILE))
+        names = sample_names(db_dir)
+        present = {os.path.basename(p): p for p in translated_files(db_dir)}
+
+        changed = 0
+        for filename in set(index.files) - set(present):
+            index.drop_file(filename)
+            log(f"{db}: dropped {filename}, no longer in {db_dir}")
+            changed += 1
+        for filename, path in present.items():
+            suffix = COUNTS_SUFFIX if filename.endswith(COUNTS_SUFFIX) else ".tabular"
+            sample = names.get(filename, filename[:-len(suffix)])
+            sig = manifest.signature(files={"tabular": path}, params={"sample": sample})
+            key = f"{db}/{filename}"
+            if filename in index.files and manifest.is_current("taxonomy_matrix", key, sig):
+                continue
+            index.add_file(filename, sample, lineage_counts(path))
+            manifest.record("taxonomy_matrix", key, sig)
+            log(f"{db}: indexed {filename} as sample '{sample}'")
+            changed += 1
+        if not index.files:
+            continue
+        # Names without a prefix get their rank from the NCBI taxonomy, when
+        # there is one for this database
+        source = taxonomy_dir(db)
+        if index.unresolved() and os.path.exists(os.path.join(source, "nodes.dmp")):
+            if source not in taxonomies:
+                taxonomies[source] = Taxonomy(source, manifest, log=log)
+            resolved = index.assign_ranks(taxonomies[source])
+            log(f"{db}: ranks of {resolved} lineage name(s) taken from the NCBI taxonomy in {source}")
+            changed += 1
+        if not changed and os.path.exists(index.path):
+            log(f"{db}: {len(index.files)} file(s) already indexed, matrices up to date")
+            continue
+
+        os.makedirs(out_dir, exist_ok=True)
+        direct, totals = index.sample_counts()
+        samples = sorted(totals)
+        unranked = index.unresolved()
+        if unranked:
+            log(f"{db}: {unranked} of {len(index.nodes) - 1} lineage names carry no d__/p__/... rank prefix "
+                f"and there is no NCBI taxonomy in {source}; they appear only in the lineage matrix. "
+                f"Set TAXONOMY_DIR, or translate with make translate_local TRANSLATE_LOCAL_ARGS=--mpa-format")
+        # Every rank counts reads at or below each taxon; "lineage" counts
+        # reads by the exact lineage they were assigned, ranked or not
+        for rank in RANKS + ["lineage"]:
+            counts = direct if rank == "lineage" else totals
+            candidates = range(1, len(index.nodes)) if rank == "lineage" else index.ranked(rank)
+            nodes = [node for node in candidates if any(counts[s][node] for s in samples)]
+            if not nodes:
+                # Nothing at this rank any more; drop matrices left from
+                # earlier runs
+                for name in MATRIX_FILES:
+                    path = os.path.join(out_dir, name.format(rank))
+                    if os.path.exists(path):
+                        os.remove(path)
+                continue
+            labels = [index.label(node) for node in nodes]
+            rows = [[counts[s][node] for node in nodes] for s in samples]
+            if args.format in ("dense", "both"):
+                write_dense(os.path.join(out_dir, f"{rank}.tsv"), samples, labels, rows)
+            if args.format in ("sparse", "both"):
+                write_sparse(os.path.join(out_dir, rank), samples, labels, rows)
+            log(f"{db}: {rank} matrix, {len(samples)} sample(s) x {len(nodes)} taxa")
+        # Saved last, so an interrupted run rebuilds the matrices next time
+        index.save()
+    log("Abundance matrices written.")
+
+if __name__ == "__main__":
+    log = stage_logger("taxonomy_matrix", LOG_FILE)
+    main()
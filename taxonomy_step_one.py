@@ -1,80 +1,26 @@
 #!/usr/bin/env python3
-import os
 import time
-from datetime import datetime
-from bioblend.galaxy import GalaxyInstance
-
-API_KEY_FILE = "galaxy/key.txt"
-ACCESSION_FILE = "download/accession.txt"
-DATABASES_FILE = "galaxy/databases.txt"
-GALAXY_URL = "https://usegalaxy.eu"
-KRAKEN_TOOL_ID = "toolshed.g2.bx.psu.edu/repos/devteam/kraken/kraken/1.3.1"
+from galaxy_session import connect, HistoryIndex
+from galaxy_jobs import JobCache
+from galaxy_polling import wait_for_datasets, failed_datasets
+from stage_manifest import StageManifest
+from galaxy_tools import get_user_databases, kraken_request, signature, submit
+from pipeline_events import stage_logger, sample_timing
+
 CHECK_INTERVAL = 30  # seconds
 LOG_FILE = "../outputs/galaxy/kraken_taxonomy.log"
 
-DATABASE_OPTIONS = {
-    "V": "Viral",
-    "B": "Bacteria",
-    "P": "Plasmid",
-    "A": "Archaea"
-}
-
-def log(message):
-    timestamp = datetime.now().strftime("[%Y-%m-%d %H:%M:%S]")
-    with open(LOG_FILE, "a") as logfile:
-        logfile.write(f"{timestamp} {message}\n")
-    print(f"{timestamp} {message}")
-
-def check_jobs_completion(gi, history_id, dataset_ids):
-    statuses = []
-    for dsid in dataset_ids:
-        state = gi.histories.show_dataset(history_id, dsid)["state"]
-        statuses.append((dsid, state, state == "ok"))
-    return statuses
-
-def get_user_databases():
-    while True:
-        print("\nSelect Kraken databases to use:")
-        print("  V = Viral")
-        print("  B = Bacteria")
-        print("  P = Plasmid")
-        print("  A = Archaea")
-        choice = input("Enter one or more: ").upper().replace(" ", "")
-        selected = [DATABASE_OPTIONS[c] for c in choice if c in DATABASE_OPTIONS]
-        if selected and len(selected) == len(set(choice)):
-            with open(DATABASES_FILE, "w") as dbfile:
-                dbfile.write(" ".join(selected) + "\n")
-            return selected
-        print("Invalid input. Please enter only V, B, P, or A.")
-
-# Validate input files
-if not os.path.exists(API_KEY_FILE) or not os.path.exists(ACCESSION_FILE):
-    log("ERROR: Missing API key or accession file.")
-    exit(1)
-
-# Get credentials
-with open(API_KEY_FILE, "r") as key_file:
-    api_key = key_file.read().strip()
+log = stage_logger("taxonomy_step_one", LOG_FILE)
 
-with open(ACCESSION_FILE, "r") as accession_file:
-    history_name = accession_file.read().strip()
-
-gi = GalaxyInstance(GALAXY_URL, api_key)
-
-# Retrieve the specified history
-histories = gi.histories.get_histories(name=history_name)
-if not histories:
-    log(f"ERROR: History '{history_name}' not found.")
-    exit(1)
-history_id = histories[0]["id"]
-log(f"Using history '{history_name}' (ID: {history_id})")
+gi, history_id, history_name = connect(log)
+index = HistoryIndex(gi, history_id)
+index.sync()
+jobs = JobCache(gi, history_id)
 
 # Get MEGAHIT outputs
-history_contents = gi.histories.show_history(history_id, contents=True)
 megahit_outputs = {
-    item["name"]: item["id"]
-    for item in history_contents
-    if item["history_content_type"] == "dataset" and "MEGAHIT" in item["name"]
+    item["name"]: (item["id"], item["state"])
+    for item in index.find(name_contains="MEGAHIT")
 }
 
 if not megahit_outputs:
@@ -88,58 +34,55 @@ databases = get_user_databases()
 log(f"Selected databases: {databases}")
 
 # Run Kraken for each database
+manifest = StageManifest()
 submitted_jobs = []
+submitted = {}
+submit_times = {}
+up_to_date = 0
 
-for name, dataset_id in megahit_outputs.items():
-    dataset_info = gi.histories.show_dataset(history_id, dataset_id)
-    if dataset_info["state"] != "ok":
+for name, (dataset_id, state) in megahit_outputs.items():
+    if state != "ok":
         log(f"Skipping '{name}': Dataset not in 'ok' state.")
         continue
 
     for db in databases:
-        log(f"Launching Kraken for '{name}' using database '{db}'...")
+        stage = f"kraken_{db}"
+        request = kraken_request(dataset_id, db)
+        sig = signature(manifest, request, {"assembly": dataset_id})
+        if manifest.is_current(stage, name, sig):
+            log(f"Skipping '{name}' with '{db}': already classified.")
+            up_to_date += 1
+            continue
 
-        kraken_inputs = {
-            "mode|mode": "individual",
-            "kraken_database": db,
-            "split_reads": True,
-            "single_paired|input_sequences": {
-                "src": "hda",
-                "id": dataset_id
-            }
-        }
+        log(f"Launching Kraken for '{name}' using database '{db}'...")
 
         try:
-            response = gi.tools.run_tool(
-                history_id=history_id,
-                tool_id=KRAKEN_TOOL_ID,
-                tool_inputs=kraken_inputs
-            )
-            output_ids = [output["id"] for output in response["outputs"]]
+            output_ids = [output["id"] for output in submit(gi, history_id, request, jobs)]
             log(f"  '{name}' with '{db}' -> outputs: {output_ids}")
             submitted_jobs.extend(output_ids)
+            submitted[(stage, name)] = (sig, output_ids)
+            submit_times[(stage, name)] = time.time()
         except Exception as e:
             log(f"  ERROR running Kraken on '{name}' with '{db}': {e}")
 
 if not submitted_jobs:
+    if up_to_date:
+        log(f"Nothing to submit: {up_to_date} Kraken run(s) already up to date.")
+        exit(0)
     log("ERROR: No Kraken jobs were submitted.")
     exit(1)
 
 # Check if it's completed
 log(f"Waiting for {len(submitted_jobs)} Kraken job(s) to finish...")
-while True:
-    time.sleep(CHECK_INTERVAL)
-    job_statuses = check_jobs_completion(gi, history_id, submitted_jobs)
-    pending_jobs = [(dsid, state) for dsid, state, is_ok in job_statuses if not is_ok]
-    for dsid, state, is_ok in job_statuses:
-        log(f"  Dataset {dsid}: {state}")
-    if not pending_jobs:
-        break
-    log(f"{len(pending_jobs)} job(s) still running...")
+timeline = {}
+states = wait_for_datasets(gi, history_id, submitted_jobs, log, CHECK_INTERVAL, index, timeline)
+for (stage, name), (sig, output_ids) in submitted.items():
+    sample_timing(stage, name, submit_times[(stage, name)], output_ids, timeline, states)
+    if all(states[dsid] == "ok" for dsid in output_ids):
+        manifest.record(stage, name, sig, output_ids)
 
 # Final check
-final_statuses = check_jobs_completion(gi, history_id, submitted_jobs)
-failed = [dsid for dsid, state, is_ok in final_statuses if not is_ok]
+failed = failed_datasets(states)
 
 if failed:
     log(f"ERROR: {len(failed)} Kraken job(s) failed: {failed}.")
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+import os
+import argparse
+from galaxy_session import connect, HistoryIndex
+from galaxy_jobs import JobCache
+from galaxy_download import default_filename, download_datasets
+from galaxy_tools import dataset_samples
+from stage_manifest import StageManifest
+from ncbi_taxonomy import Taxonomy, taxonomy_dir
+from pipeline_events import stage_logger
+
+KRAKEN_DIR = "../outputs/taxonomy/kraken"  # as make local_pipeline
+OUTPUT_DIR = "../outputs/taxonomy/translated_kraken"
+SAMPLES_FILE = "samples.tsv"  # file name -> read sample, per database directory
+LOG_FILE = "../outputs/galaxy/local_translate.log"
+
+parser = argparse.ArgumentParser(description="Download Kraken classifications from Galaxy and translate them "
+                                             "here against a local NCBI taxonomy, instead of running "
+                                             "kraken-translate in Galaxy.")
+parser.add_argument("--mpa-format", action="store_true",
+                    help="write lineages as kraken-translate --mpa-format does (d__...|p__...|...)")
+args = parser.parse_args()
+
+log = stage_logger("translate_local", LOG_FILE)
+
+gi, history_id, history_name = connect(log)
+index = HistoryIndex(gi, history_id)
+index.sync()
+jobs = JobCache(gi, history_id)
+
+classification_datasets = index.find(name_contains="Classification")
+if not classification_datasets:
+    log("ERROR: No datasets with 'Classification' found.")
+    exit(1)
+
+# Kraken database of every finished classification, from the parameters of
+# the job that made it
+jobs.fetch([item.get("creating_job") for item in classification_datasets if item.get("state") == "ok"], log)
+ready = []
+db_of = {}
+for item in classification_datasets:
+    if item.get("state") != "ok":
+        log(f"Skipping '{item['name']}' (ID: {item['id']}): dataset in state '{item.get('state')}'")
+        continue
+    kraken_db = jobs.kraken_database(item)
+    if not kraken_db:
+        log(f"ERROR: Could not determine Kraken database for '{item['name']}' (ID: {item['id']}).")
+        continue
+    db_of[item["id"]] = kraken_db
+    ready.append(item)
+
+def kraken_path(item):
+    return os.path.join(KRAKEN_DIR, db_of[item["id"]], default_filename(item))
+
+def translated_name(item):
+    return os.path.splitext(default_filename(item))[0] + ".tabular"
+
+# Classifications already on disk with Galaxy's size and checksum are not
+# fetched again
+log(f"Downloading {len(ready)} Kraken classification(s) to '{KRAKEN_DIR}'...")
+downloaded = download_datasets(gi, ready, kraken_path, log)
+
+# One taxonomy per taxdump directory, shared by the databases that use it
+manifest = StageManifest()
+taxonomies = {}
+translated = failed = 0
+for item in ready:
+    if item["id"] not in downloaded:
+        continue
+    db = db_of[item["id"]]
+    source = taxonomy_dir(db)
+    if not os.path.exists(os.path.join(source, "nodes.dmp")):
+        log(f"ERROR: {db}: no nodes.dmp/names.dmp in {source}; set TAXONOMY_DIR to an NCBI taxdump directory")
+        failed += 1
+        continue
+    out_path = os.path.join(OUTPUT_DIR, db, translated_name(item))
+    sig = manifest.signature(files={"classification": kraken_path(item),
+                                    "nodes": os.path.join(source, "nodes.dmp"),
+                                    "names": os.path.join(source, "names.dmp")},
+                             params={"mpa_format": args.mpa_format})
+    if manifest.is_current("local_translate", item["name"], sig):
+        continue
+    if source not in taxonomies:
+        taxonomies[source] = Taxonomy(source, manifest, mpa=args.mpa_format, log=log)
+    sequences, missing = taxonomies[source].translate(kraken_path(item), out_path)
+    manifest.record("local_translate", item["name"], sig, [out_path])
+    log(f"{db}: '{item['name']}' -> {out_path} ({sequences} classified sequence(s))")
+    if missing:
+        log(f"WARNING: {db}: {len(missing)} taxid(s) of '{item['name']}' are not in {source}, e.g. "
+            f"{missing[:5]}; their sequences were left out. Is the taxonomy older than the database?")
+    translated += 1
+log(f"Translated {translated} classification(s); {len(downloaded) - translated - failed} already up to date")
+
+# Galaxy file names say nothing about the sample; record it next to them,
+# keeping entries written by make download_taxonomy
+sample_of = dataset_samples(index, manifest)
+for db in sorted(set(db_of.values())):
+    path = os.path.join(OUTPUT_DIR, db, SAMPLES_FILE)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    names = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            names = dict(line.rstrip("\n").split("\t", 1) for line in f if "\t" in line)
+    for item in ready:
+        if db_of[item["id"]] == db and item["id"] in sample_of:
+            names[translated_name(item)] = sample_of[item["id"]]
+    with open(path, "w") as f:
+        f.writelines(f"{name}\t{sample}\n" for name, sample in sorted(names.items()))
+
+if failed or len(downloaded) < len(ready):
+    log(f"ERROR: {len(ready) - len(downloaded)} classification(s) could not be downloaded, "
+        f"{failed} could not be translated.")
+    exit(1)
+log("All Kraken classifications translated locally.")
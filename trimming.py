@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+import os
+from datetime import datetime
+from sample_scheduler import find_pairs, split_cores, run_tool, run_samples, FASTP_MAX_THREADS, FASTP_ARGS
+from stage_manifest import StageManifest, tool_version
+from pipeline_events import stage_logger
+
+FASTQ_DIR = "../inputs"
+TRIMMED_DIR = "../outputs/fastq_trimmed"
+SAMPLE_LOG_DIR = "../outputs/fastq_trimmed/logs"
+LOG_FILE = "../outputs/fastq_trimmed/fastp.log"
+
+log = stage_logger("trimming", LOG_FILE)
+
+def outputs(accession):
+    return [
+        os.path.join(TRIMMED_DIR, f"{accession}_1.fastq.gz"),
+        os.path.join(TRIMMED_DIR, f"{accession}_2.fastq.gz"),
+        os.path.join(TRIMMED_DIR, f"{accession}.json"),
+        os.path.join(TRIMMED_DIR, f"{accession}.html"),
+    ]
+
+def signature(pair):
+    accession, file1, file2 = pair
+    return manifest.signature(files={"1": file1, "2": file2},
+                              tool=tool_version("fastp"), params={"args": FASTP_ARGS})
+
+def trim(pair):
+    accession, file1, file2 = pair
+    if not os.path.exists(file1) or not os.path.exists(file2):
+        log(f"Error: One or both input files not found: {file1}, {file2}")
+        return False
+
+    log(f"Processing: {file1} and {file2}")
+    out1, out2, json_report, html_report = outputs(accession)
+    cmd = [
+        "fastp", "-w", str(threads),
+        "-i", file1, "-I", file2,
+        "-o", out1, "-O", out2,
+        "-j", json_report, "-h", html_report,
+    ] + FASTP_ARGS
+    if run_tool(cmd, os.path.join(SAMPLE_LOG_DIR, f"{accession}.log")) != 0:
+        return False
+    manifest.record("trim", accession, signature(pair), outputs(accession))
+    return True
+
+os.makedirs(SAMPLE_LOG_DIR, exist_ok=True)
+log(f"=== {datetime.now()} ===")
+
+manifest = StageManifest()
+all_pairs = find_pairs(FASTQ_DIR)
+pairs = [p for p in all_pairs if not manifest.is_current("trim", p[0], signature(p))]
+log(f"Trimming is up to date for {len(all_pairs) - len(pairs)} of {len(all_pairs)} sample(s)")
+
+workers, threads = split_cores(len(pairs), FASTP_MAX_THREADS)
+log(f"Trimming {len(pairs)} sample(s): {workers} at a time, {threads} fastp thread(s) each")
+
+failed = run_samples(pairs, trim, workers, log)
+if failed:
+    log(f"ERROR: fastp failed for: {[accession for accession, _, _ in failed]}")
+
+log(f"=== {datetime.now()} ===")
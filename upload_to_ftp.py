@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+import os
+import time
+import ftplib
+import getpass
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from stage_manifest import StageManifest
+from fastq_stats import failed_pairs
+from pipeline_events import stage_logger, transfer
+
+ACCOUNT_FILE = "galaxy/account.txt"
+LOG_DIR = "../outputs/galaxy"
+LOG_FILE = "../outputs/galaxy/ftp_upload.log"
+DIR_TO_UPLOAD = "../outputs/fastq_trimmed"
+GALAXY_FTP_HOST = os.environ.get("GALAXY_FTP_HOST", "ftp.usegalaxy.eu")
+FTP_JOBS = 4  # parallel connections
+BLOCK_SIZE = 1 << 20  # bytes
+TIMEOUT = 120  # seconds
+
+_local = threading.local()
+
+log = stage_logger("upload_to_ftp", LOG_FILE)
+
+def connection():
+    # One logged-in connection per worker thread, reused for its files
+    ftp = getattr(_local, "ftp", None)
+    if ftp is None:
+        ftp = ftplib.FTP_TLS(GALAXY_FTP_HOST, timeout=TIMEOUT)
+        ftp.login(username, password)
+        ftp.prot_p()
+        ftp.voidcmd("TYPE I")
+        _local.ftp = ftp
+    return ftp
+
+def remote_size(ftp, name):
+    try:
+        return ftp.size(name)
+    except ftplib.error_perm:
+        return None
+
+def upload(path):
+    # Skips a file already complete on the server, appends to a partial
+    # one, and starts over if the remote copy is larger than ours
+    name = os.path.basename(path)
+    size = os.path.getsize(path)
+    try:
+        ftp = connection()
+        offset = remote_size(ftp, name)
+        if offset == size:
+            return "skipped", 0
+        if offset is None or offset > size:
+            offset = 0
+        started = time.time()
+        with open(path, "rb") as f:
+            f.seek(offset)
+            ftp.storbinary(f"{'APPE' if offset else 'STOR'} {name}", f, BLOCK_SIZE)
+        transfer("up", name, started, size - offset)
+        if remote_size(ftp, name) != size:
+            raise IOError(f"remote size differs from local size {size}")
+        return ("resumed" if offset else "uploaded"), size - offset
+    except Exception:
+        # Drop the connection so a retry starts from a fresh login
+        _local.ftp = None
+        raise
+
+parser = argparse.ArgumentParser(description="Upload trimmed reads to the Galaxy FTP server.")
+parser.add_argument("--jobs", type=int, default=FTP_JOBS, help="parallel FTP connections")
+parser.add_argument("--dir", default=DIR_TO_UPLOAD,
+                    help=f"directory of reads to upload, e.g. ../outputs/fastq_normalised (default {DIR_TO_UPLOAD})")
+args = parser.parse_args()
+DIR_TO_UPLOAD = args.dir
+
+os.makedirs(LOG_DIR, exist_ok=True)
+
+# Galaxy login email
+if not os.path.exists(ACCOUNT_FILE):
+    log(f"ERROR: Galaxy account file not found: {ACCOUNT_FILE}")
+    exit(1)
+with open(ACCOUNT_FILE) as f:
+    username = "".join(f.read().split())
+
+# Files changed since the last successful upload
+upload_key = f"{username}@{GALAXY_FTP_HOST}"
+manifest = StageManifest()
+files = sorted(os.path.join(DIR_TO_UPLOAD, f) for f in os.listdir(DIR_TO_UPLOAD) if f.endswith(".fastq.gz"))
+# Pairs that make fastq_stats found truncated or out of step stay here
+bad_pairs = failed_pairs(DIR_TO_UPLOAD, manifest)
+for accession, problems in sorted(bad_pairs.items()):
+    log(f"ERROR: not uploading {accession}: {'; '.join(problems)}")
+files = [path for path in files if os.path.basename(path).rsplit("_", 1)[0] not in bad_pairs]
+signatures = {path: manifest.signature(files={"file": path}, params={"args": upload_key}) for path in files}
+pending = [path for path in files if not manifest.is_current("upload_to_ftp", os.path.basename(path), signatures[path])]
+if not pending:
+    log(f"All files in '{DIR_TO_UPLOAD}' are already uploaded.")
+    exit(1 if bad_pairs else 0)
+
+password = getpass.getpass(f"Enter Galaxy FTP password for {username}: ")
+log(f"=== {datetime.now()} ===")
+log(f"Uploading {len(pending)} new or changed file(s) from '{DIR_TO_UPLOAD}' to Galaxy FTP "
+    f"for user '{username}' over {min(args.jobs, len(pending))} connection(s)...")
+
+failed = []
+sent = 0
+with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+    futures = {pool.submit(upload, path): path for path in pending}
+    for done, future in enumerate(as_completed(futures), 1):
+        path = futures[future]
+        name = os.path.basename(path)
+        try:
+            status, transferred = future.result()
+        except Exception as e:
+            log(f"[{done}/{len(futures)}] ERROR uploading {name}: {e}")
+            failed.append(name)
+            continue
+        sent += transferred
+        manifest.record("upload_to_ftp", name, signatures[path])
+        log(f"[{done}/{len(futures)}] {status}: {name} ({transferred / 1e6:.1f} MB sent)")
+
+if failed:
+    log(f"ERROR: FTP upload failed for {len(failed)} file(s): {failed}. Rerun to resume them.")
+    exit(1)
+if bad_pairs:
+    log(f"ERROR: {len(bad_pairs)} pair(s) held back by make fastq_stats: {sorted(bad_pairs)}")
+    exit(1)
+log(f"Files uploaded successfully ({sent / 1e9:.2f} GB sent).")
@@ -1,53 +1,25 @@
 #!/usr/bin/env python3
 
 import os
-import time
-from bioblend.galaxy import GalaxyInstance
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from galaxy_session import connect, HistoryIndex
+from galaxy_polling import wait_for_datasets, failed_datasets
+from stage_manifest import StageManifest
+from galaxy_tools import read_pairs, pairs_collection_signature, build_pairs_collection
+from pipeline_events import stage_logger
 
-API_KEY_FILE = "galaxy/key.txt"
-ACCESSION_FILE = "download/accession.txt"
-GALAXY_URL = "https://usegalaxy.eu"
 FTP_DIR = "/"
 UPLOAD_LOG_FILE = "../outputs/galaxy/upload_from_ftp.log"
 FTP_FILES_DIR = "../outputs/fastq_trimmed"
 INTERVAL = 10  # 10 seconds
+UPLOAD_JOBS = 4  # concurrent upload_from_ftp requests
 
 # Log
-def log(message):
-    timestamp = datetime.now().strftime("[%Y-%m-%d %H:%M:%S]")
-    with open(UPLOAD_LOG_FILE, "a") as f:
-        f.write(f"{timestamp} {message}\n")
-    print(f"{timestamp} {message}")
-
-# API
-if not os.path.exists(API_KEY_FILE):
-    log(f"ERROR: Galaxy API key file not found: {API_KEY_FILE}")
-    exit(1)
-
-with open(API_KEY_FILE) as f:
-    api_key = f.read().strip()
-
-# History name
-if not os.path.exists(ACCESSION_FILE):
-    log(f"ERROR: Accession file not found: {ACCESSION_FILE}")
-    exit(1)
+log = stage_logger("upload_to_galaxy", UPLOAD_LOG_FILE)
 
-with open(ACCESSION_FILE) as f:
-    history_name = f.read().strip()
-
-# Galaxy Instance
-gi = GalaxyInstance(url=GALAXY_URL, key=api_key)
-
-# Find or Create History
-histories = gi.histories.get_histories(name=history_name)
-if histories:
-    history_id = histories[0]['id']
-    log(f"Using existing history: {history_name} (ID: {history_id})")
-else:
-    history = gi.histories.create_history(name=history_name)
-    history_id = history['id']
-    log(f"Created new history: {history_name} (ID: {history_id})")
+# Galaxy Instance and history (created on first upload)
+gi, history_id, history_name = connect(log, create=True)
+index = HistoryIndex(gi, history_id)
 
 # Upload Files from FTP
 ftp_files = [f for f in os.listdir(FTP_FILES_DIR) if f.endswith(".fastq.gz")]
@@ -55,59 +27,85 @@ if not ftp_files:
     log(f"WARNING: No .fastq.gz files found in {FTP_FILES_DIR}")
     exit(0)
 
+manifest = StageManifest()
 dataset_ids = []
+submitted = {}
+to_upload = []
+
+# Datasets already in the history by name. A file never recorded in the
+# manifest that is already there (ok, or still importing) is adopted rather
+# than imported again; a recorded file whose local copy changed is re-imported.
+index.sync()
+in_history = {}
+for item in index.find():
+    if item["state"] not in ("error", "failed_metadata", "discarded"):
+        in_history.setdefault(item["name"], item)
 
 for filename in ftp_files:
-    try:
-        upload_response = gi.tools.upload_from_ftp(path=filename, history_id=history_id)
-
-        # Handle single and multiple outputs
-        if isinstance(upload_response, dict) and 'outputs' in upload_response:
-            outputs = upload_response['outputs']
-        elif isinstance(upload_response, list):
-            outputs = upload_response
-        else:
-            outputs = [upload_response]
-
+    signature = manifest.signature(files={"file": os.path.join(FTP_FILES_DIR, filename)},
+                                   params={"history_id": history_id})
+    if manifest.is_current("upload_to_galaxy", filename, signature):
+        log(f"Skipping {filename}: already imported into history")
+        continue
+    existing = in_history.get(filename)
+    if existing and not manifest.outputs("upload_to_galaxy", filename):
+        log(f"Skipping {filename}: already in history as dataset {existing['id']} ({existing['state']})")
+        dataset_ids.append(existing["id"])
+        submitted[filename] = (signature, [existing["id"]])
+        continue
+    to_upload.append((filename, signature))
+
+def upload(filename):
+    upload_response = gi.tools.upload_from_ftp(path=filename, history_id=history_id)
+
+    # Handle single and multiple outputs
+    if isinstance(upload_response, dict) and 'outputs' in upload_response:
+        return upload_response['outputs']
+    elif isinstance(upload_response, list):
+        return upload_response
+    return [upload_response]
+
+# Import requests are independent, so several are sent at once
+with ThreadPoolExecutor(max_workers=UPLOAD_JOBS) as pool:
+    futures = {pool.submit(upload, filename): (filename, signature) for filename, signature in to_upload}
+    for future in as_completed(futures):
+        filename, signature = futures[future]
+        try:
+            outputs = future.result()
+        except Exception as e:
+            log(f"ERROR uploading {filename}: {e}")
+            continue
         for dataset in outputs:
             if isinstance(dataset, dict) and 'id' in dataset:
                 dataset_ids.append(dataset['id'])
+                submitted.setdefault(filename, (signature, []))[1].append(dataset['id'])
                 log(f"Started upload for {filename}, dataset ID: {dataset['id']}")
             else:
                 log(f"WARNING: Unexpected dataset format for {filename}: {dataset}")
-    except Exception as e:
-        log(f"ERROR uploading {filename}: {e}")
 
 
 # Wait for Uploads
-log("Waiting for uploads to complete...")
-
-def is_upload_done(ds):
-    return ds['state'] == 'ok'
-
-
-def all_done(ids):
-    statuses = []
-    for ds_id in ids:
-        try:
-            ds = gi.histories.show_dataset(history_id, ds_id)
-            done = is_upload_done(ds)
-            statuses.append((ds_id, ds['state'], done))
-        except Exception as e:
-            statuses.append((ds_id, f"error ({e})", False))
-    return statuses
-
-done = False
-while not done:
-    time.sleep(INTERVAL)
-    statuses = all_done(dataset_ids)
-    not_done = [(dsid, state) for dsid, state, finished in statuses if not finished]
-    for dsid, state, finished in statuses:
-        log(f"Dataset {dsid} state: {state} {'(done)' if finished else '(waiting)'}")
-    if not not_done:
-        done = True
-        log("All uploads completed successfully.")
-    else:
-        log(f"{len(not_done)} uploads still in progress...")
+states = {}
+if dataset_ids:
+    log("Waiting for uploads to complete...")
+    states = wait_for_datasets(gi, history_id, dataset_ids, log, INTERVAL, index)
+for filename, (signature, ids) in submitted.items():
+    if all(states[dsid] == "ok" for dsid in ids):
+        manifest.record("upload_to_galaxy", filename, signature, ids)
+failed = failed_datasets(states)
+if failed:
+    log(f"ERROR: {len(failed)} upload(s) failed: {failed}")
+    exit(1)
+log("All uploads completed successfully.")
+
+# list:paired collection of every read pair, for collection-based submission
+index.sync()
+name2id = {item["name"]: item["id"] for item in index.find(state="ok") if item["name"] in ftp_files}
+pairs = {s: ids for s, ids in read_pairs(name2id, log).items() if "forward" in ids and "reverse" in ids}
+collection_sig = pairs_collection_signature(manifest, pairs)
+if pairs and not manifest.is_current("reads_collection", history_name, collection_sig):
+    collection_id = build_pairs_collection(gi, history_id, pairs, f"{history_name} reads ({len(pairs)} samples)")
+    manifest.record("reads_collection", history_name, collection_sig, [collection_id])
+    log(f"Created list:paired collection of {len(pairs)} sample(s) (ID: {collection_id})")
 
 